@@ -29,27 +29,52 @@ class MetaGroupAdmin(admin.ModelAdmin):
     ]
 
 
-class LSAdmin(admin.ModelAdmin):
-    readonly_fields = ('id',)
-    filter_horizontal = ('xray_sources',)
+class XrayLinkInline(admin.TabularInline):
+    # calculated from coordinates on save
+    readonly_fields = ('separation', 'position_angle')
 
 
-class LSInline(admin.TabularInline):
+class LSInline(XrayLinkInline):
     model = LS.xray_sources.through
 
 
-class SDSSInline(admin.TabularInline):
+class SDSSInline(XrayLinkInline):
     model = SDSS.xray_sources.through
 
 
-class PSInline(admin.TabularInline):
+class PSInline(XrayLinkInline):
     model = PS.xray_sources.through
 
 
-class GAIAInline(admin.TabularInline):
+class GAIAInline(XrayLinkInline):
     model = GAIA.xray_sources.through
 
 
+class LSAdmin(admin.ModelAdmin):
+    readonly_fields = ('id',)
+    inlines = [
+        LSInline,
+    ]
+
+
+class SDSSAdmin(LSAdmin):
+    inlines = [
+        SDSSInline,
+    ]
+
+
+class PSAdmin(LSAdmin):
+    inlines = [
+        PSInline,
+    ]
+
+
+class GAIAAdmin(LSAdmin):
+    inlines = [
+        GAIAInline,
+    ]
+
+
 class eROSITAAdmin(admin.ModelAdmin):
     readonly_fields = ('id',)
     filter_horizontal = ('meta_objects',)
@@ -61,13 +86,14 @@ class eROSITAAdmin(admin.ModelAdmin):
 admin.site.register(MetaGroup, MetaGroupAdmin)
 admin.site.register(MetaObject, MetaAdmin)
 admin.site.register(OriginFile)
+admin.site.register(IngestCheckpoint)
 admin.site.register(Survey)
 
 admin.site.register(eROSITA, eROSITAAdmin)
 admin.site.register(Comment)
 admin.site.register(LS, LSAdmin)
-admin.site.register(SDSS, LSAdmin)
-admin.site.register(PS, LSAdmin)
-admin.site.register(GAIA, LSAdmin)
+admin.site.register(SDSS, SDSSAdmin)
+admin.site.register(PS, PSAdmin)
+admin.site.register(GAIA, GAIAAdmin)
 admin.site.register(OptComment)
 
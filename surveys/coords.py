@@ -0,0 +1,83 @@
+"""A module implementing vectorized sky coordinates calculations.
+
+Functions accept NumPy arrays (or pandas Series) of coordinates in degrees
+and avoid creating astropy objects per source.
+"""
+
+from typing import List, Tuple
+
+import astropy.units as u
+from astropy_healpix import HEALPix
+import numpy as np
+
+# order of HEALPix indices `hpidx` of sources, nside = 2**19
+HPIDX_ORDER = 19
+
+
+def unit_vectors(ra, dec) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Cartesian coordinates of points on the unit sphere.
+
+    Same values as `SkyCoord(..., distance=1 * u.pc).cartesian`.
+    """
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    cos_dec = np.cos(dec)
+    return cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)
+
+
+def healpix_index(hp: HEALPix, ra, dec) -> np.ndarray:
+    """HEALPix indices of coordinates, same as `hp.skycoord_to_healpix`."""
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    return hp.lonlat_to_healpix(ra * u.deg, dec * u.deg).astype(np.int64)
+
+
+def angular_separation(ra1, dec1, ra2, dec2) -> np.ndarray:
+    """Angular separation in arcseconds (Vincenty formula, as in astropy)."""
+    ra1, dec1, ra2, dec2 = (np.radians(np.asarray(c, dtype=float))
+                            for c in (ra1, dec1, ra2, dec2))
+    d_ra = ra2 - ra1
+    sin_dec1, cos_dec1 = np.sin(dec1), np.cos(dec1)
+    sin_dec2, cos_dec2 = np.sin(dec2), np.cos(dec2)
+
+    num1 = cos_dec2 * np.sin(d_ra)
+    num2 = cos_dec1 * sin_dec2 - sin_dec1 * cos_dec2 * np.cos(d_ra)
+    denominator = sin_dec1 * sin_dec2 + cos_dec1 * cos_dec2 * np.cos(d_ra)
+
+    return np.degrees(np.arctan2(np.hypot(num1, num2), denominator)) * 3600
+
+
+def position_angle(ra1, dec1, ra2, dec2) -> np.ndarray:
+    """Position angle of the second point relative to the first one in
+    degrees East of North in [0, 360) (as `SkyCoord.position_angle`)."""
+    ra1, dec1, ra2, dec2 = (np.radians(np.asarray(c, dtype=float))
+                            for c in (ra1, dec1, ra2, dec2))
+    d_ra = ra2 - ra1
+    x = np.sin(d_ra) * np.cos(dec2)
+    y = np.cos(dec1) * np.sin(dec2) - np.sin(dec1) * np.cos(dec2) * np.cos(d_ra)
+    return np.degrees(np.arctan2(x, y)) % 360
+
+
+def healpix_cone_ranges(ra: float, dec: float, radius: float,
+                        order: int = HPIDX_ORDER) -> List[Tuple[int, int]]:
+    """Return ranges [start, stop] of nested HEALPix indices of `order`
+    covering the cone, `radius` in degrees.
+
+    Cone is searched at a coarse order with pixels about the radius, each
+    coarse pixel is a contiguous range of nested indices of `order`,
+    adjacent ranges are merged. Ranges can contain points outside the cone.
+    """
+    # pixel size of order 0 is ~58.6 degrees
+    resolution = np.degrees(np.sqrt(np.pi / 3))
+    coarse_order = int(np.clip(np.floor(np.log2(resolution / max(radius, 1e-9))) + 1, 0, order))
+    hp = HEALPix(nside=2 ** coarse_order, order='nested', frame='icrs')
+    pixels = np.sort(hp.cone_search_lonlat(ra * u.deg, dec * u.deg, radius * u.deg))
+
+    shift = 2 * (order - coarse_order)
+    ranges = []
+    for pixel in pixels.tolist():
+        if ranges and ranges[-1][1] + 1 == pixel << shift:
+            ranges[-1][1] = ((pixel + 1) << shift) - 1
+        else:
+            ranges.append([pixel << shift, ((pixel + 1) << shift) - 1])
+    return [(start, stop) for start, stop in ranges]
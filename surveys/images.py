@@ -0,0 +1,279 @@
+"""A module implementing staging of source images.
+
+Images of master table sources are placed in `{settings.MASTER_DIR}/eRASS{i}`
+as `src_{img_id}_lc.pdf`, `src_{img_id}_spec.pdf` and
+`src_{img_id}_e{i}.png` and are staged to
+`{settings.IMAGE_DATA_PATH}/e{i}` as `lc_{meta_ind}.pdf`,
+`spec_{meta_ind}.pdf` and `trans_{meta_ind}.png`.
+
+Staged images are listed in the manifest `{settings.IMAGE_DATA_PATH}/manifest.json`
+with hashes of their content, templates check images with `image_exists`
+without filesystem calls and add the hash to image URLs (`image_url`), so
+images can be served with `Cache-Control: immutable`.
+
+Light curves and spectra have PNG previews `{name}_preview.png` of their
+first page, rendered by `pdftoppm`.
+"""
+
+from collections import Counter, defaultdict
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import re
+import shutil
+import subprocess
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+# eROSITA surveys with image dirs
+IMAGE_SURVEYS = range(1, 10)
+
+# kind of image: (file name template, extension)
+IMAGE_KINDS = {'lc': ('lc_{}.pdf', 'pdf'),
+               'spec': ('spec_{}.pdf', 'pdf'),
+               'trans': ('trans_{}.png', 'png')}
+
+MANIFEST_NAME = 'manifest.json'
+# how often the manifest file is checked for changes, seconds
+MANIFEST_CHECK_INTERVAL = 60
+
+SOURCE_NAME_RE = re.compile(r'^src_(?P<img_id>.+)_(?:(?P<kind>lc|spec)\.pdf|e(?P<survey>\d+)\.png)$')
+
+
+def image_dir(survey: int) -> str:
+    """Dir of staged images of the survey."""
+    return os.path.join(settings.IMAGE_DATA_PATH, 'e' + str(survey))
+
+
+def make_image_dirs():
+    """Make dirs of staged images of all surveys."""
+    for survey in IMAGE_SURVEYS:
+        os.makedirs(image_dir(survey), exist_ok=True)
+
+
+def scan_source_images(images_path: str = None) -> Dict[str, List[Tuple[int, str, str]]]:
+    """Return {img_id: [(survey, kind, source path)]} of all images found in
+    source dirs, each dir is listed once.
+
+    Trans images are taken only from the dir of their survey.
+    """
+    images_path = images_path or settings.MASTER_DIR
+    images = defaultdict(list)
+    for survey in IMAGE_SURVEYS:
+        survey_path = os.path.join(images_path, 'eRASS' + str(survey))
+        if not os.path.isdir(survey_path):
+            continue
+        with os.scandir(survey_path) as entries:
+            for entry in entries:
+                match = SOURCE_NAME_RE.match(entry.name)
+                if match is None or not entry.is_file():
+                    continue
+                kind = match['kind']
+                if kind is None:
+                    if int(match['survey']) != survey:
+                        continue
+                    kind = 'trans'
+                images[match['img_id']].append((survey, kind, entry.path))
+    return images
+
+
+def stage_file(source_path: str, target_path: str) -> str:
+    """Stage one file, return 'skipped', 'linked' or 'copied'.
+
+    Files with the same size and mtime are skipped. Hardlinks are made if
+    both paths are on the same filesystem, otherwise the file is copied with
+    its mtime.
+    """
+    source_stat = os.stat(source_path)
+    try:
+        target_stat = os.stat(target_path)
+    except FileNotFoundError:
+        target_stat = None
+    if target_stat is not None:
+        if (target_stat.st_size == source_stat.st_size
+                and int(target_stat.st_mtime) == int(source_stat.st_mtime)):
+            return 'skipped'
+        os.remove(target_path)
+
+    if source_stat.st_dev == os.stat(os.path.dirname(target_path)).st_dev:
+        try:
+            os.link(source_path, target_path)
+            return 'linked'
+        except OSError:
+            # filesystem without hardlinks
+            pass
+    shutil.copy2(source_path, target_path)
+    return 'copied'
+
+
+def stage_images(meta_inds: Iterable[Tuple[str, int]], images_path: str = None,
+                 workers: int = 8) -> Counter:
+    """Stage images of meta objects in a thread pool.
+
+    :param meta_inds: pairs (img_id, meta_ind) of master table rows.
+    :param images_path: dir with source image dirs, MASTER_DIR by default.
+    :param workers: number of threads copying files.
+    :return: number of files by result of `stage_file`.
+    """
+    make_image_dirs()
+    source_images = scan_source_images(images_path)
+    tasks = []
+    for img_id, meta_ind in meta_inds:
+        for survey, kind, source_path in source_images.get(str(img_id), []):
+            target_name = IMAGE_KINDS[kind][0].format(meta_ind)
+            tasks.append((source_path, os.path.join(image_dir(survey), target_name)))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return Counter(executor.map(lambda task: stage_file(*task), tasks))
+
+
+def preview_name(pdf_name: str) -> str:
+    """Name of PNG preview of PDF image."""
+    return pdf_name[:-len('.pdf')] + '_preview.png'
+
+
+def render_preview(pdf_path: str, size: int = 600) -> str:
+    """Render the first page of PDF to PNG preview with the longest side of
+    `size` pixels, return 'skipped' or 'rendered'.
+
+    Previews newer than their PDF files are skipped.
+    """
+    preview_path = preview_name(pdf_path)
+    try:
+        if os.stat(preview_path).st_mtime >= os.stat(pdf_path).st_mtime:
+            return 'skipped'
+    except FileNotFoundError:
+        pass
+    # pdftoppm adds extension to the output file
+    subprocess.run(['pdftoppm', '-png', '-singlefile', '-f', '1', '-l', '1', '-scale-to', str(size),
+                    pdf_path, preview_path[:-len('.png')]],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    return 'rendered'
+
+
+def render_previews(size: int = 600, workers: int = 8) -> Counter:
+    """Render previews of all staged PDF images in a pool of threads running
+    `pdftoppm`.
+
+    :return: number of files by result of `render_preview`.
+    """
+    pdf_paths = []
+    for survey in IMAGE_SURVEYS:
+        if not os.path.isdir(image_dir(survey)):
+            continue
+        with os.scandir(image_dir(survey)) as entries:
+            pdf_paths.extend(entry.path for entry in entries if entry.name.endswith('.pdf'))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return Counter(executor.map(lambda pdf_path: render_preview(pdf_path, size), pdf_paths))
+
+
+def manifest_path() -> str:
+    """Path of the manifest of staged images."""
+    return os.path.join(settings.IMAGE_DATA_PATH, MANIFEST_NAME)
+
+
+def file_hash(path: str) -> str:
+    """Short hash of file content."""
+    file_hash = hashlib.blake2b(digest_size=8)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def read_manifest() -> Dict[str, list]:
+    """Return {path: [size, mtime_ns, hash]} of images in the manifest file,
+    empty dict if there is no manifest or it lists images without hashes."""
+    try:
+        with open(manifest_path()) as f:
+            images = json.load(f)['images']
+    except FileNotFoundError:
+        return {}
+    # manifest of previous versions is a list of paths
+    return images if isinstance(images, dict) else {}
+
+
+def write_manifest() -> int:
+    """List staged images of all surveys with hashes of their content in the
+    manifest, return number of images.
+
+    Paths are relative to IMAGE_DATA_PATH, e.g. `e1/lc_1000.pdf`. Hashes are
+    calculated only for files with size or mtime changed since the previous
+    manifest. The file is replaced atomically.
+    """
+    old_images = read_manifest()
+    images = {}
+    for survey in IMAGE_SURVEYS:
+        if not os.path.isdir(image_dir(survey)):
+            continue
+        with os.scandir(image_dir(survey)) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                path = f'e{survey}/{entry.name}'
+                stat = entry.stat()
+                old_image = old_images.get(path)
+                if old_image is not None and old_image[:2] == [stat.st_size, stat.st_mtime_ns]:
+                    images[path] = old_image
+                else:
+                    images[path] = [stat.st_size, stat.st_mtime_ns, file_hash(entry.path)]
+
+    path = manifest_path()
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'images': dict(sorted(images.items()))}, f)
+    os.replace(path + '.tmp', path)
+    return len(images)
+
+
+# cached manifest: {path: hash} of images, mtime of the file and time of the last check
+_manifest = {'images': None, 'mtime': None, 'checked': None}
+
+
+def get_manifest() -> Optional[Dict[str, str]]:
+    """Return {path: content hash} of staged images from the manifest, None
+    if there is no manifest.
+
+    The manifest is read once per process and reloaded if the file is
+    changed, the file is checked at most every MANIFEST_CHECK_INTERVAL
+    seconds.
+    """
+    now = time.monotonic()
+    if _manifest['checked'] is not None and now - _manifest['checked'] < MANIFEST_CHECK_INTERVAL:
+        return _manifest['images']
+
+    try:
+        mtime = os.stat(manifest_path()).st_mtime
+    except FileNotFoundError:
+        mtime = None
+    if mtime is None:
+        images = None
+    elif mtime == _manifest['mtime']:
+        images = _manifest['images']
+    else:
+        images = {path: image[2] for path, image in read_manifest().items()}
+    _manifest.update(images=images, mtime=mtime, checked=now)
+    return images
+
+
+def image_exists(path: str) -> bool:
+    """Check if image is staged, `path` is relative to IMAGE_DATA_PATH.
+
+    Without manifest the file is checked on disk.
+    """
+    images = get_manifest()
+    if images is None:
+        return os.path.isfile(os.path.join(settings.IMAGE_DATA_PATH, path))
+    return path in images
+
+
+def image_version(path: str) -> Optional[str]:
+    """Return content hash of staged image from the manifest, None if it is
+    unknown. `path` is relative to IMAGE_DATA_PATH."""
+    images = get_manifest()
+    if images is None:
+        return None
+    return images.get(path)
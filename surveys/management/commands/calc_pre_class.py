@@ -1,212 +1,216 @@
 from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
 from django.utils import timezone
 import pandas as pd
 import numpy as np
 
 from surveys.models import *
-from django.conf import settings
-import shutil
-import os
+from surveys.utils import calculate_link_separations, filter_in_chunks
 
-import astropy.units as u
-from astropy.coordinates import SkyCoord
 
-import astropy_healpix
-from astropy_healpix import HEALPix
+class Command(BaseCommand):
+    help = ("Calculate pre-class for loaded eROSITA Sources. Missing flags are calculated, all flags of sources "
+            "marked as dirty by loaders (pre_class_dirty) are recalculated.")
 
+    # pre-class flags of eROSITA sources and meta objects
+    flag_fields = ['flag_agn_wise', 'g_s', 'ls_g_s']
 
-class Command(BaseCommand):
-    help = "Calculate pre-class for loaded eROSITA Sources."
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100000,
+                            help='number of eROSITA sources processed at once')
+        parser.add_argument('--incremental', action='store_true',
+                            help='process only eROSITA sources and meta objects marked as dirty')
 
     @staticmethod
-    def calculate_wise_agn(xray_source, c_xray, Rc):
-        # flag_agn_wise = 1 - w1 - w2 > 0.8 для ВСЕХ источников в кружке Rc
-        # flag_agn_wise = 0 - все остальные случаи
-        ls_sources = xray_source.ls_sources.all()
-        # TODO: what to return - False or None?
-        if not ls_sources.exists():
+    def to_python(value):
+        """Convert NumPy scalar to Python value, missing values to None."""
+        if pd.isna(value):
             return None
-        else:
-            # get ra, dec of ls sources
-            ra = ls_sources.values_list('ra', flat=True)
-            dec = ls_sources.values_list('dec', flat=True)
-            # get sky coords for ls sources
-            c_opts = SkyCoord(ra=ra * u.degree, dec=dec * u.degree, distance=1 * u.pc, frame='icrs')
-            # get separations in arcseconds
-            sep_arcsec = np.array(c_xray.separation(c_opts).arcsecond)
-            # get indices of near sources
-            ls_indices = np.argwhere(sep_arcsec < Rc).flatten()
-            print(ls_indices)
-            # get near ls sources
-            for ls_ind in ls_indices:
-                near_ls = ls_sources[int(ls_ind)]
-                # print(f'{ls_ind}: LS Source in radius of correlation: {near_ls} flag_agn_wise: {near_ls.flag_agn_wise}')
-                # return False if any source has False flag
-                if not near_ls.flag_agn_wise:
-                    return False
-            # return True if all sources are AGN in radius of correlation
-            return True
+        return value.item() if isinstance(value, np.generic) else value
 
     @staticmethod
-    def calculate_gaia_star(xray_source, c_xray, Rc):
-        # g_s = 1 - все источники Гаяй внутри Rc звезды
-        # g_s = 0 - ... не звезды
-        # g_s = 2	- звезды и не звезды
-        # g_s = -1 - нет источников Гайя внутри Rc
-        gaia_sources = xray_source.gaia_sources.all()
-        # TODO: what to return - -1 or None?
-        if not gaia_sources.exists():
-            return None
-        else:
-            # get ra, dec of gaia sources
-            ra = gaia_sources.values_list('ra', flat=True)
-            dec = gaia_sources.values_list('dec', flat=True)
-            # get sky coords for gaia sources
-            c_opts = SkyCoord(ra=ra * u.degree, dec=dec * u.degree, distance=1 * u.pc, frame='icrs')
-            # get separations in arcseconds
-            sep_arcsec = np.array(c_xray.separation(c_opts).arcsecond)
-            # get indices of near sources
-            gaia_indices = np.argwhere(sep_arcsec < Rc).flatten()
-            print(gaia_indices)
-            # return -1 if there is no sources in Rc
-            if len(gaia_indices) == 0:
-                return -1
-            # there is opt sources in Rc
-            g_s = -1
-            # get near gaia sources
-            for gaia_ind in gaia_indices:
-                near_gaia = gaia_sources[int(gaia_ind)]
-                # print(f'{gaia_ind}: GAIA Source in radius of correlation: {near_gaia} star: {near_gaia.star}')
-                if not near_gaia.star and g_s == -1:
-                    g_s = 0
-                elif near_gaia.star and g_s == -1:
-                    g_s = 1
-                elif (not near_gaia.star and g_s == 1) or (near_gaia.star and g_s == 0):
-                    return 2
-            # return 0 - no stars in Rc, 1 - all stars in Rc, 2 - stars and no stars
-            return g_s
+    def get_pairs(opt_model, opt_fields, xray_data):
+        """Return table of (xray source, optical source) links of xray sources
+        in `xray_data` with `opt_fields` of optical sources and separations
+        in arcseconds stored in links, selected by exact pks of xray sources
+        in chunks. Separations of links stored without them are calculated
+        from coordinates.
+
+        :param opt_model: optical survey model.
+        :param opt_fields: fields of optical sources.
+        :param xray_data: table of eROSITA sources indexed by pk.
+        """
+        m2m_field = opt_model._meta.get_field('xray_sources')
+        through = m2m_field.remote_field.through
+        opt_name = m2m_field.m2m_field_name()
+
+        pairs = pd.DataFrame.from_records(
+            list(filter_in_chunks(
+                through.objects.values_list(m2m_field.m2m_reverse_name(), m2m_field.m2m_column_name(), 'separation',
+                                            *(opt_name + '__' + field for field in opt_fields)),
+                m2m_field.m2m_reverse_name(), xray_data.index.tolist())),
+            columns=['xray_pk', 'opt_pk', 'sep'] + opt_fields)
+        pairs['sep'] = pd.to_numeric(pairs['sep'].astype(float))
+        missing = pairs['sep'].isna()
+        if missing.any():
+            pairs.loc[missing, 'sep'] = calculate_link_separations(
+                through, pairs.loc[missing, ['opt_pk', 'xray_pk']])['sep'].to_numpy()
+        return pairs
+
+    @staticmethod
+    def calculate_wise_agn(pairs, Rc):
+        # flag_agn_wise = 1 - w1 - w2 > 0.8 для ВСЕХ источников в кружке Rc
+        # flag_agn_wise = 0 - все остальные случаи
+        # sources without ls sources are not in the result (None)
+        near = pairs[pairs['sep'].to_numpy() < Rc.loc[pairs['xray_pk']].to_numpy()]
+        # False if any source has False flag, True if all sources are AGN in radius of correlation
+        flags = pd.Series(True, index=pd.Index(pairs['xray_pk'].unique(), name='xray_pk'))
+        not_agn = near.loc[~near['flag_agn_wise'].eq(True), 'xray_pk'].unique()
+        flags[not_agn] = False
+        return flags
 
     @staticmethod
-    def calculate_ls_star(xray_source, c_xray, Rc):
-        # g_s = 1 - все источники DESI LS внутри Rc звезды
+    def calculate_star(pairs, Rc):
+        # g_s = 1 - все источники внутри Rc звезды
         # g_s = 0 - ... не звезды
         # g_s = 2	- звезды и не звезды
-        # g_s = -1 - нет источников DESI LS внутри Rc
-        ls_sources = xray_source.ls_sources.all()
-        # TODO: what to return - -1 or None?
-        if not ls_sources.exists():
-            return None
-        else:
-            # get ra, dec of gaia sources
-            ra = ls_sources.values_list('ra', flat=True)
-            dec = ls_sources.values_list('dec', flat=True)
-            # get sky coords for gaia sources
-            c_opts = SkyCoord(ra=ra * u.degree, dec=dec * u.degree, distance=1 * u.pc, frame='icrs')
-            # get separations in arcseconds
-            sep_arcsec = np.array(c_xray.separation(c_opts).arcsecond)
-            # get indices of near sources
-            ls_indices = np.argwhere(sep_arcsec < Rc).flatten()
-            print(ls_indices)
-            # return -1 if there is no sources in Rc
-            if len(ls_indices) == 0:
-                return -1
-            # there is opt sources in Rc
-            ls_g_s = -1
-            # get near gaia sources
-            for ls_ind in ls_indices:
-                near_ls = ls_sources[int(ls_ind)]
-                # print(f'{ls_ind}: LS Source in radius of correlation: {near_ls} star: {near_ls.star}')
-                if not near_ls.star and ls_g_s == -1:
-                    ls_g_s = 0
-                elif near_ls.star and ls_g_s == -1:
-                    ls_g_s = 1
-                elif (not near_ls.star and ls_g_s == 1) or (near_ls.star and ls_g_s == 0):
-                    return 2
-            # return 0 - no stars in Rc, 1 - all stars in Rc, 2 - stars and no stars
-            return ls_g_s
+        # g_s = -1 - нет источников внутри Rc
+        # sources without optical sources are not in the result (None)
+        near = pairs[pairs['sep'].to_numpy() < Rc.loc[pairs['xray_pk']].to_numpy()]
+        flags = pd.Series(-1, index=pd.Index(pairs['xray_pk'].unique(), name='xray_pk'))
+        stars = near['star'].eq(True).groupby(near['xray_pk']).agg(['any', 'all'])
+        flags[stars.index] = np.where(stars['all'], 1, np.where(stars['any'], 2, 0))
+        return flags
 
     @staticmethod
-    def calculate_tde_v3(meta_object):
+    def calculate_tde_v3(meta_data, star_field='g_s'):
         # ID_e3 == -1 & g_s != 1 &  (qual != 0 & qual != 2) & flag_agn_wise != 1 & RATIO_e4e3 > 7
-        survey_2_flag = meta_object.ID_e1 == -1 and (meta_object.g_s is not None) and meta_object.g_s != 1 \
-                        and (meta_object.flag_agn_wise is not None) and meta_object.flag_agn_wise != 1 \
-                        and (meta_object.RATIO_e2e1 is not None) and meta_object.RATIO_e2e1 > 7
-
-        survey_3_flag = meta_object.ID_e2 == -1 and (meta_object.g_s is not None) and meta_object.g_s != 1 \
-                        and (meta_object.flag_agn_wise is not None) and meta_object.flag_agn_wise != 1 \
-                        and (meta_object.RATIO_e3e2 is not None) and meta_object.RATIO_e3e2 > 7
-
-        survey_4_flag = meta_object.ID_e3 == -1 and (meta_object.g_s is not None) and meta_object.g_s != 1 \
-                        and (meta_object.flag_agn_wise is not None) and meta_object.flag_agn_wise != 1 \
-                        and (meta_object.RATIO_e4e3 is not None) and meta_object.RATIO_e4e3 > 7
-
-        # survey_5_flag = meta_object.ID_e4 == -1 and meta_object.g_s and meta_object.g_s != 1 \
-        #                         and meta_object.flag_agn_wise and meta_object.flag_agn_wise != 1 \
-        #                         and meta_object.RATIO_e5e4 and meta_object.RATIO_e5e4 > 7
-
-        tde_v3 = survey_2_flag or survey_3_flag or survey_4_flag
-        # print(f'Surveys flags: {survey_2_flag}, {survey_3_flag}, {survey_4_flag} = {tde_v3}\n')
+        star = pd.to_numeric(meta_data[star_field], errors='coerce')
+        agn_wise = pd.to_numeric(meta_data['flag_agn_wise'].map({True: 1, False: 0}), errors='coerce')
+        pre_class = star.notna() & (star != 1) & agn_wise.notna() & (agn_wise != 1)
+
+        tde_v3 = pd.Series(False, index=meta_data.index)
+        for id_field, ratio_field in [('ID_e1', 'RATIO_e2e1'), ('ID_e2', 'RATIO_e3e2'), ('ID_e3', 'RATIO_e4e3')]:
+            ratio = pd.to_numeric(meta_data[ratio_field], errors='coerce')
+            tde_v3 |= (meta_data[id_field] == -1) & pre_class & (ratio > 7)
         return tde_v3
 
     @staticmethod
-    def calculate_tde_v3_ls(meta_object):
+    def calculate_tde_v3_ls(meta_data):
         # ID_e3 == -1 & ls_g_s != 1 &  (qual != 0 & qual != 2) & flag_agn_wise != 1 & RATIO_e4e3 > 7
-        survey_2_flag = meta_object.ID_e1 == -1 and (meta_object.ls_g_s is not None) and meta_object.ls_g_s != 1 \
-                        and (meta_object.flag_agn_wise is not None) and meta_object.flag_agn_wise != 1 \
-                        and (meta_object.RATIO_e2e1 is not None) and meta_object.RATIO_e2e1 > 7
-
-        survey_3_flag = meta_object.ID_e2 == -1 and (meta_object.ls_g_s is not None) and meta_object.ls_g_s != 1 \
-                        and (meta_object.flag_agn_wise is not None) and meta_object.flag_agn_wise != 1 \
-                        and (meta_object.RATIO_e3e2 is not None) and meta_object.RATIO_e3e2 > 7
-
-        survey_4_flag = meta_object.ID_e3 == -1 and (meta_object.ls_g_s is not None) and meta_object.ls_g_s != 1 \
-                        and (meta_object.flag_agn_wise is not None) and meta_object.flag_agn_wise != 1 \
-                        and (meta_object.RATIO_e4e3 is not None) and meta_object.RATIO_e4e3 > 7
-
-        # survey_5_flag = meta_object.ID_e4 == -1 and meta_object.ls_g_s and meta_object.ls_g_s != 1 \
-        #                         and meta_object.flag_agn_wise and meta_object.flag_agn_wise != 1 \
-        #                         and meta_object.RATIO_e5e4 and meta_object.RATIO_e5e4 > 7
-
-        tde_v3_ls = survey_2_flag or survey_3_flag or survey_4_flag
-        # print(f'Surveys flags: {survey_2_flag}, {survey_3_flag}, {survey_4_flag} = {tde_v3_ls}\n')
-        return tde_v3_ls
+        return Command.calculate_tde_v3(meta_data, star_field='ls_g_s')
+
+    def calculate_xray_batch(self, xray_data):
+        """Calculate pre-class flags of eROSITA sources of the batch and save
+        them with bulk_update.
+
+        All flags of dirty sources are recalculated, other sources get only
+        missing flags. Dirty marks of the batch are cleared.
+
+        :return: number of updated sources.
+        """
+        # calculate radius of correlation
+        Rc = np.clip(1.1 * pd.to_numeric(xray_data['pos_r98'], errors='coerce'), 4, 20)
+
+        ls_pairs = Command.get_pairs(LS, ['flag_agn_wise', 'star'], xray_data)
+        gaia_pairs = Command.get_pairs(GAIA, ['star'], xray_data)
+        flags = {'flag_agn_wise': Command.calculate_wise_agn(ls_pairs, Rc),
+                 'g_s': Command.calculate_star(gaia_pairs, Rc),
+                 'ls_g_s': Command.calculate_star(ls_pairs, Rc)}
+
+        def get_source(pk):
+            if pk not in xray_sources:
+                xray_sources[pk] = eROSITA(pk=pk, pre_class_dirty=False,
+                                           **{name: Command.to_python(xray_data.at[pk, name])
+                                              for name in Command.flag_fields})
+            return xray_sources[pk]
+
+        xray_sources = {}
+        dirty = xray_data.index[xray_data['pre_class_dirty'].eq(True)]
+        for pk in dirty:
+            get_source(pk)
+        for field, values in flags.items():
+            # sources without optical sources get None
+            target = xray_data.index[xray_data[field].isna()].intersection(values.index).union(dirty)
+            for pk, value in zip(target, values.astype(object).reindex(target).tolist()):
+                setattr(get_source(pk), field, Command.to_python(value))
+        xray_sources = list(xray_sources.values())
+
+        with transaction.atomic():
+            eROSITA.objects.bulk_update(xray_sources, Command.flag_fields + ['pre_class_dirty'], batch_size=1000)
+            # meta objects copy flags of their master sources
+            xray_pks = [xray_source.pk for xray_source in xray_sources]
+            for i in range(0, len(xray_pks), 500):
+                MetaObject.objects.filter(object_sources__in=xray_pks[i:i + 500]).update(pre_class_dirty=True)
+        return len(xray_sources)
+
+    def calculate_meta_objects(self, incremental=False):
+        """Copy pre-class flags of master sources to meta objects and
+        calculate TDE v.3 flags, dirty marks are cleared (also of meta
+        objects skipped because of missing master sources).
+
+        :param incremental: process only dirty meta objects.
+        :return: number of updated meta objects.
+        """
+        meta_filter = {'pre_class_dirty': True} if incremental else {}
+        through = eROSITA.meta_objects.through
+        master_flags = pd.DataFrame.from_records(
+            through.objects.filter(erosita__survey__name=F('metaobject__master_survey'),
+                                   **{'metaobject__' + field: value for field, value in meta_filter.items()})
+            .order_by('metaobject_id', 'erosita_id')
+            .values_list('metaobject_id', *('erosita__' + field for field in Command.flag_fields)),
+            columns=['pk'] + Command.flag_fields)
+        master_flags = master_flags.drop_duplicates('pk').set_index('pk')
+
+        tde_fields = ['ID_e1', 'ID_e2', 'ID_e3', 'RATIO_e2e1', 'RATIO_e3e2', 'RATIO_e4e3']
+        meta_data = pd.DataFrame.from_records(
+            MetaObject.objects.filter(**meta_filter).values_list('pk', *tde_fields),
+            columns=['pk'] + tde_fields).set_index('pk')
+        missing = meta_data.index.difference(master_flags.index)
+        if len(missing):
+            self.stderr.write(f'Master sources of {len(missing)} meta objects not found, skip them')
+        meta_data = meta_data.join(master_flags, how='inner')
+        meta_data['tde_v3'] = Command.calculate_tde_v3(meta_data)
+        meta_data['tde_v3_ls'] = Command.calculate_tde_v3_ls(meta_data)
+
+        fields = Command.flag_fields + ['tde_v3', 'tde_v3_ls']
+        meta_objects = [MetaObject(pk=pk, pre_class_dirty=False, **{field: Command.to_python(value)
+                                             for field, value in zip(fields, row)})
+                        for pk, row in zip(meta_data.index, meta_data[fields].itertuples(index=False, name=None))]
+        missing = missing.tolist()
+        with transaction.atomic():
+            MetaObject.objects.bulk_update(meta_objects, fields + ['pre_class_dirty'], batch_size=1000)
+            # skipped meta objects are not selected again until their sources change
+            for i in range(0, len(missing), 500):
+                MetaObject.objects.filter(pk__in=missing[i:i + 500]).update(pre_class_dirty=False)
+        return len(meta_objects)
 
     def handle(self, *args, **options):
         start_time = timezone.now()
-        for xray_source in eROSITA.objects.all():
-            # calculate radius of correlation
-            Rc = np.clip(1.1 * xray_source.pos_r98, 4, 20)
-            # get SkyCoord for calculating separation
-            c_xray = SkyCoord(ra=xray_source.RA * u.degree, dec=xray_source.DEC * u.degree, distance=1 * u.pc,
-                              frame='icrs')
-            # print(f'Radius of correlation:{Rc}')
-            # get flag values
-            if xray_source.flag_agn_wise is None:
-                xray_source.flag_agn_wise = Command.calculate_wise_agn(xray_source, c_xray, Rc)
-                print(f'AGN Flag for {xray_source.survey.name} - {xray_source}: {xray_source.flag_agn_wise}\n')
-
-            if xray_source.g_s is None:
-                xray_source.g_s = Command.calculate_gaia_star(xray_source, c_xray, Rc)
-                print(f'GAIA EDR3 Star Flag for {xray_source.survey.name} - {xray_source}: {xray_source.g_s}\n')
-
-            if xray_source.ls_g_s is None:
-                xray_source.ls_g_s = Command.calculate_ls_star(xray_source, c_xray, Rc)
-                print(f'GAIA EDR2 Star Flag for {xray_source.survey.name} - {xray_source}: {xray_source.ls_g_s}\n')
-            xray_source.save()
+        batch_size = options['batch_size']
+        if batch_size <= 0:
+            raise CommandError('--batch-size must be positive')
+
+        # only dirty sources in incremental mode
+        xray_sources = eROSITA.objects.all()
+        if options['incremental']:
+            xray_sources = xray_sources.filter(pre_class_dirty=True)
+
+        xray_fields = ['pos_r98', 'pre_class_dirty'] + Command.flag_fields
+        xray_pks = list(xray_sources.order_by('pk').values_list('pk', flat=True))
+        updated_num = 0
+        for i in range(0, len(xray_pks), batch_size):
+            chunk = xray_pks[i:i + batch_size]
+            xray_data = pd.DataFrame.from_records(
+                list(filter_in_chunks(xray_sources.values_list('pk', *xray_fields), 'pk', chunk)),
+                columns=['pk'] + xray_fields).set_index('pk')
+            updated_num += self.calculate_xray_batch(xray_data)
+            self.stdout.write(f'Calculate pre-class of {i + len(chunk)} eROSITA sources, updated {updated_num}')
 
         # get TDE v.3 and to copy pre-class flags to meta object
-        for meta_obj in MetaObject.objects.all():
-            master_source = meta_obj.object_sources.get(survey__name=meta_obj.master_survey)
-            # print(f'Meta Obj {meta_obj} - master source {master_source}\n')
-            meta_obj.g_s = master_source.g_s
-            meta_obj.ls_g_s = master_source.ls_g_s
-            meta_obj.flag_agn_wise = master_source.flag_agn_wise
-            meta_obj.tde_v3 = Command.calculate_tde_v3(meta_obj)
-            meta_obj.tde_v3_ls = Command.calculate_tde_v3_ls(meta_obj)
-            # TODO: delete this later
-            # meta_obj.GLON = master_source.GLON
-            # meta_obj.GLAT = master_source.GLAT
-            meta_obj.save()
+        meta_num = self.calculate_meta_objects(options['incremental'])
+        self.stdout.write(f'Update {meta_num} meta objects')
 
         self.stdout.write(f'End calculating pre-class')
         end_time = timezone.now()
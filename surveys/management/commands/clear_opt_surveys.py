@@ -2,6 +2,7 @@ from django.core.management import BaseCommand
 from django.utils import timezone
 
 from surveys.models import *
+from surveys.utils import clear_row_hashes
 
 
 class Command(BaseCommand):
@@ -32,6 +33,12 @@ class Command(BaseCommand):
         sources.update(ls_dup_sep=None, sdss_dup_sep=None, ps_dup_sep=None, gaia_dup_sep=None)
         # sources.save()
 
+        print('Reset checkpoints and row hashes of optical files')
+        checkpoints = IngestCheckpoint.objects.filter(catalogue__in=['LS', 'SDSS', 'PS', 'GAIA'])
+        # without stale hashes load_optic --incremental loads all rows
+        clear_row_hashes(OriginFile.objects.filter(checkpoints__in=checkpoints).distinct())
+        checkpoints.delete()
+
         self.stdout.write(f'End clearing surveys')
         end_time = timezone.now()
         self.stdout.write(self.style.SUCCESS(f'Clearing took: {(end_time-start_time).total_seconds()} seconds.'))
@@ -2,6 +2,7 @@ from django.core.management import BaseCommand
 from django.utils import timezone
 
 from surveys.models import *
+from surveys.utils import clear_row_hashes
 
 
 class Command(BaseCommand):
@@ -22,6 +23,12 @@ class Command(BaseCommand):
         meta_objects = MetaGroup.objects.all()
         meta_objects.delete()
 
+        print('Reset checkpoints and row hashes of master files')
+        checkpoints = IngestCheckpoint.objects.filter(catalogue='master')
+        # without stale hashes load_master --incremental loads all rows
+        clear_row_hashes(OriginFile.objects.filter(checkpoints__in=checkpoints).distinct())
+        checkpoints.delete()
+
         print('Delete origin files')
         meta_sources = OriginFile.objects.all()
         meta_sources.delete()
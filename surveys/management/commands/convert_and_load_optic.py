@@ -0,0 +1,95 @@
+from collections import defaultdict
+import os
+
+from astropy_healpix import HEALPix
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from surveys.management.commands.convert_optic import Command as ConvertOptic
+from surveys.management.commands.load_optic import Command as LoadOptic
+from surveys.utils import help_from_docstring, record_batch_to_frame
+
+
+@help_from_docstring
+class Command(BaseCommand):
+    """Convert optical sources of eROSITA survey as `convert_optic` and
+    load them into database as `load_optic` in one pass.
+
+    Converted batches of each optical survey (with `flag_agn_wise` and `star`
+    flags) are loaded without writing and reading Parquet files. With
+    `--parquet` converted catalogues are written to
+
+    `{settings.WORK_DIR}/eRASS{survey number}
+        /opt_sources_{optical survey}.parquet`
+
+    too, as `convert_optic` does.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey_num', type=int, help='number of survey')
+        parser.add_argument('--input-format',
+                            choices=['auto', 'parquet', 'feather', 'pkl'],
+                            default='auto',
+                            help='format of input files, see convert_optic')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='number of rows converted and loaded at '
+                                 'once')
+        parser.add_argument('--parquet', action='store_true',
+                            help='write converted catalogues to Parquet '
+                                 'files as well')
+
+    def handle(self, *args, **options):
+        start_time = timezone.now()
+        survey_num = options['survey_num']
+        batch_size = options['batch_size']
+
+        converter = ConvertOptic(stdout=self.stdout, stderr=self.stderr)
+        loader = LoadOptic(stdout=self.stdout, stderr=self.stderr)
+        loader.xray_indices = {}
+        # healpix map with pixel_resolution < 1/2 arcsec
+        hp = HEALPix(nside=2 ** 19, order='nested', frame='icrs')
+        opt_surveys = {file_suffix: (opt_type, field_list)
+                       for opt_type, file_suffix, field_list
+                       in LoadOptic.get_opt_surveys()}
+
+        writers = {}
+        if options['parquet']:
+            writers = ConvertOptic.open_writers('eRASS' + str(survey_num))
+        # number of loaded rows of each optical survey, rows are numbered
+        # as in Parquet files
+        rows_num = defaultdict(int)
+        try:
+            for name, table in converter.iter_catalogue_tables(
+                    survey_num, options['input_format'], batch_size,
+                    verbosity=options['verbosity']):
+                if name in writers:
+                    writers[name].write_table(table)
+
+                opt_type, field_list = opt_surveys[name]
+                # xray source fields and model fields, as read by load_optic
+                columns = [column for column
+                           in dict.fromkeys(['srcname_fin', 'hpidx'] + field_list)
+                           if column in table.column_names]
+                for batch in table.select(columns).to_batches(batch_size):
+                    data = record_batch_to_frame(batch, rows_num[name])
+                    data = LoadOptic.add_sky_columns(data, hp)
+                    with transaction.atomic():
+                        loader.load_opt_survey(data, field_list,
+                                               opt_type=opt_type)
+                    rows_num[name] += batch.num_rows
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        for name, (opt_type, field_list) in opt_surveys.items():
+            self.stdout.write(f'Loaded {rows_num[name]} {opt_type} rows')
+        if writers:
+            self.stdout.write(f'Parquet files are written to '
+                              f'{os.path.join(settings.WORK_DIR, "eRASS" + str(survey_num))}')
+        end_time = timezone.now()
+        self.stdout.write(self.style.SUCCESS(
+            f'Converting and loading took: '
+            f'{(end_time - start_time).total_seconds()} seconds.'
+        ))
@@ -1,15 +1,15 @@
 from django.core.management import BaseCommand
 from django.utils import timezone
 import pandas as pd
-from pandas.api.types import is_datetime64_any_dtype as is_datetime  # for datetime64[ns] format
-import numpy as np
 
 import pickle
 import pyarrow as pa
 import pyarrow.parquet as pq
 
+from surveys.utils import write_partitioned_dataset
 from django.conf import settings
 import os
+import shutil
 
 # from surveys.models import *
 
@@ -19,6 +19,10 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('survey_num', type=int, help='number of survey')
+        parser.add_argument('--partitioned', action='store_true',
+                            help='write Hive partitioned dataset by survey and HEALPix pixel of hpidx')
+        parser.add_argument('--partition-order', type=int, default=3,
+                            help='order of HEALPix pixels of partitioned dataset')
 
     @staticmethod
     def get_fields():
@@ -45,9 +49,9 @@ class Command(BaseCommand):
             pa.field('RA', pa.float64(), False),
             pa.field('DEC', pa.float64(), False),
             pa.field('comment', pa.string()),
-            pa.field('source_class', pa.string()),
-            pa.field('source_class_1', pa.string()),
-            pa.field('source_class_2', pa.string()),
+            pa.field('source_class', pa.dictionary(pa.int32(), pa.string())),
+            pa.field('source_class_1', pa.dictionary(pa.int32(), pa.string())),
+            pa.field('source_class_2', pa.dictionary(pa.int32(), pa.string())),
             # pa.field('master_source', pa.bool_()),
 
             # eROSITA table fields
@@ -135,12 +139,12 @@ class Command(BaseCommand):
             pa.field('c_dbb', pa.float64()),
             pa.field('dof_dbb', pa.int64()),
 
-            pa.field('TSTART', pa.string()),
-            pa.field('TSTOP', pa.string()),
+            pa.field('TSTART', pa.timestamp('ns')),
+            pa.field('TSTOP', pa.timestamp('ns')),
             # end of eROSITA table
 
             pa.field('survey', pa.int64()),
-            pa.field('file_name', pa.string()),
+            pa.field('file_name', pa.dictionary(pa.int32(), pa.string())),
         ]
         schema = pa.schema(fields)
 
@@ -176,16 +180,6 @@ class Command(BaseCommand):
         xray_sources = xray_sources.rename(columns={'srcname_fin': 'name', 'RA_fin': 'RA', 'DEC_fin': 'DEC',
                                                     'RADEC_ERR_fin': 'RADEC_ERR', 'flux_05-20': 'flux_05_20'})
 
-        # TODO: change this later (object, datetime64[ns] -> string)
-        for col in xray_sources.columns:
-            if xray_sources[col].dtype == np.object:
-                print("Column {} type: {}".format(col, xray_sources[col].dtype))
-                xray_sources[col] = xray_sources[col].astype(str)
-            if is_datetime(xray_sources[col]):
-                print("Column {} type: {}".format(col, xray_sources[col].dtype))
-                xray_sources[col] = pd.to_datetime(xray_sources[col]).dt.date
-                xray_sources[col] = xray_sources[col].astype(str)
-
         xray_sources['survey_ind'] = xray_sources.index
         xray_sources.reset_index(drop=True, inplace=True)
         xray_sources['survey'] = survey_num
@@ -200,13 +194,27 @@ class Command(BaseCommand):
                 xray_sources[field] = None
 
         xray_sources = xray_sources[fields]
+
+        # Keep native types: datetime columns are written as timestamps, strings as (dictionary) strings with
+        # nulls, integer columns are converted to nullable integers instead of floats with NaN
+        schema = Command.get_table_schema()
+        for field in schema:
+            if pa.types.is_integer(field.type) and not pd.api.types.is_integer_dtype(xray_sources[field.name]):
+                print("Column {} type: {}".format(field.name, xray_sources[field.name].dtype))
+                xray_sources[field.name] = xray_sources[field.name].astype('Int64')
         print(xray_sources)
 
         # Save parquet table with specified schema
-        schema = Command.get_table_schema()
         table = pa.Table.from_pandas(xray_sources, schema=schema)
         convert_file_name = 'xray_sources_' + str(survey_num) + '.parquet'
-        pq.write_table(table, os.path.join(settings.WORK_DIR, convert_file_name))
+        convert_file_path = os.path.join(settings.WORK_DIR, convert_file_name)
+        # remove partitioned dataset written earlier
+        if os.path.isdir(convert_file_path):
+            shutil.rmtree(convert_file_path)
+        pq.write_table(table, convert_file_path)
+        if options['partitioned']:
+            write_partitioned_dataset(convert_file_path, options['partition_order'])
+            self.stdout.write(f'Partitioned dataset {convert_file_path}')
 
         self.stdout.write(f'End converting pkl')
         end_time = timezone.now()
@@ -1,26 +1,48 @@
-from django.core.management import BaseCommand
+from astropy_healpix import HEALPix
+from django.core.management import BaseCommand, CommandError
 from django.utils import timezone
 import pandas as pd
 from pandas.api.types import is_datetime64_any_dtype as is_datetime  # for datetime64[ns] format
 import numpy as np
 
+import itertools
 import pickle
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
+from typing import Iterator, Optional, Tuple
 
+from surveys.coords import healpix_index
+from surveys.utils import write_partitioned_dataset
 from django.conf import settings
 import os
+import shutil
+import tempfile
 
 # from surveys.models import *
 
 
 class Command(BaseCommand):
-    help = "Convert Optical sources from PKL to Parquet file."
+    help = "Convert Optical sources from PKL, Parquet or Arrow IPC/Feather to Parquet file."
 
     def add_arguments(self, parser):
         parser.add_argument('survey_num', type=int, help='number of survey')
+        parser.add_argument('--input-format', choices=['auto', 'parquet', 'feather', 'pkl'], default='auto',
+                            help='format of input files, auto: Parquet, Arrow IPC/Feather or pickle file with the '
+                                 'same name, in this order')
+        parser.add_argument('--batch-size', type=int, default=100000,
+                            help='number of rows read at once from Parquet and Arrow IPC/Feather files')
+        parser.add_argument('--partitioned', action='store_true',
+                            help='write Hive partitioned datasets by survey and HEALPix pixel of hpidx')
+        parser.add_argument('--partition-order', type=int, default=3,
+                            help='order of HEALPix pixels of partitioned datasets and of temporary partitions '
+                                 'used to drop duplicates of Parquet and Arrow IPC/Feather inputs')
 
     base_fields = ['srcname_fin', 'RA_fin', 'DEC_fin', 'hpidx', 'opt_id', 'opt_hpidx', 'survey', 'file_name']
+    # input column names and their names in tables
+    renamed_columns = {'ls_objid': 'ls_objID', 'ps_raBest': 'ps_ra', 'ps_decBest': 'ps_dec',
+                       'gaiaedr3_designation': 'gaiaedr3_objID'}
 
     @staticmethod
     def get_ls_fields():
@@ -487,8 +509,6 @@ class Command(BaseCommand):
         # rename columns - cut prefix 'ls_'
         survey_sources.columns = opt_fields
 
-        print(f'\nTable with {opt_type}sources:\n', survey_sources)
-
         return survey_sources
 
     @staticmethod
@@ -513,19 +533,237 @@ class Command(BaseCommand):
 
         return ls_file_path, ps_file_path
 
-    def handle(self, *args, **options):
-        start_time = timezone.now()
-        survey_num = options['survey_num']
-        # get dir name by survey number
-        dir_name = 'eRASS' + str(survey_num)
-        # get file paths by survey number
-        ls_file_path, ps_file_path = Command.get_ls_ps_file_paths(dir_name, survey_num)
-        # create dirs for optic data
-        # check path
-        print(os.path.join(settings.WORK_DIR, dir_name))
-        if not os.path.exists(os.path.join(settings.WORK_DIR, dir_name)):
-            os.makedirs(os.path.join(settings.WORK_DIR, dir_name))
+    @staticmethod
+    def prepare_opt_sources(opt_sources, survey_num, file_name):
+        """Rename columns of correlated optical sources, add file name and survey, convert dates to strings."""
+        # rename columns of opt sources
+        opt_sources = opt_sources.rename(columns=Command.renamed_columns)
+        # add file name
+        opt_sources['file_name'] = file_name
+
+        # TODO: change this later (datetime64[ns] -> string)
+        for col in opt_sources.columns:
+            if is_datetime(opt_sources[col]):
+                print("Column {} type: {}".format(col, opt_sources[col].dtype))
+                opt_sources[col] = pd.to_datetime(opt_sources[col]).dt.date
+                opt_sources[col] = opt_sources[col].astype(str)
+
+        opt_sources['survey'] = survey_num
+        return opt_sources
 
+    @staticmethod
+    def add_ls_flags(ls_sources):
+        # calculate AGN WISE flag
+        ls_mag_w1 = 22.5 - 2.5 * np.log10(ls_sources['flux_w1'])  # if w1 < 0 -> None, flag=False
+        ls_mag_w2 = 22.5 - 2.5 * np.log10(ls_sources['flux_w2'])  # if w2 < 0 -> None, flag=False
+        ls_sources['flag_agn_wise'] = ((ls_mag_w1 - ls_mag_w2) > 0.8)
+        # calculate star flag GAIA EDR2
+        ls_sources['star'] = ((abs(ls_sources['parallax'] * np.sqrt(ls_sources['parallax_ivar'])) > 5)
+                              | (abs(ls_sources['pmra'] * np.sqrt(ls_sources['pmra_ivar'])) > 5)
+                              | (abs(ls_sources['pmdec'] * np.sqrt(ls_sources['pmdec_ivar'])) > 5))
+        return ls_sources
+
+    @staticmethod
+    def add_gaia_flags(gaia_sources):
+        # convert string column to boolean
+        gaia_sources['duplicated_source'] = gaia_sources['duplicated_source'].replace(
+            {'True ': True, 'True': True, 'False': False, 'False ': False})
+        # calculate star flag GAIA EDR3
+        gaia_sources['star'] = ((abs(gaia_sources['parallax'] / gaia_sources['parallax_error']) > 5)
+                                | (abs(gaia_sources['pmra'] / gaia_sources['pmra_error']) > 5)
+                                | (abs(gaia_sources['pmdec'] / gaia_sources['pmdec_error']) > 5))
+        return gaia_sources
+
+    @staticmethod
+    def get_catalogues():
+        """Return list of (catalogue name, column prefix, fields, schema, function adding flags)."""
+        return [('ls', 'ls_', Command.get_ls_fields(), Command.get_ls_table_schema(), Command.add_ls_flags),
+                ('sdss', 'sdss_', Command.get_sdss_fields(), Command.get_sdss_table_schema(), None),
+                ('ps', 'ps_', Command.get_ps_fields(), Command.get_ps_table_schema(), None),
+                ('gaia', 'gaiaedr3_', Command.get_gaia_fields(), Command.get_gaia_table_schema(), Command.add_gaia_flags)]
+
+    @staticmethod
+    def get_input_columns():
+        """Return names of input columns used by any catalogue."""
+        original_names = {new: old for old, new in Command.renamed_columns.items()}
+        columns = {'srcname_fin'}
+        for name, prefix, fields, schema, add_flags in Command.get_catalogues():
+            for field in fields:
+                column = field if field in Command.base_fields else prefix + field
+                columns.add(original_names.get(column, column))
+        return columns
+
+    @staticmethod
+    def find_input_file(pkl_file_path, input_format='auto'):
+        """Return (path, format) of input file: Parquet, Arrow IPC/Feather file with the same name as pickle file
+        or pickle file itself."""
+        base_path = os.path.splitext(pkl_file_path)[0]
+        candidates = {'parquet': ['.parquet'], 'feather': ['.feather', '.arrow'], 'pkl': ['.pkl']}
+        formats = ['parquet', 'feather', 'pkl'] if input_format == 'auto' else [input_format]
+        for file_format in formats:
+            for extension in candidates[file_format]:
+                if os.path.isfile(base_path + extension):
+                    return base_path + extension, file_format
+        raise CommandError(f'Input file {base_path} with format {input_format} not found')
+
+    @staticmethod
+    def iter_input_batches(file_path, file_format, columns, batch_size):
+        """Read record batches of memory mapped Parquet or Arrow IPC/Feather file with only required columns."""
+        if file_format == 'parquet':
+            parquet_file = pq.ParquetFile(file_path, memory_map=True)
+            columns = [column for column in parquet_file.schema_arrow.names if column in columns]
+            yield from parquet_file.iter_batches(batch_size=batch_size, columns=columns)
+        else:
+            reader = pa.ipc.open_file(pa.memory_map(file_path, 'r'))
+            columns = [column for column in reader.schema.names if column in columns]
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i).select(columns)
+                # split large record batches
+                for offset in range(0, batch.num_rows, batch_size):
+                    yield batch.slice(offset, batch_size)
+
+    @staticmethod
+    def get_output_path(dir_name, name):
+        """Return path of catalogue file, remove partitioned dataset written earlier."""
+        file_path = os.path.join(settings.WORK_DIR, dir_name, f'opt_sources_{name}.parquet')
+        if os.path.isdir(file_path):
+            shutil.rmtree(file_path)
+        return file_path
+
+    @staticmethod
+    def write_partitions(batches: Iterator[pa.RecordBatch], base_dir: str, partitions_num: int,
+                         basename: str = 'part'):
+        """Write record batches with `_part` column to Arrow IPC dataset partitioned by it."""
+        batches = iter(batches)
+        first_batch = next(batches, None)
+        if first_batch is None:
+            return
+        # pixel -1 of sources without coordinates
+        ds.write_dataset(itertools.chain([first_batch], batches), base_dir, schema=first_batch.schema,
+                         basename_template=basename + '-{i}.arrow', format='ipc',
+                         partitioning=ds.partitioning(pa.schema([('_part', pa.int64())]), flavor='hive'),
+                         max_partitions=partitions_num + 1, use_threads=False,
+                         existing_data_behavior='overwrite_or_ignore')
+
+    @staticmethod
+    def iter_partitions(base_dir: str) -> Iterator[Tuple[int, pa.Table]]:
+        """Yield (partition, table sorted by `_row` without `_part` column) of dataset written by
+        `write_partitions`, one partition in memory at a time."""
+        if not os.path.isdir(base_dir):
+            return
+        for partition in sorted(int(dir_name.split('=')[1]) for dir_name in os.listdir(base_dir)):
+            yield partition, Command.read_partition(base_dir, partition)
+
+    @staticmethod
+    def read_partition(base_dir: str, partition: int) -> Optional[pa.Table]:
+        """Table of partition of dataset written by `write_partitions` sorted by `_row`, None if it is missing."""
+        partition_dir = os.path.join(base_dir, f'_part={partition}')
+        if not os.path.isdir(partition_dir):
+            return None
+        table = ds.dataset(partition_dir, format='ipc').to_table()
+        return table.take(pc.sort_indices(table, sort_keys=[('_row', 'ascending')]))
+
+    def iter_columnar_tables(self, ls_input, ps_input, survey_num, file_name, batch_size, partition_order=3,
+                             verbosity=1):
+        """Yield (catalogue name, table) converted from Parquet or Arrow IPC/Feather inputs.
+
+        Only required columns are read by batches, rows are spilled to temporary Arrow IPC datasets, so memory is
+        bounded by batch size and partition size:
+
+        - input rows are numbered in the order of the pickle path (PS rows first) and partitioned by hash of xray
+          source name, so opt_id and the choice of PS rows are calculated within a partition;
+        - sources of each catalogue are partitioned by nested HEALPix pixel of `partition_order` of their
+          coordinates, duplicates are dropped within a pixel keeping the first row.
+        """
+        columns = Command.get_input_columns()
+        catalogues = Command.get_catalogues()
+        partitions_num = 12 * 4 ** partition_order
+        hp = HEALPix(nside=2 ** partition_order, order='nested', frame='icrs')
+
+        rows_num = [0]
+
+        def iter_numbered_batches(file_input):
+            # running row number and partition by xray source name
+            for batch in Command.iter_input_batches(*file_input, columns, batch_size):
+                names = batch.column('srcname_fin').to_pandas()
+                partitions = pd.util.hash_pandas_object(names, index=False).to_numpy() % partitions_num
+                rows = np.arange(rows_num[0], rows_num[0] + batch.num_rows, dtype=np.int64)
+                rows_num[0] += batch.num_rows
+                yield pa.RecordBatch.from_arrays(
+                    batch.columns + [pa.array(rows), pa.array(partitions.astype(np.int64))],
+                    names=batch.schema.names + ['_row', '_part'])
+
+        with tempfile.TemporaryDirectory(prefix='convert_optic_', dir=settings.WORK_DIR) as tmp_dir:
+            # each input is read once, LS rows are numbered after PS rows
+            Command.write_partitions(iter_numbered_batches(ps_input), os.path.join(tmp_dir, 'input_ps'),
+                                     partitions_num)
+            Command.write_partitions(iter_numbered_batches(ls_input), os.path.join(tmp_dir, 'input_ls'),
+                                     partitions_num)
+
+            # converted sources of each catalogue are buffered up to batch size before spilling
+            buffers = {name: [] for name, prefix, fields, schema, add_flags in catalogues}
+            spills_num = [0]
+
+            def spill(name):
+                if buffers[name]:
+                    Command.write_partitions(pa.concat_tables(buffers[name]).to_batches(),
+                                             os.path.join(tmp_dir, 'opt_sources_' + name), partitions_num,
+                                             basename=f'spill-{spills_num[0]}')
+                    spills_num[0] += 1
+                    buffers[name] = []
+
+            for partition, ls_table in Command.iter_partitions(os.path.join(tmp_dir, 'input_ls')):
+                opt_sources_ls = ls_table.to_pandas().set_index('_row')
+                ps_table = Command.read_partition(os.path.join(tmp_dir, 'input_ps'), partition)
+                opt_sources_ps = ps_table.to_pandas().set_index('_row') if ps_table is not None else None
+                if verbosity >= 2:
+                    self.stdout.write(f'Partition {partition} of xray sources, {len(opt_sources_ls)} rows of LS '
+                                      f'file')
+
+                # names of xray sources without correlated ls optical sources, PS rows are taken for them
+                null_ls_sources = opt_sources_ls.loc[opt_sources_ls['ls_objid'].isnull(), 'srcname_fin']
+                opt_sources_ls = opt_sources_ls[opt_sources_ls['ls_objid'].notnull()]
+                if opt_sources_ps is not None:
+                    opt_sources_ps = opt_sources_ps[opt_sources_ps['srcname_fin'].isin(null_ls_sources)]
+                opt_sources = pd.concat([opt_sources_ps, opt_sources_ls])
+                if opt_sources.empty:
+                    continue
+
+                opt_sources = Command.prepare_opt_sources(opt_sources, survey_num, file_name)
+                # index sources in each group(same xray source) + const for complicated cases with opt sources from
+                # dif surveys, all rows of xray source are in the partition
+                opt_sources['opt_id'] = opt_sources.groupby('srcname_fin').cumcount() + (survey_num-1)*100
+
+                for name, prefix, fields, schema, add_flags in catalogues:
+                    survey_sources = Command.get_opt_survey_sources(self, opt_sources, fields, opt_type=prefix)
+                    if survey_sources.empty:
+                        continue
+                    if add_flags:
+                        survey_sources = add_flags(survey_sources)
+                    table = pa.Table.from_pandas(survey_sources, schema=schema, preserve_index=False)
+                    # sources without coordinates are in pixel -1
+                    coordinates = survey_sources[['ra', 'dec']].astype(float)
+                    pixels = np.where(coordinates.isna().any(axis=1), -1,
+                                      healpix_index(hp, coordinates['ra'].fillna(0), coordinates['dec'].fillna(0)))
+                    table = table.append_column('_row', pa.array(survey_sources.index.to_numpy(dtype=np.int64)))
+                    buffers[name].append(table.append_column('_part', pa.array(pixels)))
+                    if sum(buffered.num_rows for buffered in buffers[name]) >= batch_size:
+                        spill(name)
+
+            for name in buffers:
+                spill(name)
+
+            # duplicates of sources of different xray sources are in the same pixel
+            for name, prefix, fields, schema, add_flags in catalogues:
+                for pixel, table in Command.iter_partitions(os.path.join(tmp_dir, 'opt_sources_' + name)):
+                    keys = table.select(['ra', 'dec']).to_pandas()
+                    table = table.filter(pa.array(~keys.duplicated().to_numpy())).select(schema.names)
+                    if verbosity >= 2:
+                        self.stdout.write(f'\nTable with {prefix}sources of pixel {pixel}:\n{table.to_pandas()}')
+                    yield name, table
+
+    def iter_pickle_tables(self, ls_file_path, ps_file_path, survey_num, file_name, verbosity=1):
+        """Yield (catalogue name, table) converted from pickle inputs, loaded into memory as a whole."""
         # load opt sources correlated with DESI LIS
         with open(ls_file_path, 'rb') as f:
             opt_sources_ls = pickle.load(f)
@@ -534,94 +772,97 @@ class Command(BaseCommand):
         with open(ps_file_path, 'rb') as f:
             opt_sources_ps = pickle.load(f)
 
-        print(f'Table with opt_sources_ls:\n', opt_sources_ls)
-        print(f'Table with opt_sources_ps:\n', opt_sources_ps)
+        if verbosity >= 2:
+            self.stdout.write(f'Table with opt_sources_ls:\n{opt_sources_ls}')
+            self.stdout.write(f'Table with opt_sources_ps:\n{opt_sources_ps}')
 
         # get names of xray sources without correlated ls optical sources
         null_ls_sources = list(opt_sources_ls[opt_sources_ls['ls_objid'].isnull()]['srcname_fin'])
         # delete NULL rows
         opt_sources_ls = opt_sources_ls[opt_sources_ls['ls_objid'].notnull()]
-        print(f'Table with notnull opt_sources_ls:\n', opt_sources_ls)
+        if verbosity >= 2:
+            self.stdout.write(f'Table with notnull opt_sources_ls:\n{opt_sources_ls}')
 
         # get ps correlated optical sources for xray sources found earlier
         opt_sources_ps = opt_sources_ps.query('srcname_fin in @null_ls_sources')
         # shuffle and limit number of ps opt sources
         # opt_sources_ps = opt_sources_ps.sample(frac=1)
         # opt_sources_ps = opt_sources_ps.groupby('srcname_fin').head(20)
-        print(f'Table with filtered opt_sources_ps:\n', opt_sources_ps)
+        if verbosity >= 2:
+            self.stdout.write(f'Table with filtered opt_sources_ps:\n{opt_sources_ps}')
 
         # Concatenate sources correlated with ls and correlated with ps
         opt_sources = pd.concat([opt_sources_ps, opt_sources_ls])
-        print(f'Table with concatenated ps sources and ls sources:\n', opt_sources)
-
-        # rename columns of opt sources
-        opt_sources = opt_sources.rename(columns={'ls_objid': 'ls_objID', 'ps_raBest': 'ps_ra', 'ps_decBest': 'ps_dec',
-                                                  'gaiaedr3_designation': 'gaiaedr3_objID'})
+        if verbosity >= 2:
+            self.stdout.write(f'Table with concatenated ps sources and ls sources:\n{opt_sources}')
 
+        opt_sources = Command.prepare_opt_sources(opt_sources, survey_num, file_name)
         # index sources in each group(same xray source) + const for complicated cases with opt sources from dif surveys
         opt_sources['opt_id'] = opt_sources.groupby('srcname_fin').cumcount() + (survey_num-1)*100
-        # add file name
-        file_name = os.path.splitext(os.path.basename(ls_file_path))[0]
-        opt_sources['file_name'] = file_name
 
-        # TODO: change this later (datetime64[ns] -> string)
-        for col in opt_sources.columns:
-            if is_datetime(opt_sources[col]):
-                print("Column {} type: {}".format(col, opt_sources[col].dtype))
-                opt_sources[col] = pd.to_datetime(opt_sources[col]).dt.date
-                opt_sources[col] = opt_sources[col].astype(str)
-
-        opt_sources['survey'] = survey_num
+        for name, prefix, fields, schema, add_flags in Command.get_catalogues():
+            survey_sources = Command.get_opt_survey_sources(self, opt_sources, fields, opt_type=prefix)
+            if verbosity >= 2:
+                self.stdout.write(f'\nTable with {prefix}sources:\n{survey_sources}')
+            if add_flags:
+                survey_sources = add_flags(survey_sources)
+            yield name, pa.Table.from_pandas(survey_sources, schema=schema, preserve_index=False)
+
+    def iter_catalogue_tables(self, survey_num, input_format='auto', batch_size=100000, partition_order=3,
+                              verbosity=1):
+        """Yield (catalogue name, table with catalogue schema) of converted optical sources of the survey.
+
+        Tables of each catalogue are yielded by HEALPix pixels of `partition_order` for Parquet and Arrow
+        IPC/Feather inputs, as a whole for pickle inputs. Tables are written to stdout at verbosity >= 2.
+        """
+        dir_name = 'eRASS' + str(survey_num)
+        # get file paths by survey number
+        ls_file_path, ps_file_path = Command.get_ls_ps_file_paths(dir_name, survey_num)
+        ls_input = Command.find_input_file(ls_file_path, input_format)
+        ps_input = Command.find_input_file(ps_file_path, input_format)
+        self.stdout.write(f'Start converting {ls_input[0]}, {ps_input[0]}')
 
-        # # get DESI LIS sources
-        ls_fields = Command.get_ls_fields()
-        ls_sources = Command.get_opt_survey_sources(self, opt_sources, ls_fields, opt_type='ls_')
-        # calculate AGN WISE flag
-        ls_mag_w1 = 22.5 - 2.5 * np.log10(ls_sources['flux_w1'])  # if w1 < 0 -> None, flag=False
-        ls_mag_w2 = 22.5 - 2.5 * np.log10(ls_sources['flux_w2'])  # if w2 < 0 -> None, flag=False
-        ls_sources['flag_agn_wise'] = ((ls_mag_w1 - ls_mag_w2) > 0.8)
-        # calculate star flag GAIA EDR2
-        ls_sources['star'] = ((abs(ls_sources['parallax'] * np.sqrt(ls_sources['parallax_ivar'])) > 5)
-                              | (abs(ls_sources['pmra'] * np.sqrt(ls_sources['pmra_ivar'])) > 5)
-                              | (abs(ls_sources['pmdec'] * np.sqrt(ls_sources['pmdec_ivar'])) > 5))
+        # file name of LS pickle file is used for all catalogues
+        file_name = os.path.splitext(os.path.basename(ls_file_path))[0]
+        if ls_input[1] == 'pkl' or ps_input[1] == 'pkl':
+            yield from self.iter_pickle_tables(ls_input[0], ps_input[0], survey_num, file_name, verbosity)
+        else:
+            yield from self.iter_columnar_tables(ls_input, ps_input, survey_num, file_name, batch_size,
+                                                 partition_order, verbosity)
 
-        # Save parquet table with specified schema
-        ls_schema = Command.get_ls_table_schema()
-        table = pa.Table.from_pandas(ls_sources, schema=ls_schema)
-        pq.write_table(table, os.path.join(settings.WORK_DIR, dir_name, 'opt_sources_ls.parquet'))
-
-        # # get SDSS source
-        sdss_fields = Command.get_sdss_fields()
-        sdss_sources = Command.get_opt_survey_sources(self, opt_sources, sdss_fields, opt_type='sdss_')
-        # Save parquet table with specified schema
-        sdss_schema = Command.get_sdss_table_schema()
-        table = pa.Table.from_pandas(sdss_sources, schema=sdss_schema)
-        pq.write_table(table, os.path.join(settings.WORK_DIR, dir_name, 'opt_sources_sdss.parquet'))
-
-        # # get PS source
-        ps_fields = Command.get_ps_fields()
-        ps_sources = Command.get_opt_survey_sources(self, opt_sources, ps_fields, opt_type='ps_')
-        # Save parquet table with specified schema
-        ps_schema = Command.get_ps_table_schema()
-        table = pa.Table.from_pandas(ps_sources, schema=ps_schema)
-        pq.write_table(table, os.path.join(settings.WORK_DIR, dir_name, 'opt_sources_ps.parquet'))
-
-        # # get GAIA source
-        gaia_fields = Command.get_gaia_fields()
-        gaia_sources = Command.get_opt_survey_sources(self, opt_sources, gaia_fields, opt_type='gaiaedr3_')
-        # convert string column to boolean
-        gaia_sources['duplicated_source'].replace({'True ': True, 'True': True,
-                                                   'False': False, 'False ': False}, inplace=True)
-        # calculate star flag GAIA EDR3
-        gaia_sources['star'] = ((abs(gaia_sources['parallax'] / gaia_sources['parallax_error']) > 5)
-                                | (abs(gaia_sources['pmra'] / gaia_sources['pmra_error']) > 5)
-                                | (abs(gaia_sources['pmdec'] / gaia_sources['pmdec_error']) > 5))
+    @staticmethod
+    def open_writers(dir_name):
+        """Return ParquetWriter of each catalogue file in the survey dir."""
+        if not os.path.exists(os.path.join(settings.WORK_DIR, dir_name)):
+            os.makedirs(os.path.join(settings.WORK_DIR, dir_name))
+        return {name: pq.ParquetWriter(Command.get_output_path(dir_name, name), schema)
+                for name, prefix, fields, schema, add_flags in Command.get_catalogues()}
 
-        # Save parquet table with specified schema
-        gaia_schema = Command.get_gaia_table_schema()
-        table = pa.Table.from_pandas(gaia_sources, schema=gaia_schema)
-        pq.write_table(table, os.path.join(settings.WORK_DIR, dir_name, 'opt_sources_gaia.parquet'))
+    def handle(self, *args, **options):
+        start_time = timezone.now()
+        survey_num = options['survey_num']
+        # get dir name by survey number
+        dir_name = 'eRASS' + str(survey_num)
+        # create dirs for optic data
+        # check path
+        print(os.path.join(settings.WORK_DIR, dir_name))
 
-        self.stdout.write(f'End converting pkl')
+        # each catalogue is written by its own ParquetWriter
+        writers = Command.open_writers(dir_name)
+        try:
+            for name, table in self.iter_catalogue_tables(survey_num, options['input_format'], options['batch_size'],
+                                                          options['partition_order'], options['verbosity']):
+                writers[name].write_table(table)
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        if options['partitioned']:
+            for name, prefix, fields, schema, add_flags in Command.get_catalogues():
+                file_path = os.path.join(settings.WORK_DIR, dir_name, f'opt_sources_{name}.parquet')
+                write_partitioned_dataset(file_path, options['partition_order'])
+                self.stdout.write(f'Partitioned dataset {file_path}')
+
+        self.stdout.write(f'End converting')
         end_time = timezone.now()
-        self.stdout.write(self.style.SUCCESS(f'Converting PKL took: {(end_time - start_time).total_seconds()} seconds.'))
+        self.stdout.write(self.style.SUCCESS(f'Converting took: {(end_time - start_time).total_seconds()} seconds.'))
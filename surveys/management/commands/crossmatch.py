@@ -0,0 +1,253 @@
+from functools import partial
+from itertools import islice
+import os
+from typing import List
+
+from astropy_healpix import HEALPix
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+from surveys.coords import HPIDX_ORDER, angular_separation, healpix_index, position_angle
+from surveys.management.commands.load_optic import Command as LoadOptic
+from surveys.models import OriginFile, Survey, eROSITA
+from surveys.utils import (cone_search_filter, filter_in_chunks, help_from_docstring, hp_pixels_filter,
+                           iter_parquet_batches, mark_pre_class_dirty)
+
+
+@help_from_docstring
+class Command(BaseCommand):
+    """Cross-match eROSITA sources of the survey with optical catalogue
+    (Parquet file or dataset with `ra`, `dec`, `hpidx` and optical model
+    columns, `hpidx` is nested HEALPix index of order 19 of `ra`, `dec`).
+
+    Optical sources within the match radius of X-ray sources
+
+    `clip(radius factor * pos_r98, min radius, max radius)`
+
+    are found by chunks: nested HEALPix pixels of chunk order with X-ray
+    sources or next to them. For each chunk pixel only X-ray sources of the
+    pixel and its neighbours are loaded and catalogue rows of the pixel are
+    read by batches with `hp_pixels_filter`, which skips row groups and
+    partitions of datasets sorted by `hpidx` (see
+    `write_partitioned_dataset`). Within a chunk pairs are found by HEALPix
+    neighbour search: X-ray sources are indexed by their pixel and 8
+    neighbours at order with pixels larger than the doubled max radius,
+    catalogue batches are joined with the index by pixel. Matched optical
+    sources are created, links and counterparts are written as by
+    `load_optic`.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey_num', type=int, help='number of eROSITA survey')
+        parser.add_argument('opt_type', choices=list(LoadOptic.opt_models), help='optical survey')
+        parser.add_argument('file_path', type=str, help='path of optical catalogue')
+        parser.add_argument('--batch-size', type=int, default=100000,
+                            help='number of catalogue rows read at once')
+        parser.add_argument('--chunk-order', type=int, default=3,
+                            help='order of HEALPix pixels the sky is split into, '
+                                 'limited by the order of neighbour search')
+        parser.add_argument('--radius-factor', type=float, default=1.1,
+                            help='match radius in units of pos_r98')
+        parser.add_argument('--min-radius', type=float, default=4,
+                            help='min match radius, arcseconds')
+        parser.add_argument('--max-radius', type=float, default=20,
+                            help='max match radius, arcseconds')
+
+    @staticmethod
+    def get_search_order(max_radius: float) -> int:
+        """Max HEALPix order with pixels larger than 2 * max_radius
+        (arcseconds), all matches of a source are in its pixel or neighbours."""
+        # pixel size of order 0 is ~58.6 degrees
+        resolution = np.degrees(np.sqrt(np.pi / 3)) * 3600
+        return int(np.clip(np.floor(np.log2(resolution / (2 * max_radius))), 0, HPIDX_ORDER))
+
+    @staticmethod
+    def get_xray_index(xray_data: pd.DataFrame, hp: HEALPix) -> pd.DataFrame:
+        """Return table of (pixel, xray_pk) of X-ray sources and their
+        neighbour pixels."""
+        pixels = healpix_index(hp, xray_data['RA'], xray_data['DEC'])
+        neighbours = hp.neighbours(pixels)
+        xray_index = pd.DataFrame({
+            'pixel': np.concatenate([pixels[np.newaxis], neighbours]).ravel(),
+            'xray_pk': np.tile(xray_data.index.to_numpy(), len(neighbours) + 1),
+        })
+        # missing neighbours are -1
+        xray_index = xray_index[xray_index['pixel'] >= 0].drop_duplicates()
+        return xray_index
+
+    def get_chunk_pixels(self, chunk_hp: HEALPix, batch_size: int) -> List[int]:
+        """Return sorted chunk pixels with X-ray sources of the survey and
+        their neighbours, coordinates are read by batches."""
+        pixels = set()
+        coords = eROSITA.objects.filter(survey__name=self.survey_num).values_list('RA', 'DEC')
+        coords = coords.iterator(chunk_size=batch_size)
+        for batch in iter(lambda: list(islice(coords, batch_size)), []):
+            ra, dec = np.array(batch, dtype=float).T
+            pixels.update(np.unique(healpix_index(chunk_hp, ra, dec)).tolist())
+        pixels = np.array(sorted(pixels), dtype=np.int64)
+        # some pixels at corners of base pixels have 7 neighbours, missing ones are -1
+        with np.errstate(invalid='ignore'):
+            neighbours = chunk_hp.neighbours(pixels).ravel()
+        return np.union1d(pixels, neighbours[neighbours >= 0]).tolist()
+
+    def get_xray_chunk(self, pixel: int, chunk_hp: HEALPix, options) -> pd.DataFrame:
+        """Return X-ray sources of the survey in the chunk pixel and its
+        neighbours with match radius, indexed by pk.
+
+        Sources are selected by cone search around the pixel center
+        covering the neighbours, then by their chunk pixel.
+        """
+        with np.errstate(invalid='ignore'):
+            ring = chunk_hp.neighbours(pixel)
+        ring = np.append(ring[ring >= 0], pixel)
+        center = chunk_hp.healpix_to_lonlat(pixel)
+        ra, dec = float(center[0].deg), float(center[1].deg)
+        lon, lat = chunk_hp.boundaries_lonlat(ring, step=4)
+        radius = 1.01 * angular_separation(ra, dec, lon.deg.ravel(), lat.deg.ravel()).max() / 3600
+
+        xray_sources = cone_search_filter(eROSITA.objects.filter(survey__name=self.survey_num), ra, dec, radius)
+        xray_data = pd.DataFrame.from_records(
+            xray_sources.values_list('pk', 'RA', 'DEC', 'pos_r98'),
+            columns=['pk', 'RA', 'DEC', 'pos_r98']).set_index('pk')
+        xray_data = xray_data[np.isin(healpix_index(chunk_hp, xray_data['RA'], xray_data['DEC']), ring)].copy()
+        # sources without pos_r98 get min radius
+        xray_data['radius'] = np.clip(options['radius_factor'] * pd.to_numeric(xray_data['pos_r98']),
+                                      options['min_radius'], options['max_radius']).fillna(options['min_radius'])
+        return xray_data
+
+    def match_batch(self, data: pd.DataFrame, xray_data: pd.DataFrame,
+                    xray_index: pd.DataFrame, hp: HEALPix) -> pd.DataFrame:
+        """Return table of matched pairs with `opt_row` (index of data),
+        `xray_pk`, `sep` (arcseconds) and `pa` (position angle, degrees)
+        columns."""
+        data = data[data['ra'].notna() & data['dec'].notna()]
+        opt_pixels = pd.DataFrame({'pixel': healpix_index(hp, data['ra'], data['dec']),
+                                   'opt_row': data.index})
+        pairs = opt_pixels.merge(xray_index, on='pixel')
+        if pairs.empty:
+            return pairs.assign(sep=pd.Series(dtype=float), pa=pd.Series(dtype=float))
+
+        xray_coords = xray_data.loc[pairs['xray_pk'], ['RA', 'DEC', 'radius']].to_numpy()
+        opt_coords = data.loc[pairs['opt_row'], ['ra', 'dec']].to_numpy(dtype=float)
+        coords = (xray_coords[:, 0], xray_coords[:, 1], opt_coords[:, 0], opt_coords[:, 1])
+        pairs['sep'] = angular_separation(*coords)
+        pairs['pa'] = position_angle(*coords)
+        return pairs[pairs['sep'].to_numpy() <= xray_coords[:, 2]]
+
+    def write_batch(self, data: pd.DataFrame, pairs: pd.DataFrame, opt_type: str,
+                    field_list, origin_file, loader: LoadOptic) -> pd.DataFrame:
+        """Create matched optical sources, link them with X-ray sources and
+        resolve counterparts.
+
+        Links are written with separations and position angles of pairs.
+
+        :return: table of new links with `opt_pk` and `xray_pk` columns.
+        """
+        opt_model = LoadOptic.opt_models[opt_type]
+        m2m_field = opt_model._meta.get_field('xray_sources')
+        through = m2m_field.remote_field.through
+        opt_column = m2m_field.m2m_column_name()
+        xray_column = m2m_field.m2m_reverse_name()
+
+        matched = data.loc[pairs['opt_row'].unique()].copy()
+        matched = LoadOptic.add_sky_columns(matched, self.hp)
+        pairs = pairs.assign(opt_hpidx=matched.loc[pairs['opt_row'], 'opt_hpidx'].to_numpy())
+        matched = matched.drop_duplicates('opt_hpidx')
+
+        # optical sources are identified by opt_hpidx, as in load_optic
+        opt_pks = dict(filter_in_chunks(opt_model.objects.values_list('opt_hpidx', 'pk'), 'opt_hpidx',
+                                        matched['opt_hpidx'].tolist()))
+        model_fields = ([field for field in field_list if field in matched.columns]
+                        + ['opt_hpidx', 'c_x', 'c_y', 'c_z'])
+        new_sources = [opt_model(origin_file=origin_file, **dict(zip(model_fields, row)))
+                       for row in matched.loc[~matched['opt_hpidx'].isin(opt_pks), model_fields]
+                       .itertuples(index=False, name=None)]
+        # bulk_create skips save(), automatic attributes of GAIA sources are calculated here
+        if hasattr(opt_model, 'calculate_autoclass_star'):
+            for opt_source in new_sources:
+                opt_source.autoclass_star = opt_source.calculate_autoclass_star()
+        opt_model.objects.bulk_create(new_sources, batch_size=1000)
+        opt_pks.update(filter_in_chunks(opt_model.objects.values_list('opt_hpidx', 'pk'), 'opt_hpidx',
+                                        [opt_source.opt_hpidx for opt_source in new_sources]))
+
+        pairs['opt_pk'] = pairs['opt_hpidx'].map(opt_pks)
+        linked = set(filter_in_chunks(through.objects.values_list(opt_column, xray_column), opt_column,
+                                      pairs['opt_pk'].unique().tolist()))
+        new_links = pairs[[(opt_pk, xray_pk) not in linked
+                           for opt_pk, xray_pk in zip(pairs['opt_pk'], pairs['xray_pk'])]]
+        new_links = new_links.drop_duplicates(['opt_pk', 'xray_pk'])
+        through.objects.bulk_create([through(**{opt_column: opt_pk, xray_column: xray_pk,
+                                                'separation': sep, 'position_angle': pa})
+                                     for opt_pk, xray_pk, sep, pa
+                                     in zip(new_links['opt_pk'].tolist(), new_links['xray_pk'].tolist(),
+                                            new_links['sep'].tolist(), new_links['pa'].tolist())],
+                                    batch_size=1000, ignore_conflicts=True)
+
+        new_links = new_links[['opt_pk', 'xray_pk']]
+        loader.resolve_counterparts(new_links, [self.survey_num], opt_type)
+        mark_pre_class_dirty(new_links['xray_pk'])
+        self.stdout.write(f'Create {len(new_sources)} {opt_type} sources, new links: {len(new_links)}')
+        return new_links
+
+    def handle(self, *args, **options):
+        start_time = timezone.now()
+        self.survey_num = options['survey_num']
+        opt_type = options['opt_type']
+        file_path = options['file_path']
+        if not os.path.exists(file_path):
+            raise CommandError(f'Optical catalogue {file_path} not found')
+        if not Survey.objects.filter(name=self.survey_num).exists():
+            raise CommandError(f'Survey{self.survey_num} not found')
+        if not 0 < options['min_radius'] <= options['max_radius']:
+            raise CommandError('Match radius must satisfy 0 < --min-radius <= --max-radius')
+
+        # healpix map with pixel_resolution < 1/2 arcsec, for opt_hpidx
+        self.hp = HEALPix(nside=2 ** HPIDX_ORDER, order='nested', frame='icrs')
+        search_order = Command.get_search_order(options['max_radius'])
+        search_hp = HEALPix(nside=2 ** search_order, order='nested', frame='icrs')
+
+        if not 0 <= options['chunk_order'] <= HPIDX_ORDER:
+            raise CommandError(f'--chunk-order must be in [0, {HPIDX_ORDER}]')
+        if 'hpidx' not in ds.dataset(file_path, format='parquet', partitioning='hive').schema.names:
+            raise CommandError(f'Optical catalogue {file_path} has no hpidx column')
+        # X-ray sources matching sources of a chunk pixel are in the pixel or its neighbours
+        chunk_order = min(options['chunk_order'], search_order)
+        chunk_hp = HEALPix(nside=2 ** chunk_order, order='nested', frame='icrs')
+        chunk_pixels = self.get_chunk_pixels(chunk_hp, options['batch_size'])
+        self.stdout.write(f'Match sources of survey {self.survey_num} with {opt_type} sources of {file_path} '
+                          f'by {len(chunk_pixels)} chunks of HEALPix order {chunk_order}, '
+                          f'neighbour search order {search_order}')
+
+        # model fields read from the catalogue, opt_hpidx is calculated
+        opt_fields = {opt: fields for opt, suffix, fields in LoadOptic.get_opt_surveys()}
+        concrete_fields = {field.name for field in LoadOptic.opt_models[opt_type]._meta.concrete_fields}
+        field_list = [field for field in opt_fields[opt_type]
+                      if field in concrete_fields and field != 'opt_hpidx']
+        origin_file, f_created = OriginFile.objects.get_or_create(file_name=os.path.basename(file_path))
+        loader = LoadOptic(stdout=self.stdout, stderr=self.stderr)
+
+        rows_num = pairs_num = links_num = 0
+        for chunk_num, pixel in enumerate(chunk_pixels, 1):
+            xray_data = self.get_xray_chunk(pixel, chunk_hp, options)
+            if xray_data.empty:
+                continue
+            xray_index = Command.get_xray_index(xray_data, search_hp)
+            for data in iter_parquet_batches(file_path, field_list, options['batch_size'],
+                                             filter=partial(hp_pixels_filter, [pixel], chunk_order)):
+                rows_num += len(data)
+                pairs = self.match_batch(data, xray_data, xray_index, search_hp)
+                pairs_num += len(pairs)
+                if not pairs.empty:
+                    with transaction.atomic():
+                        links_num += len(self.write_batch(data, pairs, opt_type, field_list, origin_file, loader))
+            self.stdout.write(f'Chunk {chunk_num} of {len(chunk_pixels)}: {len(xray_data)} xray sources, '
+                              f'read {rows_num} {opt_type} sources, pairs: {pairs_num}')
+
+        end_time = timezone.now()
+        self.stdout.write(self.style.SUCCESS(
+            f'Cross-matching took: {(end_time - start_time).total_seconds()} seconds, '
+            f'{pairs_num} pairs, {links_num} new links.'))
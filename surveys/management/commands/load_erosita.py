@@ -1,14 +1,18 @@
 from django.core.management import BaseCommand, CommandError
+from django.db import transaction
 from django.utils import timezone
 import pandas as pd
 import numpy as np
 import pyarrow as pa
 import pyarrow.parquet as pq
 
+from surveys.coords import unit_vectors
 from surveys.models import *
+from surveys.utils import hp_pixels_filter, iter_parquet_batches
 from django.conf import settings
 import shutil
 import os
+from functools import partial
 
 import astropy.units as u
 from astropy.coordinates import SkyCoord
@@ -19,6 +23,13 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('survey_num', type=int, help='number of survey')
+        parser.add_argument('--bulk', action='store_true',
+                            help='insert new sources with bulk_create in chunks')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='number of rows read at once and sources per chunk in --bulk mode')
+        parser.add_argument('--hp-pixels', type=int, nargs='+',
+                            help='load only sources with hpidx inside these nested HEALPix pixels')
+        parser.add_argument('--hp-order', type=int, default=3, help='order of HEALPix pixels of --hp-pixels')
 
     @staticmethod
     def get_fields():
@@ -37,24 +48,68 @@ class Command(BaseCommand):
                     'c_dbb', 'dof_dbb', 'TSTART', 'TSTOP', 'survey', 'file_name']
         return fields
 
-    def handle(self, *args, **options):
-        start_time = timezone.now()
-        # get number of loading survey
-        survey_num = options['survey_num']
-        load_file_name = 'xray_sources_' + str(survey_num) + '.parquet'
-        file_path = os.path.join(settings.WORK_DIR, load_file_name)
+    def bulk_load(self, data, field_list, batch_size):
+        """Create eROSITA sources in chunks with one transaction per chunk.
 
-        # Field list in the order in which the columns should be in the table
-        field_list = Command.get_fields()
+        Survey and OriginFile objects are resolved once per batch and file,
+        sources that already exist for the survey and file are skipped.
 
-        table = pq.read_table(file_path)
-        data = table.to_pandas()
-        # replace all nan with None
-        data = data.replace({np.nan: None})
+        :return: number of created sources.
+        """
+        filled_fields = ['survey', 'file_name']
+        model_fields = [field for field in field_list
+                        if field not in filled_fields and field in data.columns]
+        # bulk_create does not call save(), unit vectors are calculated here
+        data = data.assign(**dict(zip(['c_x', 'c_y', 'c_z'], unit_vectors(data['RA'], data['DEC']))))
+        model_fields += ['c_x', 'c_y', 'c_z']
+        created_num = 0
 
-        self.stdout.write(f'Start reading data')
-        # sources = []
-        print(data)
+        for (file_name, survey_name), file_data in data.groupby(['file_name', 'survey'], sort=False):
+            origin_file, f_created = OriginFile.objects.get_or_create(file_name=file_name)
+            if f_created:
+                self.stdout.write(f'Create new file object for: {file_name}')
+
+            try:
+                survey = Survey.objects.get(name=survey_name)
+            except Survey.DoesNotExist:
+                raise CommandError(f'Survey{survey_name} not found')
+
+            # sources loaded from this file, updated with created sources
+            key = (origin_file.pk, survey.pk)
+            if key not in self.existing_sources:
+                self.existing_sources[key] = set(eROSITA.objects.filter(survey=survey, origin_file=origin_file)
+                                                 .values_list('survey_ind', 'name'))
+            existing = self.existing_sources[key]
+
+            sources = []
+            for row in file_data[model_fields].itertuples(index=False, name=None):
+                values = dict(zip(model_fields, row))
+                if (values['survey_ind'], values['name']) in existing:
+                    continue
+
+                # duplicates in following rows and batches are skipped
+                existing.add((values['survey_ind'], values['name']))
+                sources.append(eROSITA(survey=survey, origin_file=origin_file, **values))
+                if len(sources) >= batch_size:
+                    created_num += self.bulk_create_chunk(sources, batch_size)
+                    sources = []
+
+            if sources:
+                created_num += self.bulk_create_chunk(sources, batch_size)
+
+        return created_num
+
+    def bulk_create_chunk(self, sources, batch_size):
+        with transaction.atomic():
+            eROSITA.objects.bulk_create(sources, batch_size=batch_size)
+        self.stdout.write(f'Created {len(sources)} sources, last: {sources[-1].survey_ind} - {sources[-1].name}')
+        return len(sources)
+
+    def load_batch(self, data, field_list):
+        """Create or fill eROSITA sources one by one."""
+        filled_fields = ['survey_ind', 'name', 'survey', 'file_name', 'RA', 'DEC']
+        model_fields = [field for field in field_list
+                        if field not in filled_fields and field in data.columns]
 
         for row in data.itertuples():
             # find/create meta source - file
@@ -73,19 +128,14 @@ class Command(BaseCommand):
                                                             survey=survey, origin_file=origin_file,
                                                             defaults={'RA': row.RA, 'DEC': row.DEC})
             if created:
-                self.stdout.write(f'{row[0]} - Create new source {row.survey_ind} with name: {row.name}, survey: {row.survey}')
+                self.stdout.write(f'{row.Index} - Create new source {row.survey_ind} with name: {row.name}, survey: {row.survey}')
 
             # Check that it is new source or new file
             if f_created or created:
                 try:
-                    self.stdout.write(f'Start filling fields...\n')
-                    for i, field in enumerate(field_list):
-                        # self.stdout.write(f'Num:{i} - {field} - {row[i+1]}')  # i+1 - skip index
-                        filled_fields = ['survey_ind', 'name', 'survey', 'file_name', 'RA', 'DEC']
-                        if field not in filled_fields:
-                            setattr(source, field, row[i+1])  # Similar to source.field = row[i+1]
-
-                    # sources.append(source)
+                    for field in model_fields:
+                        setattr(source, field, getattr(row, field))
+
                     source.save()
 
                 except Exception as e:
@@ -93,14 +143,38 @@ class Command(BaseCommand):
                     if created: source.delete()
                     raise CommandError(e)
 
-            # maybe use this later
-            # if len(sources) > 500:
-            #     Source.objects.bulk_create(sources)
-            #     sources = []
-            #
+    def handle(self, *args, **options):
+        start_time = timezone.now()
+        # get number of loading survey
+        survey_num = options['survey_num']
+        load_file_name = 'xray_sources_' + str(survey_num) + '.parquet'
+        file_path = os.path.join(settings.WORK_DIR, load_file_name)
 
-        # if sources:
-        #     Source.objects.bulk_create(sources)
+        # Only columns of these fields are read from the file
+        field_list = Command.get_fields()
+
+        self.stdout.write(f'Start reading data')
+        self.existing_sources = {}
+        rows_num = 0
+        created_num = 0
+        # read only partitions and row groups of selected sky region
+        filter = None
+        if options['hp_pixels']:
+            filter = partial(hp_pixels_filter, options['hp_pixels'], options['hp_order'])
+        for data in iter_parquet_batches(file_path, field_list, options['batch_size'], filter=filter):
+            rows_num += len(data)
+            if options['bulk']:
+                created_num += self.bulk_load(data, field_list, options['batch_size'])
+            else:
+                self.load_batch(data, field_list)
+
+        if options['bulk']:
+            end_time = timezone.now()
+            seconds = (end_time - start_time).total_seconds()
+            self.stdout.write(self.style.SUCCESS(
+                f'Loading Parquet took: {seconds} seconds, created {created_num} of {rows_num} sources '
+                f'({rows_num / seconds:.1f} rows/sec).'))
+            return
 
         self.stdout.write(f'End reading table')
         end_time = timezone.now()
@@ -1,4 +1,5 @@
-from django.core.management import BaseCommand, CommandError
+from django.core.management import BaseCommand, CommandError, call_command
+from django.db import transaction
 from django.utils import timezone
 import pandas as pd
 import numpy as np
@@ -6,6 +7,8 @@ import pyarrow as pa
 import pyarrow.parquet as pq
 
 from surveys.models import *
+from surveys.utils import (DisjointSet, diff_row_hashes, filter_in_chunks, get_checkpoint, iter_parquet_batches,
+                           load_row_hashes, read_row_hashes, save_row_hashes)
 from django.conf import settings
 import shutil
 import os
@@ -20,8 +23,23 @@ from django.db.models import Count
 class Command(BaseCommand):
     help = "Load data from Parquet file."
 
-    # def add_arguments(self, parser):
-    #     parser.add_argument("file_path", type=str, help='path for parquet file')
+    # master table ID columns and names of corresponding surveys
+    id_surveys = {'ID_e1': 1, 'ID_e2': 2, 'ID_e3': 3, 'ID_e4': 4, 'ID_e5': 5,
+                  'ID_e1234': 9}
+    # meta object fields edited by users, incremental loading keeps them
+    user_fields = ['comment', 'object_class', 'unchange_flag']
+
+    def add_arguments(self, parser):
+        # parser.add_argument("file_path", type=str, help='path for parquet file')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='number of rows read from the file at once')
+        parser.add_argument('--resume', action='store_true',
+                            help='continue loading the file from its checkpoint')
+        parser.add_argument('--incremental', action='store_true',
+                            help='apply only rows inserted, changed or deleted since the previous '
+                                 'incremental loading of the file')
+        parser.add_argument('--skip-images', action='store_true',
+                            help='do not stage images, run stage_images command later')
 
     @staticmethod
     def get_fields():  # add img_id to identify images in load_data
@@ -40,88 +58,44 @@ class Command(BaseCommand):
         return fields
 
     @staticmethod
-    def rename_copy_images(img_id, meta_ind):
-        # Rename and Copy images to dir: static/images
-        # img_id, master_name - attributes of master table
-
-        images_path = settings.MASTER_DIR
-        for i in range(1, 10):
-            # Copy Light Curve
-            old_path = os.path.join(images_path, 'eRASS'+str(i), 'src_' + str(img_id) + '_lc' + '.pdf')
-            if os.path.isfile(old_path):
-                new_file_name = 'lc_' + str(meta_ind) + '.pdf'
-                new_path = os.path.join(settings.IMAGE_DATA_PATH, 'e' + str(i), new_file_name)
-                shutil.copy(old_path, new_path)
-
-            # Copy Spectrum
-            old_path = os.path.join(images_path, 'eRASS'+str(i), 'src_' + str(img_id) + '_spec' + '.pdf')
-            if os.path.isfile(old_path):
-                new_file_name = 'spec_' + str(meta_ind) + '.pdf'
-                new_path = os.path.join(settings.IMAGE_DATA_PATH, 'e' + str(i), new_file_name)
-                shutil.copy(old_path, new_path)
-
-            # Copy Trans Image
-            old_path = os.path.join(images_path, 'eRASS'+str(i), 'src_' + str(img_id) + '_e' + str(i) + '.png')
-            if os.path.isfile(old_path):
-                new_file_name = 'trans_' + str(meta_ind) + '.png'
-                new_path = os.path.join(settings.IMAGE_DATA_PATH, 'e' + str(i), new_file_name)
-                shutil.copy(old_path, new_path)
+    def get_source_index():
+        """Return dict {(survey name, survey_ind): eROSITA pk} built with
+        a single query."""
+        return {
+            (survey_name, survey_ind): pk
+            for pk, survey_name, survey_ind in
+            eROSITA.objects.values_list('pk', 'survey__name', 'survey_ind')
+        }
+
+    def link_sources_with_meta(self, meta_objects, source_index):
+        """Set many-to-many relationships between meta objects and eROSITA
+        sources in bulk.
+
+        eROSITA sources are found by (survey name, survey_ind) keys in
+        `source_index`, all links are inserted with one bulk_create.
+
+        :param meta_objects: list of (meta object pk, master table row).
+        :param source_index: dict from `get_source_index`.
+        """
+        through = eROSITA.meta_objects.through
+
+        links = []
+        for meta_pk, row in meta_objects:
+            for id_field, survey_name in Command.id_surveys.items():
+                survey_ind = getattr(row, id_field)
+                if not survey_ind or survey_ind <= 0:
+                    continue
+                try:
+                    source_pk = source_index[(survey_name, survey_ind)]
+                except KeyError:
+                    raise CommandError(f'Source with survey_ind: {survey_ind} '
+                                       f'from survey {survey_name} not found')
+                links.append(through(erosita_id=source_pk,
+                                     metaobject_id=meta_pk))
 
-    @staticmethod
-    def link_source_with_meta(meta_object, row_values):
-        if row_values.ID_e1 and row_values.ID_e1 > 0:
-            try:
-                source = eROSITA.objects.get(survey_ind=row_values.ID_e1, survey=Survey.objects.get(name=1))
-                source.meta_objects.add(meta_object)
-                print(f'Link meta object: {meta_object} with source: {source.survey_ind} - {source}')
-                source.save()
-            except eROSITA.DoesNotExist:
-                raise CommandError(f'Source with survey_ind: {row_values.ID_e1} from survey 1 not found')
-
-        if row_values.ID_e2 and row_values.ID_e2 > 0:
-            try:
-                source = eROSITA.objects.get(survey_ind=row_values.ID_e2, survey=Survey.objects.get(name=2))
-                source.meta_objects.add(meta_object)
-                print(f'Link meta object: {meta_object} with source: {source.survey_ind} - {source}')
-                source.save()
-            except eROSITA.DoesNotExist:
-                raise CommandError(f'Source with survey_ind: {row_values.ID_e2} from survey 2 not found')
-
-        if row_values.ID_e3 and row_values.ID_e3 > 0:
-            try:
-                source = eROSITA.objects.get(survey_ind=row_values.ID_e3, survey=Survey.objects.get(name=3))
-                source.meta_objects.add(meta_object)
-                print(f'Link meta object: {meta_object} with source: {source.survey_ind} - {source}')
-                source.save()
-            except eROSITA.DoesNotExist:
-                raise CommandError(f'Source with survey_ind: {row_values.ID_e3} from survey 3 not found')
-
-        if row_values.ID_e4 and row_values.ID_e4 > 0:
-            try:
-                source = eROSITA.objects.get(survey_ind=row_values.ID_e4, survey=Survey.objects.get(name=4))
-                source.meta_objects.add(meta_object)
-                print(f'Link meta object: {meta_object} with source: {source.survey_ind} - {source}')
-                source.save()
-            except eROSITA.DoesNotExist:
-                raise CommandError(f'Source with survey_ind: {row_values.ID_e4} from survey 4 not found')
-
-        if row_values.ID_e5 and row_values.ID_e5 > 0:
-            try:
-                source = eROSITA.objects.get(survey_ind=row_values.ID_e5, survey=Survey.objects.get(name=5))
-                source.meta_objects.add(meta_object)
-                print(f'Link meta object: {meta_object} with source: {source.survey_ind} - {source}')
-                source.save()
-            except eROSITA.DoesNotExist:
-                raise CommandError(f'Source with survey_ind: {row_values.ID_e5} from survey 5 not found')
-
-        if row_values.ID_e1234 and row_values.ID_e1234 > 0:
-            try:
-                source = eROSITA.objects.get(survey_ind=row_values.ID_e1234, survey=Survey.objects.get(name=9))
-                source.meta_objects.add(meta_object)
-                print(f'Link meta object: {meta_object} with source: {source.survey_ind} - {source}')
-                source.save()
-            except eROSITA.DoesNotExist:
-                raise CommandError(f'Source with survey_ind: {row_values.ID_e1234} from survey 9 not found')
+        through.objects.bulk_create(links, ignore_conflicts=True)
+        self.stdout.write(f'Link {len(meta_objects)} meta objects with '
+                          f'sources, links: {len(links)}')
 
     @staticmethod
     def find_master_source(meta_object):
@@ -141,200 +115,280 @@ class Command(BaseCommand):
             # add galactic coordinates
             meta_object.GLON = master_source.GLON
             meta_object.GLAT = master_source.GLAT
-            meta_object.save()
-
-    @staticmethod
-    def create_m_group_with_prime_obj(prime_obj):
-        meta_group = MetaGroup.objects.create(meta_ind=prime_obj.meta_ind,
-                                              master_name=prime_obj.master_name,
-                                              master_survey=prime_obj.master_survey,
-                                              max_sources_num=prime_obj.object_sources.count())
-        print(f'Create new meta group {meta_group}\n')
-        prime_obj.meta_group = meta_group
-        prime_obj.save()
-        return meta_group
-
-    @staticmethod
-    def change_prime_object(meta_group, new_prime_obj):
-        # change flag of old primary object
-        old_primary_obj = meta_group.meta_objects.get(primary_object=True)
-        old_primary_obj.primary_object = False
-        old_primary_obj.save()
-        # handle new primary object
-        meta_group.meta_ind = new_prime_obj.meta_ind
-        meta_group.master_name = new_prime_obj.master_name
-        meta_group.master_survey = new_prime_obj.master_survey
-        meta_group.max_sources_num = new_prime_obj.object_sources.count()
-        meta_group.save()
-        # change meta object flag
-        new_prime_obj.primary_object = True
-        return meta_group
-
-    @staticmethod
-    def union_meta_groups(meta_object, meta_groups):
-        # get meta group with max sources number
-        print(f'Choose primary object and join meta_groups: {meta_groups}')
-        max_meta_group = meta_groups.order_by('-max_sources_num')[0]
-        other_meta_groups = meta_groups.exclude(pk=max_meta_group.pk)
-        print(f'Found max source num meta group: {max_meta_group}')
-        print(
-            f'Meta_object source_num: {meta_object.object_sources.count()}, meta_group: {max_meta_group.max_sources_num}')
-        if max_meta_group.max_sources_num < meta_object.object_sources.count():
-            # make meta object - primary object for max meta group
-            Command.change_prime_object(max_meta_group, meta_object)
-        else:
-            meta_object.primary_object = False
-
-        # join meta group
-        meta_object.meta_group = max_meta_group
-        meta_object.save()
-        # change meta group and flag of meta objects from other meta groups
-        for meta_group in other_meta_groups.distinct():
-            other_meta_objects = meta_group.meta_objects.all()
-            other_meta_objects.update(meta_group=max_meta_group, primary_object=False)
-
-        # delete other meta groups
-        print(f'Delete meta groups: {other_meta_groups}\n')
-        other_meta_groups.delete()
-
-    @staticmethod
-    def find_or_create_meta_group(meta_object):
-        print(f'Find or create meta group for MetaObj: {meta_object}')
-        # dict with id: number of related source
-        sources_num = {meta_object.pk: meta_object.object_sources.count()}
-        sources = meta_object.object_sources.all()
-        # create empty queryset
-        dup_objects = MetaObject.objects.none()
-        for source in sources:
-            # union all linked meta_objects
-            dup_objects = dup_objects | source.meta_objects.all()
-
-        # get distinct queryset of dup meta objects without current object
-        dup_objects = dup_objects.distinct()
-        dup_objects_ = dup_objects.exclude(pk=meta_object.pk)
-        print(f'\n Get all meta objects with common sources: {dup_objects}')
-
-        # queryset is empty -> no meta objects with common sources
-        if not dup_objects_:
-            Command.create_m_group_with_prime_obj(meta_object)
+            meta_object.save(update_fields=['master_name', 'master_survey', 'RA', 'DEC', 'EXT', 'R98', 'LIKE',
+                                            'GLON', 'GLAT'])
+
+    def build_meta_groups(self):
+        """Create meta groups for all meta objects without a group.
+
+        Meta objects with common eROSITA sources (and objects of the same
+        meta group) form connected components, which are found with
+        a disjoint-set over the (meta object, source) edge list. Primary
+        object of a component is the object with max number of sources
+        (current primary object or object with the lowest pk on ties).
+        Components with ungrouped objects get new or updated groups, groups
+        left without objects are deleted.
+        """
+        objects = pd.DataFrame.from_records(
+            MetaObject.objects.values_list('pk', 'meta_group', 'primary_object', 'meta_ind', 'master_name',
+                                           'master_survey'),
+            columns=['pk', 'meta_group', 'primary_object', 'meta_ind', 'master_name', 'master_survey'])
+        if objects.empty:
             return
-
-        # find all meta groups for dup_objects
-        meta_groups = MetaGroup.objects.none()
-        list_of_ids = []
-        for dup_obj in dup_objects_:
-            # get id: number of related sources for all dup meta objects
-            sources_num[dup_obj.pk] = dup_obj.object_sources.count()
-            # union all linked meta_groups
-            if dup_obj.meta_group: list_of_ids.append(dup_obj.meta_group.pk)
-
-        meta_groups = MetaGroup.objects.filter(pk__in=list_of_ids) if list_of_ids else MetaGroup.objects.none()
-        meta_groups_dist = meta_groups.distinct() if meta_groups else meta_groups
-        print(f'Get all meta groups for dup_objects: {meta_groups_dist}\n')
-
-        # queryset is empty -> no meta groups for meta_objects with common sources
-        # create meta group for these meta objects
-        if not meta_groups.exists():
-            # get meta_ind and sources number of primary meta object
-            prime_pk = max(sources_num, key=sources_num.get)
-            prime_object = dup_objects.get(pk=prime_pk)
-            print(f'Found prime object {prime_object} with max sources number: {sources_num[prime_pk]}')
-            meta_group = Command.create_m_group_with_prime_obj(prime_object)
-            dup_objects.exclude(pk=prime_object.pk).update(meta_group=meta_group, primary_object=False)
+        edges = pd.DataFrame.from_records(
+            eROSITA.meta_objects.through.objects.values_list('metaobject_id', 'erosita_id'),
+            columns=['meta_pk', 'source_pk'])
+        objects['sources_num'] = objects['pk'].map(edges.groupby('meta_pk').size()).fillna(0).astype(int)
+
+        components = DisjointSet()
+        for pk in objects['pk']:
+            components.find(pk)
+        # join meta objects with common sources and meta objects of one meta group
+        for pairs in (edges.rename(columns={'meta_pk': 'pk', 'source_pk': 'key'}),
+                      objects.loc[objects['meta_group'].notna(), ['pk', 'meta_group']].rename(
+                          columns={'meta_group': 'key'})):
+            pairs = pairs.sort_values('key')
+            pks, keys = pairs['pk'].to_numpy(), pairs['key'].to_numpy()
+            same_key = keys[1:] == keys[:-1]
+            for pk_1, pk_2 in zip(pks[:-1][same_key], pks[1:][same_key]):
+                components.union(pk_1, pk_2)
+        objects['component'] = [components.find(pk) for pk in objects['pk']]
+
+        # only components with ungrouped objects or several meta groups are rebuilt
+        group_stats = objects.groupby('component')['meta_group'].agg(['nunique', 'count', 'size'])
+        changed = group_stats.index[(group_stats['count'] < group_stats['size']) | (group_stats['nunique'] > 1)]
+        objects = objects[objects['component'].isin(changed)]
+        if objects.empty:
             return
 
-        # there is one meta group -> join it and check primary object
-        if len(meta_groups_dist) == 1:
-            meta_group = meta_groups_dist[0]
-            print(f'Found meta group: {meta_group} for {meta_object}')
-            print(f'Meta_object source_num: {meta_object.object_sources.count()}, meta_group: {meta_group.max_sources_num}\n')
-            if meta_group.max_sources_num < meta_object.object_sources.count():
-                # make meta object - primary object for meta group
-                Command.change_prime_object(meta_group, meta_object)
+        objects['is_primary'] = objects['primary_object'].fillna(False).astype(bool) & objects['meta_group'].notna()
+        primary = objects.sort_values(['component', 'sources_num', 'is_primary', 'pk'],
+                                      ascending=[True, False, False, True]).drop_duplicates('component')
+
+        new_groups, old_groups = {}, {}
+        for row in primary.itertuples():
+            # meta objects without sources have no master source
+            meta_group = MetaGroup(meta_ind=row.meta_ind,
+                                   master_name=None if pd.isna(row.master_name) else row.master_name,
+                                   master_survey=None if pd.isna(row.master_survey) else int(row.master_survey),
+                                   max_sources_num=row.sources_num)
+            if pd.notna(row.meta_group):
+                # keep meta group of primary object
+                meta_group.pk = int(row.meta_group)
+                old_groups[row.component] = meta_group
             else:
-                meta_object.primary_object = False
+                new_groups[row.component] = meta_group
+
+        with transaction.atomic():
+            MetaGroup.objects.bulk_create(new_groups.values())
+            MetaGroup.objects.bulk_update(old_groups.values(),
+                                          ['meta_ind', 'master_name', 'master_survey', 'max_sources_num'])
+            groups = {**new_groups, **old_groups}
+            primary_pks = set(primary['pk'])
+            MetaObject.objects.bulk_update(
+                [MetaObject(pk=pk, meta_group=groups[component], primary_object=pk in primary_pks)
+                 for pk, component in zip(objects['pk'], objects['component'])],
+                ['meta_group', 'primary_object'], batch_size=1000)
+            # delete meta groups of joined components after their objects are moved
+            unused_groups = set(objects['meta_group'].dropna().astype(int)) - {g.pk for g in old_groups.values()}
+            MetaGroup.objects.filter(pk__in=unused_groups).delete()
+
+        self.stdout.write(f'Create {len(new_groups)} meta groups, update {len(old_groups)} meta groups, '
+                          f'delete {len(unused_groups)} meta groups')
+
+    def load_batch(self, data, field_list, source_index, checkpoint=None):
+        """Create meta objects of the batch, link them with sources and find
+        their master sources.
+
+        The batch and its checkpoint (if any) are committed in one
+        transaction.
+        """
+        filled_fields = ['meta_ind', 'RA', 'DEC', 'ID_e1', 'ID_e2', 'ID_e3', 'ID_e4', 'ID_e5', 'ID_e1234']
+        model_fields = [field for field in field_list if field not in filled_fields and field in data.columns]
+        meta_objects = []
+        created_objects = []
+        with transaction.atomic():
+            for row in data.itertuples():
+                # TODO: think about 5th survey load
+                # find/create meta object
+                meta_object, created = MetaObject.objects.get_or_create(meta_ind=row.img_id, ID_e1=row.ID_e1, ID_e2=row.ID_e2,
+                                                                        ID_e3=row.ID_e3, ID_e4=row.ID_e4, ID_e1234=row.ID_e1234,
+                                                                        defaults={'ID_e5': row.ID_e5, 'RA': row.RA, 'DEC': row.DEC})
+
+                # Check that it is new meta object
+                if created:
+                    print(f'{row.Index} - Create new meta object with img_id: {row.img_id}, RA: {row.RA}, DEC: {row.DEC}')
+                    try:
+                        for field in model_fields:
+                            setattr(meta_object, field, getattr(row, field))
+
+                        meta_object.save()
+                    except Exception as e:
+                        # transaction is rolled back, no meta objects of the batch are created
+                        raise CommandError(e)
+                    created_objects.append((meta_object, row))
+                else:
+                    # MetaObject exists already
+                    print(f'{row.Index} - Meta object with img_id: {row.img_id}, RA: {row.RA}, DEC: {row.DEC} exists.')
+                meta_objects.append((meta_object, row))
+
+            # link sources with created meta objects
+            self.link_sources_with_meta([(meta_object.pk, row) for meta_object, row in created_objects], source_index)
+
+            for meta_object, row in created_objects:
+                # find master_source and take name, survey, RA, DEC, EXT, R98, LIKE from it
+                Command.find_master_source(meta_object)
+
+            if checkpoint:
+                checkpoint.advance(len(data))
 
-            # join meta group
-            meta_object.meta_group = meta_group
-            meta_object.save()
-            return
-        # there is several meta groups - > choose new primary source and union meta groups
-        else:
-            Command.union_meta_groups(meta_object, meta_groups)
+    @staticmethod
+    def ungroup_meta_objects(meta_pks):
+        """Delete meta groups of meta objects, all objects of these groups are
+        left without group to be grouped again by build_meta_groups."""
+        group_pks = {meta_object.meta_group_id
+                     for meta_object in filter_in_chunks(MetaObject.objects.only('meta_group'), 'pk', meta_pks)
+                     if meta_object.meta_group_id}
+        group_pks = list(group_pks)
+        for i in range(0, len(group_pks), 500):
+            chunk = group_pks[i:i + 500]
+            # objects are moved out of groups before deleting groups (cascade)
+            MetaObject.objects.filter(meta_group__in=chunk).update(meta_group=None, primary_object=True)
+            MetaGroup.objects.filter(pk__in=chunk).delete()
+
+    def update_batch(self, data, field_list, source_index):
+        """Update meta objects with changed rows of master table.
+
+        Fields edited by users are kept. Meta objects with changed source IDs
+        are linked with sources again and removed from their meta groups.
+        """
+        filled_fields = ['meta_ind'] + Command.user_fields
+        model_fields = [field for field in field_list if field not in filled_fields and field in data.columns]
+        meta_objects = {meta_object.meta_ind: meta_object
+                        for meta_object in filter_in_chunks(MetaObject.objects.all(), 'meta_ind', data['img_id'])}
+
+        relinked = []
+        with transaction.atomic():
+            for row in data.itertuples():
+                meta_object = meta_objects.get(row.img_id)
+                if meta_object is None:
+                    raise CommandError(f'{row.Index} - Meta object with img_id: {row.img_id} not found')
+
+                ids_changed = any(getattr(meta_object, field) != getattr(row, field)
+                                  for field in Command.id_surveys)
+                for field in model_fields:
+                    setattr(meta_object, field, getattr(row, field))
+                meta_object.update_sky_columns()
+                # master source and its pre-class flags can change
+                meta_object.pre_class_dirty = True
+                if ids_changed:
+                    relinked.append((meta_object, row))
+
+            MetaObject.objects.bulk_update(meta_objects.values(),
+                                           model_fields + MetaObject.sky_fields + ['pre_class_dirty'],
+                                           batch_size=1000)
+
+            if relinked:
+                relinked_pks = [meta_object.pk for meta_object, row in relinked]
+                Command.ungroup_meta_objects(relinked_pks)
+                for i in range(0, len(relinked_pks), 500):
+                    eROSITA.meta_objects.through.objects.filter(metaobject__in=relinked_pks[i:i + 500]).delete()
+                self.link_sources_with_meta([(meta_object.pk, row) for meta_object, row in relinked], source_index)
+
+            for meta_object in meta_objects.values():
+                # master source fields are overwritten with file values
+                Command.find_master_source(meta_object)
+
+        self.stdout.write(f'Update {len(meta_objects)} meta objects, relink {len(relinked)} meta objects')
+
+    def delete_meta_objects(self, meta_inds):
+        """Delete meta objects of rows deleted from master table."""
+        meta_pks = [meta_object.pk
+                    for meta_object in filter_in_chunks(MetaObject.objects.only('pk'), 'meta_ind', meta_inds)]
+        with transaction.atomic():
+            Command.ungroup_meta_objects(meta_pks)
+            for i in range(0, len(meta_pks), 500):
+                MetaObject.objects.filter(pk__in=meta_pks[i:i + 500]).delete()
+        self.stdout.write(f'Delete {len(meta_pks)} meta objects')
+
+    def load_incremental(self, file_path, columns, field_list, source_index, batch_size):
+        """Apply only rows inserted, changed or deleted since the previous
+        version of the file.
+
+        Row hashes of mapped columns are stored for each version of the file
+        (OriginFile.version), the new version is compared with the previous
+        one by keys (img_id). Without stored hashes all rows are loaded as
+        new ones, existing meta objects are not changed.
+        """
+        checkpoint = get_checkpoint(file_path, 'master', batch_size=batch_size)
+        origin_file = checkpoint.origin_file
+        hashes = read_row_hashes(file_path, ['img_id'], columns, batch_size)
+        inserted, updated, deleted = diff_row_hashes(load_row_hashes(origin_file), hashes, ['img_id'])
+        self.stdout.write(f'Version {origin_file.version} of {file_path}, rows to insert: {len(inserted)}, '
+                          f'to update: {len(updated)}, to delete: {len(deleted)}')
+
+        try:
+            if len(inserted) or len(updated):
+                for data in iter_parquet_batches(file_path, columns, batch_size):
+                    new_data = data[data.index.isin(inserted)]
+                    if not new_data.empty:
+                        self.load_batch(new_data, field_list, source_index)
+                    changed_data = data[data.index.isin(updated)]
+                    if not changed_data.empty:
+                        self.update_batch(changed_data, field_list, source_index)
+            if len(deleted):
+                self.delete_meta_objects(deleted['img_id'].tolist())
+        except Exception:
+            checkpoint.set_status(IngestCheckpoint.FAILED)
+            raise
+
+        save_row_hashes(origin_file, hashes)
+        checkpoint.set_status(IngestCheckpoint.DONE)
+
+    def load_file(self, file_path, columns, field_list, source_index, batch_size, resume=False):
+        """Load all rows of the file by batches, skip committed batches if
+        `resume` is set."""
+        checkpoint = get_checkpoint(file_path, 'master', resume, batch_size)
+        if checkpoint.status == IngestCheckpoint.DONE:
+            self.stdout.write(f'Skip loaded file {file_path}')
             return
 
+        if checkpoint.rows_loaded:
+            self.stdout.write(f'Resume loading {file_path} from row {checkpoint.rows_loaded}')
+        try:
+            for data in iter_parquet_batches(file_path, columns, batch_size, checkpoint.rows_loaded):
+                self.load_batch(data, field_list, source_index, checkpoint)
+        except Exception:
+            checkpoint.set_status(IngestCheckpoint.FAILED)
+            raise
+        checkpoint.set_status(IngestCheckpoint.DONE)
+
     def handle(self, *args, **options):
         start_time = timezone.now()
         # file_path = options["file_path"]
         file_path = os.path.join(settings.WORK_DIR, 'master_sources.parquet')
 
-        # Field list in the order in which the columns should be in the table
+        # Only columns of these fields are read from the file
         field_list = Command.get_fields()
 
-        table = pq.read_table(file_path)
-        data = table.to_pandas()
-        # replace all nan with None
-        data = data.replace({np.nan: None})
-
-        # Make Survey dirs for image data
-        for i in range(1, 10):
-            # check path
-            print(os.path.join(settings.IMAGE_DATA_PATH, 'e' + str(i)))
-            if not os.path.exists(os.path.join(settings.IMAGE_DATA_PATH, 'e' + str(i))):
-                os.makedirs(os.path.join(settings.IMAGE_DATA_PATH, 'e' + str(i)))
-
         self.stdout.write(f'Start reading data')
-        # sources = []
-        print(data)
-
-        for row in data.itertuples():
-            # TODO: think about 5th survey load
-            # find/create meta object
-            meta_object, created = MetaObject.objects.get_or_create(meta_ind=row.img_id, ID_e1=row.ID_e1, ID_e2=row.ID_e2,
-                                                                    ID_e3=row.ID_e3, ID_e4=row.ID_e4, ID_e1234=row.ID_e1234,
-                                                                    defaults={'ID_e5': row.ID_e5, 'RA': row.RA, 'DEC': row.DEC})
-
-            # Check that it is new meta object
-            if created:
-                print(f'{row[0]} - Create new meta object with img_id: {row.img_id}, RA: {row.RA}, DEC: {row.DEC}')
-                try:
-                    self.stdout.write(f'Start filling fields...\n')
-                    for i, field in enumerate(field_list):
-                        # self.stdout.write(f'Num:{i} - {field} - {row[i+1]}')  # i+1 - skip index
-                        filled_fields = ['img_id', 'RA', 'DEC', 'ID_e1', 'ID_e2', 'ID_e3', 'ID_e4', 'ID_e5', 'ID_e1234']
-                        if field not in filled_fields:
-                            setattr(meta_object, field, row[i+1])  # Similar to source.field = row[i+1]
-
-                    # sources.append(source)
-                    meta_object.save()
-                    # link sources with created meta object
-                    Command.link_source_with_meta(meta_object, row)
-                    # find master_source and take name, survey, RA, DEC, EXT, R98, LIKE from it
-                    Command.find_master_source(meta_object)
-                    # find or create meta group for created meta object
-                    if not meta_object.meta_group:
-                        Command.find_or_create_meta_group(meta_object)
-
-                except Exception as e:
-                    # Delete created source if there was ERROR while filling fields
-                    if created: meta_object.delete()
-                    raise CommandError(e)
-                    # print(f'ERROR:{e}\n')
-            else:
-                # MetaObject exists already
-                print(f'{row[0]} - Meta object with img_id: {row.img_id}, RA: {row.RA}, DEC: {row.DEC} exists.')
-
-            # rename and copy images TODO: image names
-            Command.rename_copy_images(row.img_id, meta_object.meta_ind)
+        source_index = Command.get_source_index()
+        # img_id column is loaded into meta_ind field
+        columns = ['img_id'] + field_list
+
+        if options['incremental']:
+            if options['resume']:
+                raise CommandError('Options --incremental and --resume can not be used together')
+            self.load_incremental(file_path, columns, field_list, source_index, options['batch_size'])
+        else:
+            self.load_file(file_path, columns, field_list, source_index, options['batch_size'], options['resume'])
 
-            # maybe use this later
-            # if len(sources) > 500:
-            #     Source.objects.bulk_create(sources)
-            #     sources = []
-            #
+        # find or create meta groups for created meta objects
+        self.build_meta_groups()
 
-        # if sources:
-        #     Source.objects.bulk_create(sources)
+        # rename and copy images of meta objects, unchanged files are skipped
+        if not options['skip_images']:
+            call_command('stage_images', stdout=self.stdout._out, stderr=self.stderr._out)
 
         self.stdout.write(f'End reading table')
         end_time = timezone.now()
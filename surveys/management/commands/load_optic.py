@@ -1,20 +1,64 @@
-from collections import namedtuple
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+import multiprocessing
 import os
-from pathlib import Path
-from typing import Iterable, Union, List
+from queue import Empty
+from typing import Dict, Iterable, Iterator, Union, List
 
 import astropy.units as u
 from astropy.coordinates import SkyCoord
 from astropy_healpix import HEALPix
 import pandas as pd
-import numpy as np
-import pyarrow.parquet as pq
+import django
 from django.conf import settings
 from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
 from django.utils import timezone
 
-from surveys.models import LS, PS, SDSS, GAIA, eROSITA, OriginFile
-from surveys.utils import help_from_docstring
+from surveys.coords import (angular_separation, healpix_index,
+                            position_angle, unit_vectors)
+from surveys.models import (LS, PS, SDSS, GAIA, eROSITA, IngestCheckpoint,
+                            OriginFile)
+from surveys.utils import (calculate_link_separations, diff_row_hashes,
+                           filter_in_chunks, get_checkpoint,
+                           help_from_docstring, hp_pixels_filter,
+                           iter_parquet_batches, load_row_hashes,
+                           mark_pre_class_dirty, read_row_hashes,
+                           save_row_hashes)
+
+
+def prepare_opt_batches(file_path: str, field_list: List[str],
+                        batch_size: int,
+                        start: int = 0,
+                        filter=None) -> Iterator[pd.DataFrame]:
+    """Read optical sources by batches from `start` row and calculate their
+    HEALPix indices and cartesian coordinates. Does not use database.
+
+    :param filter: dataset filter passed to `iter_parquet_batches`.
+    """
+    # healpix map with pixel_resolution < 1/2 arcsec
+    hp = HEALPix(nside=2 ** 19, order='nested', frame='icrs')
+    # xray source fields and model fields
+    columns = ['srcname_fin', 'hpidx'] + field_list
+    for data in iter_parquet_batches(file_path, columns, batch_size, start,
+                                     filter):
+        yield Command.add_sky_columns(data, hp)
+
+
+def read_opt_file(queue, file_path: str, field_list: List[str],
+                  batch_size: int, start: int = 0, filter=None):
+    """Prepare batches of optical file and put them to the queue one by one,
+    run in worker processes. The queue is bounded, so the worker waits for
+    the writer. None is put after the last batch, also on errors."""
+    try:
+        for data in prepare_opt_batches(file_path, field_list, batch_size,
+                                        start, filter):
+            queue.put(data)
+    finally:
+        queue.put(None)
 
 
 @help_from_docstring
@@ -28,8 +72,30 @@ class Command(BaseCommand):
     relationships to eROSITA sources.
     """
 
-    # def add_arguments(self, parser):
-    #     parser.add_argument('survey_num', type=int, help='number of survey')
+    opt_models = {'LS': LS, 'SDSS': SDSS, 'PS': PS, 'GAIA': GAIA}
+    # eROSITA fields with optical counterpart from each survey
+    dup_fields = {'LS': 'ls_dup', 'SDSS': 'sdss_dup', 'PS': 'ps_dup',
+                  'GAIA': 'gaia_dup'}
+
+    def add_arguments(self, parser):
+        # parser.add_argument('survey_num', type=int, help='number of survey')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='number of rows read from a file at once')
+        parser.add_argument('--resume', action='store_true',
+                            help='continue loading files from their '
+                                 'checkpoints, skip loaded files')
+        parser.add_argument('--incremental', action='store_true',
+                            help='apply only rows inserted, changed or '
+                                 'deleted since the previous incremental '
+                                 'loading of files')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='number of processes reading and preparing '
+                                 'files, database is written by one process')
+        parser.add_argument('--hp-pixels', type=int, nargs='+',
+                            help='load only sources with hpidx inside these '
+                                 'nested HEALPix pixels')
+        parser.add_argument('--hp-order', type=int, default=3,
+                            help='order of HEALPix pixels of --hp-pixels')
 
     @staticmethod
     def get_ls_fields():
@@ -127,70 +193,30 @@ class Command(BaseCommand):
         return fields
 
     @staticmethod
-    def find_dup_source(xray_sources: Iterable[eROSITA],
-                        opt_source: Union[LS, PS, SDSS, GAIA],
-                        c_opt: SkyCoord, opt_type: str):
-        """Find X-ray sources near given optical source and set many-to-many
-        relationship.
-
-        It is done in technically inverse way (not optical counterpart for
-        X-ray source, but X-ray counterpart for optical source), because
-        many-to-many relationship is defined in optical sources models.
-
-        :param xray_sources: QuerySet of eROSITA objects.
-        :param opt_source: Optical source.
-        :param c_opt: coordinates of an optical source.
-        :param opt_type: optical survey of optical source.
-
-        TODO Refactor with single cycle via itertools.product ?
-        TODO c_opt is redundant
-        TODO change opt_type to isinstance checks.
-        TODO refactor elif with series of if-break-s
-        """
-        # for comparing float values
-        TOLERANCE = 10 ** -6
-        # c_opt = SkyCoord(
-        # ra=opt_source.ra * u.deg, dec=opt_source.dec * u.deg, frame='icrs')
-        for xray_source in xray_sources:
-            c_xray = SkyCoord(ra=xray_source.RA * u.deg, dec=xray_source.DEC * u.deg, distance=1 * u.pc, frame='icrs')
-            sep = c_xray.separation(c_opt).arcsecond
-            # find/create new opt LS counterpart + get new separation
-            if opt_type == 'LS' and (
-                    not xray_source.ls_dup or xray_source.ls_dup_sep > sep):
-                # print(f'Old Sep: {xray_source.ls_dup_sep} New Sep: {sep}')
-                xray_source.ls_dup = opt_source
-                xray_source.ls_dup_sep = sep
-            # find/create new opt SDSS counterpart
-            elif opt_type == 'SDSS' and (
-                    not xray_source.sdss_dup
-                    or xray_source.sdss_dup_sep > sep):
-                # print(f'Old Sep: {xray_source.sdss_dup_sep} New Sep: {sep}')
-                xray_source.sdss_dup = opt_source
-                xray_source.sdss_dup_sep = sep
-            # find/create new opt PS counterpart
-            elif opt_type == 'PS' and (
-                    not xray_source.ps_dup or xray_source.ps_dup_sep > sep):
-                # print(f'Old Sep: {xray_source.ps_dup_sep} New Sep: {sep}')
-                xray_source.ps_dup = opt_source
-                xray_source.ps_dup_sep = sep
-            # find/create new opt PS counterpart
-            elif opt_type == 'GAIA' and (
-                    not xray_source.gaia_dup
-                    or xray_source.gaia_dup_sep > sep):
-                # print(f'Old Sep: {xray_source.gaia_dup_sep} New Sep: {sep}')
-                xray_source.gaia_dup = opt_source
-                xray_source.gaia_dup_sep = sep
-            # TODO add VLASS and ALLWISE and exception for wrong opt type
+    def add_sky_columns(data: pd.DataFrame, hp: HEALPix) -> pd.DataFrame:
+        """Calculate HEALPix indices and cartesian coordinates (radius = 1pc)
+        for the whole table at once.
 
-            xray_source.save()
+        Overwrites `opt_hpidx` column and adds `c_x`, `c_y`, `c_z` columns.
+        """
+        data['opt_hpidx'] = healpix_index(hp, data['ra'], data['dec'])
+        data['c_x'], data['c_y'], data['c_z'] = unit_vectors(
+            data['ra'], data['dec'])
+        return data
 
     def load_opt_survey(self,
                         data: pd.DataFrame,
                         field_list: List[str],
-                        hp: HEALPix,
                         opt_type: str = 'LS'):
         # TODO change opt_type type from str to Type[models.Model]
+        # data is prepared by prepare_opt_batches
         self.stdout.write(f'Start loading {opt_type} optical data')
+        filled_fields = ['objID', 'opt_hpidx', 'survey', 'file_name', 'ra',
+                         'dec']
+        model_fields = [field for field in field_list
+                        if field not in filled_fields and field in data.columns]
+        # optical source pk for each row
+        opt_pks = {}
 
         for row in data.itertuples():
             row: namedtuple
@@ -202,11 +228,8 @@ class Command(BaseCommand):
                 self.stdout.write(
                     f'Create new file object for: {row.file_name}')
 
-            # get healpix index
-            # distance = 1*u.pc for further calculation of cartesian coords
-            c_opt = SkyCoord(ra=row.ra * u.deg, dec=row.dec * u.deg,
-                             distance=1 * u.pc, frame='icrs')
-            opt_hpidx = hp.skycoord_to_healpix(c_opt)
+            # healpix index calculated for the whole batch
+            opt_hpidx = row.opt_hpidx
 
             # find/create optical source
             get_or_create_args = dict(
@@ -219,18 +242,8 @@ class Command(BaseCommand):
                 },
             )
 
-            if opt_type == 'LS':
-                opt_source, created = LS.objects.get_or_create(
-                    **get_or_create_args)
-            elif opt_type == 'SDSS':
-                opt_source, created = SDSS.objects.get_or_create(
-                    **get_or_create_args)
-            elif opt_type == 'PS':
-                opt_source, created = PS.objects.get_or_create(
-                    **get_or_create_args)
-            elif opt_type == 'GAIA':
-                opt_source, created = GAIA.objects.get_or_create(
-                    **get_or_create_args)
+            opt_source, created = Command.opt_models[opt_type].objects\
+                .get_or_create(**get_or_create_args)
             # TODO add VLASS and ALLWISE and exception for wrong opt type
 
             if created and (row[0] < 500 or row[0] % 500 == 0):
@@ -240,21 +253,12 @@ class Command(BaseCommand):
             # Check that it is new source or new file
             if created:
                 try:
-                    # self.stdout.write(
-                    # f'Start filling {opt_type} fields...\n')
-                    for i, field in enumerate(field_list):
-                        # self.stdout.write(
-                        # f'Num:{i} - {field} - {row[i+3]}')
-                        # i+3 skip index and xray fields
-                        filled_fields = ['objID', 'opt_hpidx', 'survey',
-                                         'file_name', 'ra', 'dec']
-                        if field not in filled_fields:
-                            # Similar to source.field = row[i+3]
-                            setattr(opt_source, field, row[i+3])
-
-                    opt_source.c_x = c_opt.cartesian.x.value
-                    opt_source.c_y = c_opt.cartesian.y.value
-                    opt_source.c_z = c_opt.cartesian.z.value
+                    for field in model_fields:
+                        setattr(opt_source, field, getattr(row, field))
+
+                    opt_source.c_x = row.c_x
+                    opt_source.c_y = row.c_y
+                    opt_source.c_z = row.c_z
                     # sources.append(source)
                     opt_source.save()
 
@@ -264,125 +268,487 @@ class Command(BaseCommand):
 
                     raise CommandError(e)
 
-            # find xray sources for opt source
-            xray_sources = eROSITA.objects.filter(name=row.srcname_fin,
-                                                  survey__name=row.survey,
-                                                  hpidx=row.hpidx)
-
-            # check if xray sources already linked with opt source
-            already_linked = opt_source.xray_sources.filter(
-                name=row.srcname_fin, survey__name=row.survey, hpidx=row.hpidx
-            ).exists()
-            # already_linked = set(
-            # (xray_sources)).issubset((opt_source.xray_sources.all()))
-
-            if xray_sources.exists() and not already_linked:
-                opt_source.xray_sources.add(*xray_sources)
-                # find counterpart for xray sources
-                Command.find_dup_source(
-                    xray_sources, opt_source, c_opt, opt_type)
-                opt_source.save()
-
-                if row[0] < 500 or row[0] % 500 == 0:
-                    print(f'{row[0]} - Link {opt_type} source: {opt_source}'
-                          f'with xray sources: {xray_sources}'
-                          f'from survey {row.survey}\n')
-
-            elif not xray_sources.exists():
-                raise CommandError(
-                    f'{row[0]} - Cant find xray sources with name:'
-                    f'{row.srcname_fin} hpidx: {row.hpidx}'
-                    f'from survey {row.survey}'
-                )
-
-    @staticmethod
-    def read_table(path: Path, method: str = "auto") -> pd.DataFrame:
-        # TODO add fits support
-        if method == "auto":
-            if path.suffix == ".parquet":
-                method = 'parquet'
+            opt_pks[row.Index] = opt_source.pk
 
-        if method != "parquet":
-            return pq.read_table(path).to_pandas().replace({np.nan: None})
+        new_links = self.link_xray_sources(data, opt_pks, opt_type)
+        # find counterpart for newly linked xray sources
+        self.resolve_counterparts(new_links, data['survey'].unique(), opt_type)
+        # pre-class flags of newly linked xray sources are recalculated
+        mark_pre_class_dirty(new_links['xray_pk'])
 
-        raise NotImplementedError("Only Parquet is supported!")
+    def get_xray_index(self, survey_name) -> Dict[tuple, List[tuple]]:
+        """Return dict {(name, hpidx): list of (pk, RA, DEC) of eROSITA
+        sources} for the survey.
 
+        Index is built with one query and cached for following batches.
+        """
+        if survey_name not in self.xray_indices:
+            xray_index = defaultdict(list)
+            for pk, name, hpidx, ra, dec in eROSITA.objects.filter(
+                    survey__name=survey_name).values_list('pk', 'name', 'hpidx', 'RA', 'DEC'):
+                xray_index[(name, hpidx)].append((pk, ra, dec))
+            self.xray_indices[survey_name] = xray_index
+        return self.xray_indices[survey_name]
+
+    def link_xray_sources(self, data: pd.DataFrame, opt_pks: Dict[int, int],
+                          opt_type: str) -> pd.DataFrame:
+        """Set many-to-many relationships between optical sources and
+        eROSITA sources in bulk.
+
+        X-ray sources are found by (srcname_fin, survey, hpidx) keys in
+        cached indices of surveys, links existing in the through table are
+        skipped and the missing ones are inserted with a single bulk_create.
+        Separations and position angles of new links are calculated at once.
+
+        :param data: table of optical sources.
+        :param opt_pks: optical source pk for each row index of data.
+        :param opt_type: optical survey of optical sources.
+
+        :return: table of new links with `opt_pk` and `xray_pk` columns.
+        """
+        m2m_field = Command.opt_models[opt_type]._meta.get_field(
+            'xray_sources')
+        through = m2m_field.remote_field.through
+        opt_column = m2m_field.m2m_column_name()
+        xray_column = m2m_field.m2m_reverse_name()
+
+        new_links = []
+        for survey_name, survey_data in data.groupby('survey', sort=False):
+            xray_index = self.get_xray_index(survey_name)
+
+            # existing links of optical sources of the batch
+            linked = set(filter_in_chunks(
+                through.objects.filter(**{
+                    m2m_field.m2m_reverse_field_name() + '__survey__name':
+                        survey_name,
+                }).values_list(opt_column, xray_column),
+                opt_column, {opt_pks[row_ind] for row_ind in survey_data.index}))
+
+            for row_ind, name, hpidx, ra, dec in zip(survey_data.index,
+                                                     survey_data['srcname_fin'],
+                                                     survey_data['hpidx'],
+                                                     survey_data['ra'],
+                                                     survey_data['dec']):
+                xray_sources = xray_index.get((name, hpidx))
+                if not xray_sources:
+                    raise CommandError(
+                        f'{row_ind} - Cant find xray sources with name:'
+                        f'{name} hpidx: {hpidx}'
+                        f'from survey {survey_name}'
+                    )
+
+                opt_pk = opt_pks[row_ind]
+                for xray_pk, xray_ra, xray_dec in xray_sources:
+                    if (opt_pk, xray_pk) in linked:
+                        continue
+                    linked.add((opt_pk, xray_pk))
+                    new_links.append((opt_pk, xray_pk, xray_ra, xray_dec,
+                                      ra, dec))
+
+        new_links = pd.DataFrame(new_links, columns=['opt_pk', 'xray_pk', 'RA',
+                                                     'DEC', 'ra', 'dec'])
+        coords = (new_links['RA'], new_links['DEC'],
+                  new_links['ra'], new_links['dec'])
+        new_links['sep'] = angular_separation(*coords)
+        new_links['pa'] = position_angle(*coords)
+        links = [through(**{opt_column: opt_pk, xray_column: xray_pk,
+                            'separation': sep, 'position_angle': pa})
+                 for opt_pk, xray_pk, sep, pa
+                 in zip(new_links['opt_pk'].tolist(),
+                        new_links['xray_pk'].tolist(),
+                        new_links['sep'].tolist(), new_links['pa'].tolist())]
+        through.objects.bulk_create(links, ignore_conflicts=True)
+        self.stdout.write(f'Link {opt_type} sources with xray sources, '
+                          f'new links: {len(links)}')
+
+        return new_links[['opt_pk', 'xray_pk']]
+
+    def resolve_counterparts(self, new_links: pd.DataFrame,
+                             surveys: Iterable[str], opt_type: str):
+        """Choose optical counterparts of X-ray sources among newly linked
+        optical sources.
+
+        Separations of all new (X-ray, optical) pairs are read from the
+        through table at once (links stored without separations get them
+        calculated from coordinates), the nearest optical source of each X-ray source replaces its current
+        counterpart if there is none or the current one is farther. Changed
+        counterparts are written with one bulk_update.
+
+        :param new_links: table with `opt_pk` and `xray_pk` columns.
+        :param surveys: names of surveys of linked X-ray sources.
+        :param opt_type: optical survey of optical sources.
+        """
+        if new_links.empty:
+            return
+
+        m2m_field = Command.opt_models[opt_type]._meta.get_field(
+            'xray_sources')
+        through = m2m_field.remote_field.through
+        xray_name = m2m_field.m2m_reverse_field_name()
+        dup_field = Command.dup_fields[opt_type]
+        sep_field = dup_field + '_sep'
+
+        # separations of linked pairs and current counterparts
+        links = pd.DataFrame.from_records(
+            list(filter_in_chunks(
+                through.objects.filter(**{
+                    xray_name + '__survey__name__in': surveys,
+                }).values_list(m2m_field.m2m_column_name(),
+                               m2m_field.m2m_reverse_name(), 'separation'),
+                m2m_field.m2m_column_name(),
+                new_links['opt_pk'].unique().tolist())),
+            columns=['opt_pk', 'xray_pk', 'sep'])
+        current = pd.DataFrame.from_records(
+            list(filter_in_chunks(
+                eROSITA.objects.filter(survey__name__in=surveys)
+                .values_list('pk', dup_field + '_id', sep_field),
+                'pk', new_links['xray_pk'].unique().tolist())),
+            columns=['xray_pk', 'dup_pk', 'dup_sep'])
+        current['dup_sep'] = pd.to_numeric(current['dup_sep'].astype(float))
+
+        pairs = new_links.merge(links, on=['opt_pk', 'xray_pk'], how='left')
+        pairs['sep'] = pd.to_numeric(pairs['sep'].astype(float))
+        missing = pairs['sep'].isna()
+        if missing.any():
+            pairs.loc[missing, 'sep'] = calculate_link_separations(
+                through, pairs.loc[missing, ['opt_pk', 'xray_pk']])['sep'].to_numpy()
+        # pairs without coordinates can not be counterparts
+        pairs = pairs[pairs['sep'].notna()]
+        # nearest new optical source for each xray source
+        best = pairs.loc[pairs.groupby('xray_pk', sort=False)['sep'].idxmin()]
+        best = best.merge(current, on='xray_pk', how='left')
+        best = best[best['dup_pk'].isna() | (best['dup_sep'] > best['sep'])]
+
+        xray_sources = [
+            eROSITA(pk=xray_pk, **{dup_field + '_id': opt_pk,
+                                   sep_field: float(sep)})
+            for xray_pk, opt_pk, sep in zip(best['xray_pk'], best['opt_pk'],
+                                            best['sep'])
+        ]
+        eROSITA.objects.bulk_update(xray_sources, [dup_field, sep_field],
+                                    batch_size=1000)
+        self.stdout.write(f'Change {opt_type} counterparts of '
+                          f'{len(xray_sources)} xray sources')
 
-    def handle(self, *args, **options):
-        start_time = timezone.now()
-        # survey_num = options['survey_num']
+    @staticmethod
+    def get_opt_surveys() -> List[tuple]:
+        """Return list of (optical survey, file suffix, field list) in
+        loading order."""
+        return [('LS', 'ls', Command.get_ls_fields()),
+                ('SDSS', 'sdss', Command.get_sdss_fields()),
+                ('PS', 'ps', Command.get_ps_fields()),
+                ('GAIA', 'gaia', Command.get_gaia_fields())]
+
+    def get_opt_files(self) -> List[tuple]:
+        """Return list of (file path, field list, optical survey) of optical
+        files in loading order."""
+        opt_files = []
         # iterate over surveys
         for survey_num in ([1, 2, 3, 4, 9]):
-            start_time_ = timezone.now()  # TODO replace start_time_ with tqdm
             # get dir name by survey number
             dir_name = 'eRASS' + str(survey_num)
-
-            # healpix map with pixel_resolution < 1/2 arcsec
-            hp = HEALPix(nside=2 ** 19, order='nested', frame='icrs')
-
-            self.stdout.write(f'Start reading optical data')
-            # sources = []
-
             # TODO add command argument to control survey choice
+            for opt_type, file_suffix, field_list in Command.get_opt_surveys():
+                file_path = os.path.join(settings.WORK_DIR, dir_name,
+                                         f'opt_sources_{file_suffix}.parquet')
+                opt_files.append((file_path, field_list, opt_type))
+        return opt_files
 
-            # Load DESI LIS sources
-
-            # TODO refactor like
-            # ls_data = Command.read_table(
-            #     Path(settings.WORK_DIR) / dir_name / 'opt_sources_ls.parquet'
-            # )
-            # print(...)
-            # self.load_opt_survey(ls_data, Command.get_ls_fields(), hp, 'LS')
-
-            file_path = os.path.join(
-                settings.WORK_DIR, dir_name, 'opt_sources_ls.parquet')
-
-            table = pq.read_table(file_path)
-            ls_data = table.to_pandas()
-            ls_data = ls_data.replace({np.nan: None})
-            print(f'\nTable with LS sources:\n', ls_data)
-            ls_field_list = Command.get_ls_fields()  # replace with attribute
-            self.load_opt_survey(ls_data, ls_field_list, hp, opt_type='LS')
-
-            file_path = os.path.join(
-                settings.WORK_DIR, dir_name, 'opt_sources_sdss.parquet')
-
-            table = pq.read_table(file_path)
-            sdss_data = table.to_pandas()
-            sdss_data = sdss_data.replace({np.nan: None})
-            print(f'\nTable with SDSS sources:\n', sdss_data)
-            sdss_field_list = Command.get_sdss_fields()
-            self.load_opt_survey(
-                sdss_data, sdss_field_list, hp, opt_type='SDSS')
-
-            # Load PS sources
-            file_path = os.path.join(
-                settings.WORK_DIR, dir_name, 'opt_sources_ps.parquet')
-            table = pq.read_table(file_path)
-            ps_data = table.to_pandas()
-            ps_data = ps_data.replace({np.nan: None})
-            print(f'\nTable with PS sources:\n', ps_data)
-            ps_field_list = Command.get_ps_fields()
-            self.load_opt_survey(
-                ps_data, ps_field_list, hp, opt_type='PS')
-
-            # Load GAIA sources
-            file_path = os.path.join(
-                settings.WORK_DIR, dir_name, 'opt_sources_gaia.parquet')
-            table = pq.read_table(file_path)
-            gaia_data = table.to_pandas()
-            gaia_data = gaia_data.replace({np.nan: None})
-            print(f'\nTable with GAIA sources:\n', gaia_data)
-            gaia_field_list = Command.get_gaia_fields()
-            self.load_opt_survey(
-                gaia_data, gaia_field_list, hp, opt_type='GAIA')
+    @staticmethod
+    def iter_prepared_files(opt_files: List[tuple], batch_size: int,
+                            workers: int = 1, filter=None,
+                            queue_size: int = 2) -> Iterator[tuple]:
+        """Yield (file path, field list, optical survey, prepared batches) for
+        each optical file in order.
+
+        :param opt_files: list of (file path, field list, optical survey,
+            number of rows to skip).
+
+        With several workers files are read and prepared in a process pool,
+        at most 2 * workers files ahead of the writer. Workers pass prepared
+        batches through a queue of each file holding at most `queue_size`
+        batches, so memory is bounded by batches, not by file sizes.
+        """
+        if workers <= 1:
+            for file_path, field_list, opt_type, start in opt_files:
+                yield file_path, field_list, opt_type, prepare_opt_batches(
+                    file_path, field_list, batch_size, start, filter)
+            return
+
+        def iter_queue(queue, future):
+            data = queue.get()
+            while data is not None:
+                yield data
+                data = queue.get()
+            # errors of the worker are raised here
+            future.result()
+
+        with multiprocessing.Manager() as manager, \
+                ProcessPoolExecutor(max_workers=workers,
+                                    initializer=django.setup) as executor:
+            def submit(file_path, field_list, opt_type, start):
+                queue = manager.Queue(maxsize=queue_size)
+                return file_path, field_list, opt_type, queue, executor.submit(
+                    read_opt_file, queue, file_path, field_list, batch_size,
+                    start, filter)
+
+            opt_files = iter(opt_files)
+            futures = deque(submit(*opt_file)
+                            for opt_file in islice(opt_files, 2 * workers))
+            try:
+                while futures:
+                    file_path, field_list, opt_type, queue, future = futures[0]
+                    yield file_path, field_list, opt_type, iter_queue(queue,
+                                                                      future)
+                    futures.popleft()
+                    futures.extend(submit(*opt_file)
+                                   for opt_file in islice(opt_files, 1))
+            finally:
+                # on errors of the writer, workers blocked on full queues
+                # are drained to let the pool shut down
+                for *_, queue, future in futures:
+                    if future.cancel():
+                        continue
+                    while not future.done():
+                        try:
+                            queue.get(timeout=1)
+                        except Empty:
+                            pass
+
+    def load_files(self, batch_size: int, workers: int = 1,
+                   resume: bool = False, filter=None):
+        """Load all optical files by batches, skip committed batches if
+        `resume` is set. Loading of rows selected by `filter` is not
+        checkpointed."""
+        checkpoints = {}
+        opt_files = []
+        for file_path, field_list, opt_type in self.get_opt_files():
+            if filter is not None:
+                opt_files.append((file_path, field_list, opt_type, 0))
+                continue
+            checkpoint = get_checkpoint(file_path, opt_type, resume,
+                                        batch_size)
+            if checkpoint.status == IngestCheckpoint.DONE:
+                self.stdout.write(f'Skip loaded file {file_path}')
+                continue
+            if checkpoint.rows_loaded:
+                self.stdout.write(f'Resume loading {file_path} from row '
+                                  f'{checkpoint.rows_loaded}')
+            checkpoints[file_path] = checkpoint
+            opt_files.append((file_path, field_list, opt_type,
+                              checkpoint.rows_loaded))
+
+        self.stdout.write(f'Start reading optical data')
+        # DB writes are done by this process only
+        for file_path, field_list, opt_type, batches in Command.iter_prepared_files(
+                opt_files, batch_size, workers, filter):
+            start_time_ = timezone.now()  # TODO replace start_time_ with tqdm
+            checkpoint = checkpoints.get(file_path)
+            try:
+                for data in batches:
+                    # batch and its checkpoint are committed together
+                    with transaction.atomic():
+                        self.load_opt_survey(data, field_list, opt_type=opt_type)
+                        if checkpoint:
+                            checkpoint.advance(len(data))
+            except Exception:
+                if checkpoint:
+                    checkpoint.set_status(IngestCheckpoint.FAILED)
+                raise
+            if checkpoint:
+                checkpoint.set_status(IngestCheckpoint.DONE)
 
             end_time_ = timezone.now()
             self.stdout.write(
-                f'End reading {dir_name} optical data, time:'
+                f'End loading {file_path}, time:'
                 f'{(end_time_-start_time_).total_seconds()} seconds.'
             )
 
+    def update_opt_sources(self, data: pd.DataFrame, field_list: List[str],
+                           opt_type: str):
+        """Update fields of optical sources with changed rows."""
+        opt_model = Command.opt_models[opt_type]
+        concrete_fields = {field.name for field in opt_model._meta.concrete_fields}
+        filled_fields = ['opt_hpidx', 'survey', 'file_name', 'ra', 'dec']
+        model_fields = [field for field in field_list
+                        if field not in filled_fields and field in data.columns
+                        and field in concrete_fields]
+
+        data = data.drop_duplicates('opt_hpidx')
+        opt_sources = {
+            opt_source.opt_hpidx: opt_source for opt_source in
+            filter_in_chunks(opt_model.objects.all(), 'opt_hpidx',
+                             data['opt_hpidx'].tolist())
+        }
+        for row in data.itertuples():
+            opt_source = opt_sources.get(row.opt_hpidx)
+            if opt_source is None:
+                raise CommandError(f'{row.Index} - {opt_type} source '
+                                   f'{row.opt_hpidx} not found')
+            for field in model_fields:
+                setattr(opt_source, field, getattr(row, field))
+
+        opt_model.objects.bulk_update(opt_sources.values(), model_fields,
+                                      batch_size=1000)
+        # pre-class flags of linked xray sources are recalculated
+        m2m_field = opt_model._meta.get_field('xray_sources')
+        mark_pre_class_dirty(filter_in_chunks(
+            m2m_field.remote_field.through.objects.values_list(m2m_field.m2m_reverse_name(), flat=True),
+            m2m_field.m2m_column_name(), [opt_source.pk for opt_source in opt_sources.values()]))
+        self.stdout.write(f'Update {len(opt_sources)} {opt_type} sources')
+
+    def unlink_opt_sources(self, deleted: pd.DataFrame, opt_type: str):
+        """Remove links of deleted rows.
+
+        Counterparts of X-ray sources that lost their counterpart are chosen
+        again among remaining linked optical sources, optical sources without
+        links are deleted.
+
+        :param deleted: table with `survey`, `srcname_fin`, `hpidx` and
+            `opt_hpidx` columns.
+        """
+        opt_model = Command.opt_models[opt_type]
+        m2m_field = opt_model._meta.get_field('xray_sources')
+        through = m2m_field.remote_field.through
+        opt_column = m2m_field.m2m_column_name()
+        xray_column = m2m_field.m2m_reverse_name()
+        dup_field = Command.dup_fields[opt_type]
+
+        opt_pks = {
+            opt_hpidx: pk for pk, opt_hpidx in
+            filter_in_chunks(opt_model.objects.values_list('pk', 'opt_hpidx'),
+                             'opt_hpidx', deleted['opt_hpidx'].unique().tolist())
+        }
+        pairs = []
+        for survey_name, name, hpidx, opt_hpidx in zip(
+                deleted['survey'], deleted['srcname_fin'], deleted['hpidx'],
+                deleted['opt_hpidx']):
+            opt_pk = opt_pks.get(opt_hpidx)
+            if opt_pk is None:
+                continue
+            xray_index = self.get_xray_index(survey_name)
+            for xray_pk, ra, dec in xray_index.get((name, hpidx), []):
+                pairs.append((opt_pk, xray_pk))
+
+        with transaction.atomic():
+            for i in range(0, len(pairs), 200):
+                condition = Q()
+                for opt_pk, xray_pk in pairs[i:i + 200]:
+                    condition |= Q(**{opt_column: opt_pk, xray_column: xray_pk})
+                through.objects.filter(condition).delete()
+            # pre-class flags of unlinked xray sources are recalculated
+            mark_pre_class_dirty(xray_pk for opt_pk, xray_pk in pairs)
+
+            # xray sources which lost their counterpart
+            unlinked = defaultdict(set)
+            for opt_pk, xray_pk in pairs:
+                unlinked[xray_pk].add(opt_pk)
+            xray_sources = [
+                xray_source for xray_source in filter_in_chunks(
+                    eROSITA.objects.only('pk', 'survey', dup_field),
+                    'pk', list(unlinked))
+                if getattr(xray_source, dup_field + '_id') in unlinked[xray_source.pk]
+            ]
+            for xray_source in xray_sources:
+                setattr(xray_source, dup_field, None)
+                setattr(xray_source, dup_field + '_sep', None)
+            eROSITA.objects.bulk_update(xray_sources,
+                                        [dup_field, dup_field + '_sep'],
+                                        batch_size=1000)
+            remaining_links = pd.DataFrame.from_records(
+                list(filter_in_chunks(
+                    through.objects.values_list(opt_column, xray_column),
+                    xray_column, [xray_source.pk for xray_source in xray_sources])),
+                columns=['opt_pk', 'xray_pk'])
+            self.resolve_counterparts(remaining_links,
+                                      deleted['survey'].unique(), opt_type)
+
+            # optical sources without links
+            linked_pks = set(filter_in_chunks(
+                through.objects.values_list(opt_column, flat=True),
+                opt_column, list(opt_pks.values())))
+            orphan_pks = [pk for pk in opt_pks.values() if pk not in linked_pks]
+            for i in range(0, len(orphan_pks), 500):
+                opt_model.objects.filter(pk__in=orphan_pks[i:i + 500]).delete()
+
+        self.stdout.write(f'Remove {len(pairs)} links of {opt_type} sources, '
+                          f'delete {len(orphan_pks)} {opt_type} sources')
+
+    def load_file_incremental(self, file_path: str, field_list: List[str],
+                              opt_type: str, batch_size: int):
+        """Apply only rows inserted, changed or deleted since the previous
+        version of the file.
+
+        Row hashes of mapped columns are stored for each version of the file
+        (OriginFile.version), the new version is compared with the previous
+        one by keys (survey, srcname_fin, hpidx, opt_hpidx). Without stored
+        hashes all rows are loaded as new ones, existing sources are not
+        changed.
+        """
+        checkpoint = get_checkpoint(file_path, opt_type, batch_size=batch_size)
+        origin_file = checkpoint.origin_file
+        key_columns = ['survey', 'srcname_fin', 'hpidx', 'opt_hpidx']
+        hashes = read_row_hashes(
+            file_path, ['survey', 'srcname_fin', 'hpidx', 'ra', 'dec'],
+            ['srcname_fin', 'hpidx'] + field_list, batch_size)
+        # optical sources are stored with recalculated healpix indices
+        hp = HEALPix(nside=2 ** 19, order='nested', frame='icrs')
+        hashes['opt_hpidx'] = healpix_index(hp, hashes.pop('ra'),
+                                            hashes.pop('dec'))
+        inserted, updated, deleted = diff_row_hashes(
+            load_row_hashes(origin_file), hashes, key_columns)
+        self.stdout.write(
+            f'Version {origin_file.version} of {file_path}, rows to insert: '
+            f'{len(inserted)}, to update: {len(updated)}, '
+            f'to delete: {len(deleted)}')
+
+        try:
+            if len(inserted) or len(updated):
+                for data in prepare_opt_batches(file_path, field_list,
+                                                batch_size):
+                    new_data = data[data.index.isin(inserted)]
+                    if not new_data.empty:
+                        with transaction.atomic():
+                            self.load_opt_survey(new_data, field_list,
+                                                 opt_type=opt_type)
+                    changed_data = data[data.index.isin(updated)]
+                    if not changed_data.empty:
+                        self.update_opt_sources(changed_data, field_list,
+                                                opt_type)
+            if len(deleted):
+                self.unlink_opt_sources(deleted, opt_type)
+        except Exception:
+            checkpoint.set_status(IngestCheckpoint.FAILED)
+            raise
+
+        save_row_hashes(origin_file, hashes)
+        checkpoint.set_status(IngestCheckpoint.DONE)
+
+    def handle(self, *args, **options):
+        start_time = timezone.now()
+        self.xray_indices = {}
+
+        if options['hp_pixels'] and (options['incremental'] or options['resume']):
+            raise CommandError('Option --hp-pixels can not be used with '
+                               '--incremental or --resume')
+        if options['incremental']:
+            if options['resume']:
+                raise CommandError('Options --incremental and --resume can '
+                                   'not be used together')
+            if options['workers'] > 1:
+                raise CommandError('Option --workers can not be used with '
+                                   '--incremental')
+            for file_path, field_list, opt_type in self.get_opt_files():
+                self.load_file_incremental(file_path, field_list, opt_type,
+                                           options['batch_size'])
+        else:
+            filter = None
+            if options['hp_pixels']:
+                filter = partial(hp_pixels_filter, options['hp_pixels'],
+                                 options['hp_order'])
+            self.load_files(options['batch_size'], options['workers'],
+                            options['resume'], filter)
+
         # maybe use this later TODO
         # if len(sources) > 500:
         #     Source.objects.bulk_create(sources)
@@ -0,0 +1,36 @@
+import os
+import shutil
+import subprocess
+
+from django.core.management import BaseCommand, CommandError
+from django.utils import timezone
+
+from surveys.images import render_previews, write_manifest
+
+
+class Command(BaseCommand):
+    help = "Render PNG previews of staged light curves and spectra (PDF) with pdftoppm."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=600,
+                            help='size of the longest side of previews, pixels')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='number of pdftoppm processes run at once')
+
+    def handle(self, *args, **options):
+        start_time = timezone.now()
+        if shutil.which('pdftoppm') is None:
+            raise CommandError('pdftoppm not found, install poppler-utils')
+
+        try:
+            rendered = render_previews(options['size'], options['workers'])
+        except subprocess.CalledProcessError as e:
+            raise CommandError(f'pdftoppm failed for {e.cmd[-2]}: {e.stderr.decode(errors="replace")}')
+        # previews are listed in the manifest with staged images
+        images_num = write_manifest()
+
+        end_time = timezone.now()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rendering previews took: {(end_time - start_time).total_seconds()} seconds, '
+            f'rendered {rendered["rendered"]}, skipped {rendered["skipped"]} files, '
+            f'{images_num} images in manifest.'))
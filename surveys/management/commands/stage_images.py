@@ -0,0 +1,28 @@
+from django.core.management import BaseCommand
+from django.utils import timezone
+
+from surveys.images import stage_images, write_manifest
+from surveys.models import MetaObject
+
+
+class Command(BaseCommand):
+    help = "Copy images of meta objects from MASTER_DIR/eRASS{i} to IMAGE_DATA_PATH/e{i}."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8,
+                            help='number of threads copying files')
+
+    def handle(self, *args, **options):
+        start_time = timezone.now()
+        # images of master table rows are named by img_id, loaded into meta_ind
+        meta_inds = MetaObject.objects.values_list('meta_ind', flat=True)
+        staged = stage_images(((meta_ind, meta_ind) for meta_ind in meta_inds.iterator()),
+                              workers=options['workers'])
+        # list of staged images for templates
+        images_num = write_manifest()
+
+        end_time = timezone.now()
+        self.stdout.write(self.style.SUCCESS(
+            f'Staging images took: {(end_time - start_time).total_seconds()} seconds, '
+            f'linked {staged["linked"]}, copied {staged["copied"]}, skipped {staged["skipped"]} files, '
+            f'{images_num} images in manifest.'))
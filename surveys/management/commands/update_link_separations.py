@@ -0,0 +1,66 @@
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+import pandas as pd
+
+from surveys.models import GAIAXrayLink, LSXrayLink, PSXrayLink, SDSSXrayLink
+from surveys.utils import calculate_link_separations, filter_in_chunks, help_from_docstring
+
+
+@help_from_docstring
+class Command(BaseCommand):
+    """Fill separations and position angles of links of optical sources
+    with eROSITA sources created before they were stored.
+
+    Links without `separation` are updated (all links with `--all`) from
+    coordinates of linked sources with bulk updates by batches. Pre-class
+    flags and ordering of optical sources use stored separations.
+    """
+
+    link_models = [LSXrayLink, SDSSXrayLink, PSXrayLink, GAIAXrayLink]
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='recalculate separations of all links, not only of links without them')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='number of links updated at once')
+
+    def update_model(self, through, recalculate_all: bool, batch_size: int) -> int:
+        """Calculate separations and position angles of links of the through
+        model.
+
+        :return: number of updated links.
+        """
+        links = through.objects.all()
+        if not recalculate_all:
+            links = links.filter(separation__isnull=True)
+        pks = list(links.order_by('pk').values_list('pk', flat=True))
+
+        opt_column = through.opt_field + '_id'
+        for i in range(0, len(pks), batch_size):
+            chunk = pks[i:i + batch_size]
+            data = pd.DataFrame.from_records(
+                list(filter_in_chunks(through.objects.values_list('pk', opt_column, 'erosita_id'), 'pk', chunk)),
+                columns=['pk', 'opt_pk', 'xray_pk'])
+            data = calculate_link_separations(through, data)
+            # links without coordinates stay empty
+            data = data.astype(object).where(data.notna(), None)
+            objects = [through(pk=pk, separation=sep, position_angle=pa)
+                       for pk, sep, pa in zip(data['pk'], data['sep'], data['pa'])]
+            with transaction.atomic():
+                through.objects.bulk_update(objects, ['separation', 'position_angle'], batch_size=1000)
+            self.stdout.write(f'Update {i + len(chunk)} of {len(pks)} {through._meta.verbose_name_plural}')
+        return len(pks)
+
+    def handle(self, *args, **options):
+        start_time = timezone.now()
+        if options['batch_size'] <= 0:
+            raise CommandError('--batch-size must be positive')
+
+        links_num = sum(self.update_model(through, options['all'], options['batch_size'])
+                        for through in Command.link_models)
+
+        end_time = timezone.now()
+        self.stdout.write(self.style.SUCCESS(
+            f'Updating link separations took: {(end_time - start_time).total_seconds()} seconds, '
+            f'{links_num} links.'))
@@ -0,0 +1,69 @@
+from astropy_healpix import HEALPix
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+import pandas as pd
+
+from surveys.coords import HPIDX_ORDER, healpix_index, unit_vectors
+from surveys.models import MetaObject, eROSITA
+from surveys.utils import filter_in_chunks, help_from_docstring
+
+
+@help_from_docstring
+class Command(BaseCommand):
+    """Fill sky columns of rows loaded before the columns were added.
+
+    Meta objects get nested HEALPix index `hpidx` (order 19) and unit
+    vectors `c_x`, `c_y`, `c_z` of RA, DEC, eROSITA sources get unit
+    vectors, cone search of the source list relies on them. Rows without
+    `c_z` are updated (all rows with `--all`) with bulk updates by batches.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='recalculate columns of all rows, not only of rows without them')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='number of rows updated at once')
+
+    def update_model(self, model, hp, recalculate_all: bool, batch_size: int) -> int:
+        """Calculate sky columns of rows of the model, `hpidx` only if it
+        is calculated from RA, DEC (indexed).
+
+        :return: number of updated rows.
+        """
+        fields = ['c_x', 'c_y', 'c_z']
+        if model._meta.get_field('hpidx').db_index:
+            fields = ['hpidx'] + fields
+
+        rows = model.objects.filter(RA__isnull=False, DEC__isnull=False)
+        if not recalculate_all:
+            rows = rows.filter(c_z__isnull=True)
+        pks = list(rows.order_by('pk').values_list('pk', flat=True))
+
+        for i in range(0, len(pks), batch_size):
+            chunk = pks[i:i + batch_size]
+            data = pd.DataFrame.from_records(list(filter_in_chunks(model.objects.values_list('pk', 'RA', 'DEC'),
+                                                                   'pk', chunk)),
+                                             columns=['pk', 'RA', 'DEC'])
+            columns = dict(zip(['c_x', 'c_y', 'c_z'], unit_vectors(data['RA'], data['DEC'])))
+            columns['hpidx'] = healpix_index(hp, data['RA'], data['DEC'])
+            objects = [model(pk=pk, **{field: columns[field][j].item() for field in fields})
+                       for j, pk in enumerate(data['pk'].tolist())]
+            with transaction.atomic():
+                model.objects.bulk_update(objects, fields, batch_size=1000)
+            self.stdout.write(f'Update {i + len(chunk)} of {len(pks)} {model._meta.verbose_name_plural}')
+        return len(pks)
+
+    def handle(self, *args, **options):
+        start_time = timezone.now()
+        if options['batch_size'] <= 0:
+            raise CommandError('--batch-size must be positive')
+
+        hp = HEALPix(nside=2 ** HPIDX_ORDER, order='nested', frame='icrs')
+        meta_num = self.update_model(MetaObject, hp, options['all'], options['batch_size'])
+        xray_num = self.update_model(eROSITA, hp, options['all'], options['batch_size'])
+
+        end_time = timezone.now()
+        self.stdout.write(self.style.SUCCESS(
+            f'Updating sky columns took: {(end_time - start_time).total_seconds()} seconds, '
+            f'{meta_num} meta objects, {xray_num} eROSITA sources.'))
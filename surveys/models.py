@@ -25,6 +25,13 @@ from decimal import Decimal
 
 import astropy.units as u
 from astropy.coordinates import SkyCoord
+from astropy_healpix import HEALPix
+
+from surveys.coords import HPIDX_ORDER, angular_separation, healpix_index, position_angle, unit_vectors
+
+
+# HEALPix map of `hpidx` indices
+_hpidx_healpix = HEALPix(nside=2 ** HPIDX_ORDER, order='nested', frame='icrs')
 
 
 # Class for files from where sources were loaded
@@ -37,6 +44,60 @@ class OriginFile(models.Model):
         return 'MetaSource: {}'.format(self.file_name)
 
 
+# Class for progress of loading input files by management commands
+class IngestCheckpoint(models.Model):
+    RUNNING = 'running'
+    FAILED = 'failed'
+    DONE = 'done'
+    STATUS_CHOICES = [
+        (RUNNING, 'Running'),
+        (FAILED, 'Failed'),
+        (DONE, 'Done'),
+    ]
+
+    # input file
+    origin_file = models.ForeignKey(OriginFile, on_delete=models.CASCADE,
+                                    related_name='checkpoints')
+    # loaded catalogue, e.g. LS or master
+    catalogue = models.CharField(max_length=50)
+    batch_size = models.PositiveIntegerField(blank=True, null=True)
+    # number of last committed batch, -1 if nothing is committed
+    last_batch = models.IntegerField(default=-1)
+    # number of committed rows from the beginning of the file
+    rows_loaded = models.PositiveIntegerField(default=0)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES,
+                              default=RUNNING)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('origin_file', 'catalogue')
+
+    def __str__(self):
+        return '{} - {}: {} rows, {}'.format(self.origin_file.file_name, self.catalogue,
+                                            self.rows_loaded, self.status)
+
+    def reset(self, batch_size=None):
+        """Start loading from the beginning of the file."""
+        self.batch_size = batch_size
+        self.last_batch = -1
+        self.rows_loaded = 0
+        self.status = IngestCheckpoint.RUNNING
+        self.save()
+
+    def advance(self, rows_num):
+        """Mark next batch with rows_num rows as committed.
+
+        Should be called in the transaction of the batch.
+        """
+        self.last_batch += 1
+        self.rows_loaded += rows_num
+        self.save(update_fields=['last_batch', 'rows_loaded', 'updated_at'])
+
+    def set_status(self, status):
+        self.status = status
+        self.save(update_fields=['status', 'updated_at'])
+
+
 # Class for Meta Objects with common eROSITA sources
 class MetaGroup(models.Model):
     # Pavel id in master table
@@ -59,6 +120,12 @@ class MetaObject(models.Model):
                                                 verbose_name="Master survey")
     RA = models.FloatField(verbose_name="Ra")
     DEC = models.FloatField(verbose_name="Dec")
+    # nested HEALPix index of RA, DEC (nside = 2**19) for cone search
+    hpidx = models.BigIntegerField(blank=True, null=True, db_index=True)
+    # unit vector of RA, DEC for cone search
+    c_x = models.FloatField(blank=True, null=True)
+    c_y = models.FloatField(blank=True, null=True)
+    c_z = models.FloatField(blank=True, null=True, db_index=True)
     # add galactic coordinates
     GLON = models.FloatField(blank=True, null=True)
     GLAT = models.FloatField(blank=True, null=True)
@@ -93,6 +160,8 @@ class MetaObject(models.Model):
     tde_v3 = models.BooleanField(blank=True, null=True)
     # LS TDE v.3 flag
     tde_v3_ls = models.BooleanField(blank=True, null=True)
+    # pre-class flags need recalculation by calc_pre_class
+    pre_class_dirty = models.BooleanField(default=True, db_index=True)
 
     # Columns of Master Table
     EXT = models.FloatField(blank=True, null=True, verbose_name="Extension")
@@ -190,6 +259,26 @@ class MetaObject(models.Model):
     def __str__(self):
         return '{} - MetaObject: {}'.format(self.meta_ind, self.master_name)
 
+    # fields calculated from RA, DEC by `update_sky_columns`
+    sky_fields = ['hpidx', 'c_x', 'c_y', 'c_z']
+
+    def save(self, *args, **kwargs):
+        """Save method for automatic hpidx and unit vector calculation."""
+        self.update_sky_columns()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and ('RA' in update_fields or 'DEC' in update_fields):
+            kwargs['update_fields'] = list(dict.fromkeys(list(update_fields) + MetaObject.sky_fields))
+        super().save(*args, **kwargs)
+
+    def update_sky_columns(self):
+        """Set nested HEALPix index (nside = 2**19) and unit vector of
+        RA, DEC."""
+        if self.RA is None or self.DEC is None:
+            self.hpidx = self.c_x = self.c_y = self.c_z = None
+            return
+        self.hpidx = int(healpix_index(_hpidx_healpix, self.RA, self.DEC))
+        self.c_x, self.c_y, self.c_z = (float(c) for c in unit_vectors(self.RA, self.DEC))
+
     @staticmethod
     def fields_to_show():
         fields = ['id', 'meta_ind', 'master_name', 'master_survey', 'RA', 'DEC', 'GLON', 'GLAT',
@@ -459,6 +548,8 @@ class eROSITA(models.Model):
     ls_g_s = models.IntegerField(blank=True, null=True)  # values: -1, 0, 1, 2
     # AGN Wise flag
     flag_agn_wise = models.BooleanField(blank=True, null=True)
+    # pre-class flags need recalculation by calc_pre_class
+    pre_class_dirty = models.BooleanField(default=True, db_index=True)
 
     GLON = models.FloatField(blank=True, null=True)
     GLAT = models.FloatField(blank=True, null=True)
@@ -477,6 +568,10 @@ class eROSITA(models.Model):
 
     hpidx = models.BigIntegerField(blank=True, null=True)
     RADEC_ERR = models.FloatField(blank=True, null=True)
+    # unit vector of RA, DEC for cone search
+    c_x = models.FloatField(blank=True, null=True)
+    c_y = models.FloatField(blank=True, null=True)
+    c_z = models.FloatField(blank=True, null=True, db_index=True)
 
     ML_BKG_0 = models.FloatField(blank=True, null=True)
     ML_RATE_0 = models.FloatField(blank=True, null=True)
@@ -570,6 +665,15 @@ class eROSITA(models.Model):
     def __str__(self):
         return '{} - Source: {}'.format(self.survey_ind, self.name)
 
+    def save(self, *args, **kwargs):
+        """Save method for automatic unit vector calculation."""
+        if self.RA is not None and self.DEC is not None:
+            self.c_x, self.c_y, self.c_z = (float(c) for c in unit_vectors(self.RA, self.DEC))
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and ('RA' in update_fields or 'DEC' in update_fields):
+            kwargs['update_fields'] = list(dict.fromkeys(list(update_fields) + ['c_x', 'c_y', 'c_z']))
+        super().save(*args, **kwargs)
+
     def get_comment_count(self):
         return Comment.objects.filter(source=self).count()
 
@@ -626,28 +730,23 @@ class eROSITA(models.Model):
 
     def get_opt_survey_sources(self, survey_name):
         opt_sources = None
-        # TODO: think about adding coords to eROSITA fields
-        # find cartesian coords for xray source
-        c_xray = SkyCoord(ra=self.RA * u.deg, dec=self.DEC * u.deg, distance=1 * u.pc, frame='icrs')
-        c_x = c_xray.cartesian.x.value
-        c_y = c_xray.cartesian.y.value
-        c_z = c_xray.cartesian.z.value
-
         if survey_name == 'LS':
-            opt_sources = self.ls_sources.all()
+            opt_sources = LS.objects.filter(xray_links__erosita=self)
 
         elif survey_name == 'PS':
-            opt_sources = self.ps_sources.all()
+            opt_sources = PS.objects.filter(xray_links__erosita=self)
 
         elif survey_name == 'SDSS':
-            opt_sources = self.sdss_sources.all()
+            opt_sources = SDSS.objects.filter(xray_links__erosita=self)
 
         elif survey_name == 'GAIA':
-            opt_sources = self.gaia_sources.all()
+            opt_sources = GAIA.objects.filter(xray_links__erosita=self)
 
-        # order optical sources by distance from xray source
-        opt_sources = opt_sources.annotate(separation=((F('c_x') - c_x)**2.0 + (F('c_y') - c_y)**2.0
-                                                       + (F('c_z') - c_z)**2.0)).order_by('separation')
+        # separation (arcseconds) and position angle stored in the link,
+        # optical sources are ordered by distance from xray source
+        opt_sources = opt_sources.annotate(separation=F('xray_links__separation'),
+                                           position_angle=F('xray_links__position_angle')
+                                           ).order_by(F('separation').asc(nulls_last=True), 'pk')
         return opt_sources if opt_sources.exists() else None
 
     class Meta:
@@ -893,7 +992,8 @@ class LS(models.Model):
     flux_w4_ebv = models.FloatField(blank=True, null=True)
 
     # xray sources near which gaia source was found
-    xray_sources = models.ManyToManyField(eROSITA, related_name='ls_sources', blank=True)
+    xray_sources = models.ManyToManyField(eROSITA, related_name='ls_sources', blank=True,
+                                          through='LSXrayLink')
     # File from which source was loaded to system
     origin_file = models.ForeignKey(OriginFile, on_delete=models.CASCADE, related_name='ls_sources', blank=True, null=True)
 
@@ -992,7 +1092,8 @@ class SDSS(models.Model):
     counterparts_type = models.CharField(max_length=100, blank=True, null=True)
     
     # xray sources near which gaia source was found
-    xray_sources = models.ManyToManyField(eROSITA, related_name='sdss_sources', blank=True)
+    xray_sources = models.ManyToManyField(eROSITA, related_name='sdss_sources', blank=True,
+                                          through='SDSSXrayLink')
     # File from which source was loaded to system
     origin_file = models.ForeignKey(OriginFile, on_delete=models.CASCADE, related_name='sdss_sources', blank=True, null=True)
 
@@ -1089,7 +1190,8 @@ class PS(models.Model):
     counterparts_type = models.CharField(max_length=100, blank=True, null=True)
 
     # xray sources near which gaia source was found
-    xray_sources = models.ManyToManyField(eROSITA, related_name='ps_sources', blank=True)
+    xray_sources = models.ManyToManyField(eROSITA, related_name='ps_sources', blank=True,
+                                          through='PSXrayLink')
     # File from which source was loaded to system
     origin_file = models.ForeignKey(OriginFile, on_delete=models.CASCADE, related_name='ps_sources', blank=True,
                                     null=True)
@@ -1188,7 +1290,8 @@ class GAIA(models.Model):
     counterparts_type = models.CharField(max_length=100, blank=True, null=True)
 
     # xray sources near which gaia source was found
-    xray_sources = models.ManyToManyField(eROSITA, related_name='gaia_sources', blank=True)
+    xray_sources = models.ManyToManyField(eROSITA, related_name='gaia_sources', blank=True,
+                                          through='GAIAXrayLink')
     # File from which source was loaded to system
     origin_file = models.ForeignKey(OriginFile, on_delete=models.CASCADE, related_name='gaia_sources', blank=True,
                                     null=True)
@@ -1241,6 +1344,87 @@ class GAIA(models.Model):
         verbose_name_plural = 'GAIA sources'
 
 
+class XrayLink(models.Model):
+    """Link of optical source with eROSITA source near which it was found,
+    through model of `xray_sources` of optical surveys.
+
+    Separation and position angle of the pair are stored at link time, so
+    optical sources are sorted and shown without coordinates calculations.
+    Bulk loaders calculate them with `surveys.coords`, `save` calculates
+    them from coordinates of linked sources.
+    """
+    # name of foreign key to optical source
+    opt_field = None
+
+    separation = models.FloatField(blank=True, null=True, verbose_name="Separation, arcsec")
+    # degrees East of North, of optical source relative to xray source
+    position_angle = models.FloatField(blank=True, null=True, verbose_name="Position angle, deg")
+
+    def save(self, *args, **kwargs):
+        """Save method for automatic separation calculation."""
+        self.separation, self.position_angle = self.calculate_separation()
+        super().save(*args, **kwargs)
+
+    def calculate_separation(self) -> Tuple[float, float]:
+        """Separation (arcseconds) and position angle (degrees) of optical
+        source relative to xray source."""
+        xray_source = self.erosita
+        opt_source = getattr(self, self.opt_field)
+        args = (xray_source.RA, xray_source.DEC, opt_source.ra, opt_source.dec)
+        return float(angular_separation(*args)), float(position_angle(*args))
+
+    def __str__(self):
+        return '{} - {}'.format(getattr(self, self.opt_field), self.erosita)
+
+    class Meta:
+        abstract = True
+
+
+class LSXrayLink(XrayLink):
+    opt_field = 'ls'
+
+    ls = models.ForeignKey(LS, on_delete=models.CASCADE, related_name='xray_links')
+    erosita = models.ForeignKey(eROSITA, on_delete=models.CASCADE, related_name='ls_links')
+
+    class Meta:
+        # table of auto-created through model
+        db_table = 'surveys_ls_xray_sources'
+        unique_together = [('ls', 'erosita')]
+
+
+class SDSSXrayLink(XrayLink):
+    opt_field = 'sdss'
+
+    sdss = models.ForeignKey(SDSS, on_delete=models.CASCADE, related_name='xray_links')
+    erosita = models.ForeignKey(eROSITA, on_delete=models.CASCADE, related_name='sdss_links')
+
+    class Meta:
+        db_table = 'surveys_sdss_xray_sources'
+        unique_together = [('sdss', 'erosita')]
+
+
+class PSXrayLink(XrayLink):
+    opt_field = 'ps'
+
+    ps = models.ForeignKey(PS, on_delete=models.CASCADE, related_name='xray_links')
+    erosita = models.ForeignKey(eROSITA, on_delete=models.CASCADE, related_name='ps_links')
+
+    class Meta:
+        db_table = 'surveys_ps_xray_sources'
+        unique_together = [('ps', 'erosita')]
+
+
+class GAIAXrayLink(XrayLink):
+    opt_field = 'gaia'
+
+    gaia = models.ForeignKey(GAIA, on_delete=models.CASCADE, related_name='xray_links')
+    erosita = models.ForeignKey(eROSITA, on_delete=models.CASCADE, related_name='gaia_links')
+
+    class Meta:
+        db_table = 'surveys_gaia_xray_sources'
+        unique_together = [('gaia', 'erosita')]
+
+
 # class AllWise(models.Model):
 #     ir_id = models.PositiveIntegerField()
 #     opt_hpidx = models.BigIntegerField()
@@ -2,6 +2,8 @@ from typing import Union
 
 from django import template
 from django.core.files.storage import default_storage
+from django.templatetags.static import static
+from ..images import image_exists, image_version, preview_name
 from ..models import *
 
 import surveys.models as sm
@@ -10,9 +12,6 @@ from django.conf import settings
 from django.db.models import Model
 import os
 
-import astropy.units as u
-from astropy.coordinates import SkyCoord
-
 register = template.Library()
 
 
@@ -84,14 +83,35 @@ def is_summary(survey):
 @register.filter
 def file_exists(filepath):
     file_path = "/".join(filepath.strip("/").split('/')[1:])  # get path without images/
-    full_path = os.path.join(settings.IMAGE_DATA_PATH, file_path)
-    if os.path.isfile(full_path):
+    # staged images are listed in the manifest, see stage_images command
+    if image_exists(file_path):
         return filepath
     else:
         new_filepath = 'images/file_not_found.pdf' if filepath[-3:] == 'pdf' else 'images/file_not_found.png'
         return new_filepath
 
 
+@register.simple_tag
+def image_url(filepath):
+    """Return static URL of image with hash of its content from the manifest,
+    e.g. `/static/images/e1/lc_1.pdf?v=3f2a9c1b04d7e615`. URL changes with
+    the content, so images can be cached as immutable."""
+    url = static(filepath)
+    file_path = "/".join(filepath.strip("/").split('/')[1:])  # get path without images/
+    version = image_version(file_path)
+    return f'{url}?v={version}' if version else url
+
+
+@register.filter
+def pdf_preview(filepath):
+    """Return path of PNG preview of PDF image, empty string if there is no
+    preview (see render_previews command)."""
+    file_path = "/".join(filepath.strip("/").split('/')[1:])  # get path without images/
+    if file_path.endswith('.pdf') and image_exists(preview_name(file_path)):
+        return preview_name(filepath)
+    return ''
+
+
 @register.filter
 def sec_in_deg(sec):
     """add filter option in template"""
@@ -140,25 +160,6 @@ def get_survey_color(opt_survey):
         return 'limegreen'
 
 
-@register.simple_tag
-def opt_row_class(opt_source, master_source, sep=None):
-    if master_source in opt_source.dup_xray.all():
-        return "table-success"
-    elif sep and sep < 1.1*master_source.pos_r98:
-        return "table-primary"
-    else:
-        return ""
-
-
-@register.filter
-def get_sep(master_source, opt_source):
-    """get separation between master source and optical source"""
-    c_xray = SkyCoord(ra=master_source.RA*u.degree, dec=master_source.DEC*u.degree, distance=1*u.pc, frame='icrs')
-    c_opt = SkyCoord(ra=opt_source.ra*u.degree, dec=opt_source.dec*u.degree, distance=1*u.pc, frame='icrs')
-    sep = c_xray.separation(c_opt)
-    return sep.arcsecond
-
-
 @register.filter
 def is_gaia_star(master_source, opt_id):
     """get separation between master source and optical source"""
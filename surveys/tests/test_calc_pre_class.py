@@ -0,0 +1,80 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from ..models import LS, GAIA, MetaObject, Survey, eROSITA
+from ..utils import mark_pre_class_dirty
+
+
+class CalcPreClassIncrementalTests(TestCase):
+    def setUp(self):
+        survey = Survey.objects.create(name=1)
+        self.xray_sources = []
+        self.ls_sources = []
+        for i, (flag_agn_wise, star) in enumerate([(True, True), (False, True), (True, False)]):
+            ra, dec = 10.0 + i, 20.0
+            xray_source = eROSITA.objects.create(survey_ind=i, name=f'SRC{i}', RA=ra, DEC=dec, pos_r98=5,
+                                                 survey=survey)
+            meta_object = MetaObject.objects.create(master_name=xray_source.name, master_survey=1, RA=ra, DEC=dec,
+                                                    ID_e1=i, ID_e2=-1, ID_e3=-1, RATIO_e2e1=10)
+            xray_source.meta_objects.add(meta_object)
+            # inside and outside of the radius of correlation
+            ls_source = LS.objects.create(objID=i, ra=ra, dec=dec + 0.0005, opt_hpidx=i,
+                                          flag_agn_wise=flag_agn_wise, star=star)
+            ls_source.xray_sources.add(xray_source)
+            far_ls_source = LS.objects.create(objID=10 + i, ra=ra, dec=dec + 0.01, opt_hpidx=10 + i,
+                                              flag_agn_wise=False, star=False)
+            far_ls_source.xray_sources.add(xray_source)
+            gaia_source = GAIA.objects.create(objID=str(i), ra=ra, dec=dec - 0.0005, opt_hpidx=i, star=star)
+            gaia_source.xray_sources.add(xray_source)
+            self.xray_sources.append(xray_source)
+            self.ls_sources.append(ls_source)
+
+    def calc(self, *args):
+        call_command('calc_pre_class', '--batch-size', '2', *args, stdout=StringIO(), stderr=StringIO())
+
+    def get_flags(self):
+        fields = ['flag_agn_wise', 'g_s', 'ls_g_s']
+        return (list(eROSITA.objects.order_by('pk').values_list(*fields)),
+                list(MetaObject.objects.order_by('pk').values_list(*fields, 'tde_v3', 'tde_v3_ls')))
+
+    def test_flags(self):
+        self.calc('--incremental')
+        xray_flags, meta_flags = self.get_flags()
+
+        self.assertEqual(xray_flags, [(True, 1, 1), (False, 1, 1), (True, 0, 0)])
+        self.assertEqual(meta_flags, [(True, 1, 1, False, False), (False, 1, 1, False, False),
+                                      (True, 0, 0, False, False)])
+        self.assertFalse(eROSITA.objects.filter(pre_class_dirty=True).exists())
+        self.assertFalse(MetaObject.objects.filter(pre_class_dirty=True).exists())
+
+    def test_only_dirty_sources_are_recalculated(self):
+        self.calc()
+        LS.objects.filter(pk__in=[self.ls_sources[1].pk, self.ls_sources[2].pk]).update(flag_agn_wise=True,
+                                                                                        star=True)
+        # only the second source is marked by loaders
+        mark_pre_class_dirty([self.xray_sources[1].pk])
+        self.calc('--incremental')
+        xray_flags, meta_flags = self.get_flags()
+
+        self.assertEqual(xray_flags, [(True, 1, 1), (True, 1, 1), (True, 0, 0)])
+        self.assertEqual([flags[:3] for flags in meta_flags], xray_flags)
+        self.assertFalse(eROSITA.objects.filter(pre_class_dirty=True).exists())
+
+        # full calculation recalculates only missing flags of clean sources
+        self.calc()
+        self.assertEqual(self.get_flags()[0], xray_flags)
+
+    def test_incremental_equals_full(self):
+        self.calc('--incremental')
+        LS.objects.filter(pk=self.ls_sources[2].pk).update(star=True)
+        eROSITA.objects.filter(pk=self.xray_sources[2].pk).update(flag_agn_wise=None, g_s=None, ls_g_s=None)
+        mark_pre_class_dirty([self.xray_sources[2].pk])
+        self.calc('--incremental')
+        incremental_flags = self.get_flags()
+
+        eROSITA.objects.update(flag_agn_wise=None, g_s=None, ls_g_s=None)
+        MetaObject.objects.update(flag_agn_wise=None, g_s=None, ls_g_s=None, tde_v3=None, tde_v3_ls=None)
+        self.calc()
+        self.assertEqual(self.get_flags(), incremental_flags)
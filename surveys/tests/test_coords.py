@@ -0,0 +1,68 @@
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+from astropy_healpix import HEALPix
+from django.test import SimpleTestCase
+import numpy as np
+
+from ..coords import (HPIDX_ORDER, angular_separation, healpix_cone_ranges, healpix_index, position_angle,
+                      unit_vectors)
+
+
+class CoordsTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.ra1 = rng.uniform(0, 360, 100)
+        self.dec1 = rng.uniform(-89, 89, 100)
+        # pairs from arcseconds to degrees apart, across RA = 0 and poles
+        self.ra2 = (self.ra1 + rng.normal(0, 0.01, 100) / np.cos(np.radians(self.dec1))) % 360
+        self.dec2 = np.clip(self.dec1 + rng.normal(0, 0.01, 100), -90, 90)
+        self.ra2[:10] = (self.ra1[:10] + rng.uniform(-30, 30, 10)) % 360
+        self.c1 = SkyCoord(self.ra1 * u.deg, self.dec1 * u.deg)
+        self.c2 = SkyCoord(self.ra2 * u.deg, self.dec2 * u.deg)
+
+    def test_angular_separation(self):
+        sep = angular_separation(self.ra1, self.dec1, self.ra2, self.dec2)
+        np.testing.assert_allclose(sep, self.c1.separation(self.c2).arcsec, rtol=1e-9, atol=1e-9)
+
+    def test_angular_separation_of_same_point(self):
+        self.assertEqual(angular_separation(10.0, 20.0, 10.0, 20.0), 0)
+
+    def test_position_angle(self):
+        pa = position_angle(self.ra1, self.dec1, self.ra2, self.dec2)
+        self.assertTrue(np.all((pa >= 0) & (pa < 360)))
+        diff = (pa - self.c1.position_angle(self.c2).deg + 180) % 360 - 180
+        np.testing.assert_allclose(diff, 0, atol=1e-7)
+
+    def test_position_angle_directions(self):
+        # North, East, South, West
+        np.testing.assert_allclose(position_angle([10] * 4, [0] * 4, [10, 11, 10, 9], [1, 0, -1, 0]),
+                                   [0, 90, 180, 270])
+
+    def test_unit_vectors(self):
+        cartesian = self.c1.cartesian
+        np.testing.assert_allclose(np.stack(unit_vectors(self.ra1, self.dec1)),
+                                   np.stack([cartesian.x.value, cartesian.y.value, cartesian.z.value]),
+                                   atol=1e-12)
+
+    def test_healpix_index(self):
+        hp = HEALPix(nside=2 ** HPIDX_ORDER, order='nested', frame='icrs')
+        np.testing.assert_array_equal(healpix_index(hp, self.ra1, self.dec1), hp.skycoord_to_healpix(self.c1))
+
+    def test_healpix_cone_ranges(self):
+        hp = HEALPix(nside=2 ** HPIDX_ORDER, order='nested', frame='icrs')
+        for ra, dec, radius in [(10, 20, 30 / 3600), (0, 0, 0.5), (359.9, -89.9, 0.2), (180, 45, 5)]:
+            ranges = healpix_cone_ranges(ra, dec, radius)
+            # sorted disjoint not adjacent ranges
+            for (start, stop), (next_start, next_stop) in zip(ranges, ranges[1:]):
+                self.assertLessEqual(start, stop)
+                self.assertGreater(next_start, stop + 1)
+
+            # points inside the cone are in the ranges
+            rng = np.random.default_rng(1)
+            points = SkyCoord(ra * u.deg, dec * u.deg).directional_offset_by(
+                rng.uniform(0, 360, 1000) * u.deg, radius * np.sqrt(rng.uniform(0, 1, 1000)) * u.deg)
+            pixels = healpix_index(hp, points.ra.deg, points.dec.deg)
+            starts = np.array([start for start, stop in ranges])
+            stops = np.array([stop for start, stop in ranges])
+            i = np.searchsorted(starts, pixels, side='right') - 1
+            self.assertTrue(np.all((i >= 0) & (pixels <= stops[i])))
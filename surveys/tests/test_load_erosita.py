@@ -0,0 +1,67 @@
+from io import StringIO
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+import numpy as np
+import pandas as pd
+
+from ..models import OriginFile, Survey, eROSITA
+
+
+class LoadErositaBulkTests(TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.work_dir = tmp_dir.name
+        settings_override = override_settings(WORK_DIR=self.work_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.survey = Survey.objects.create(name=1)
+
+    def write_sources(self, survey_inds, survey_num=1):
+        sources_num = len(survey_inds)
+        data = pd.DataFrame({
+            'survey_ind': survey_inds,
+            'name': [f'SRC{survey_ind}' for survey_ind in survey_inds],
+            'RA': np.linspace(10, 11, sources_num),
+            'DEC': np.linspace(-5, 5, sources_num),
+            'pos_r98': np.full(sources_num, 5.0),
+            'DET_LIKE_0': np.linspace(6, 60, sources_num),
+            'hpidx': np.arange(sources_num) * 7,
+            'survey': survey_num,
+            'file_name': 'ecat_1',
+        })
+        data.to_parquet(os.path.join(self.work_dir, f'xray_sources_{survey_num}.parquet'), index=False)
+        return data
+
+    def load(self, *args):
+        call_command('load_erosita', '1', '--bulk', *args, stdout=StringIO())
+
+    def test_bulk(self):
+        data = self.write_sources(list(range(23)))
+        fields = ['survey_ind', 'name', 'RA', 'DEC', 'pos_r98', 'DET_LIKE_0', 'hpidx']
+        # several chunks
+        self.load('--batch-size', '5')
+        sources = eROSITA.objects.order_by('survey_ind')
+
+        self.assertEqual(list(sources.values_list(*fields)), list(data[fields].itertuples(index=False, name=None)))
+        self.assertEqual(set(sources.values_list('survey', 'origin_file__file_name')),
+                         {(self.survey.pk, 'ecat_1')})
+        # unit vectors are filled without save()
+        source = sources.get(survey_ind=3)
+        np.testing.assert_allclose([source.c_x, source.c_y, source.c_z],
+                                   [np.cos(np.radians(source.DEC)) * np.cos(np.radians(source.RA)),
+                                    np.cos(np.radians(source.DEC)) * np.sin(np.radians(source.RA)),
+                                    np.sin(np.radians(source.DEC))])
+
+    def test_bulk_skips_existing_sources(self):
+        self.write_sources(list(range(12)))
+        self.load('--batch-size', '4')
+        # the same file is loaded again with new sources and duplicate rows spanning batches
+        self.write_sources(list(range(14)) + [13, 3])
+        self.load('--batch-size', '4')
+
+        self.assertEqual(eROSITA.objects.count(), 14)
+        self.assertEqual(OriginFile.objects.filter(file_name='ecat_1').count(), 1)
@@ -0,0 +1,97 @@
+from io import StringIO
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+import pandas as pd
+
+from ..coords import angular_separation
+from ..management.commands.load_optic import Command
+from ..models import LS, GAIA, Survey, eROSITA
+
+
+class LoadOpticTests(TestCase):
+    # (srcname_fin, hpidx) of xray sources and their coordinates
+    xray_sources = [('SRC1', 7, 10.0, 20.0), ('SRC2', 14, 30.0, -10.0)]
+    # optical sources near xray sources, the nearest ones are not first
+    ls_sources = [('SRC1', 7, 1, 10.0, 20.0008),
+                  ('SRC1', 7, 2, 10.0, 20.0002),
+                  ('SRC2', 14, 3, 30.0005, -10.0),
+                  ('SRC1', 7, 4, 10.0, 20.0005)]
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.work_dir = tmp_dir.name
+        settings_override = override_settings(WORK_DIR=self.work_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        for survey_num in [1, 2, 3, 4, 9]:
+            Survey.objects.create(name=survey_num)
+        survey = Survey.objects.get(name=1)
+        for survey_ind, (name, hpidx, ra, dec) in enumerate(LoadOpticTests.xray_sources):
+            eROSITA.objects.create(survey_ind=survey_ind, name=name, hpidx=hpidx, RA=ra, DEC=dec, survey=survey)
+
+        # files of all surveys are loaded, only LS file of the first survey has sources
+        for survey_num in [1, 2, 3, 4, 9]:
+            os.makedirs(os.path.join(self.work_dir, f'eRASS{survey_num}'))
+            for file_suffix in ['ls', 'sdss', 'ps', 'gaia']:
+                rows = LoadOpticTests.ls_sources if (survey_num, file_suffix) == (1, 'ls') else []
+                self.write_opt_sources(survey_num, file_suffix, rows)
+
+    def write_opt_sources(self, survey_num, file_suffix, rows):
+        data = pd.DataFrame(rows, columns=['srcname_fin', 'hpidx', 'objID', 'ra', 'dec'])
+        data = data.astype({'hpidx': 'int64', 'objID': 'int64', 'ra': 'float64', 'dec': 'float64'})
+        data['opt_id'] = data.groupby('srcname_fin').cumcount()
+        data['survey'] = survey_num
+        data['file_name'] = f'opt_{file_suffix}'
+        # columns of xray sources and all fields of the optical survey in their order, other fields are empty
+        data = data.reindex(columns=['srcname_fin', 'hpidx'] + getattr(Command, f'get_{file_suffix}_fields')())
+        data.to_parquet(os.path.join(self.work_dir, f'eRASS{survey_num}', f'opt_sources_{file_suffix}.parquet'),
+                        index=False)
+
+    def load(self, *args):
+        # one optical source per batch
+        call_command('load_optic', '--batch-size', '1', *args, stdout=StringIO())
+
+    def test_links(self):
+        self.load()
+
+        links = {(ls.objID, xray_source.name) for ls in LS.objects.all() for xray_source in ls.xray_sources.all()}
+        self.assertEqual(links, {(1, 'SRC1'), (2, 'SRC1'), (3, 'SRC2'), (4, 'SRC1')})
+        self.assertFalse(GAIA.objects.exists())
+
+        # links are not duplicated by loading again
+        self.load()
+        self.assertEqual(LS.xray_sources.through.objects.count(), 4)
+        self.assertEqual(LS.objects.count(), 4)
+
+    def test_counterparts(self):
+        self.load()
+
+        for name, obj_id in [('SRC1', 2), ('SRC2', 3)]:
+            xray_source = eROSITA.objects.get(name=name)
+            opt_source = LS.objects.get(objID=obj_id)
+            # the nearest linked optical source
+            self.assertEqual(xray_source.ls_dup, opt_source)
+            self.assertAlmostEqual(float(xray_source.ls_dup_sep),
+                                   float(angular_separation(xray_source.RA, xray_source.DEC,
+                                                            opt_source.ra, opt_source.dec)), places=4)
+            self.assertIsNone(xray_source.gaia_dup)
+
+    def test_counterparts_of_new_sources(self):
+        self.load()
+        # a farther optical source added to the file is linked without replacing the counterpart
+        ls_sources = LoadOpticTests.ls_sources + [('SRC1', 7, 5, 10.0, 20.0009)]
+        self.write_opt_sources(1, 'ls', ls_sources)
+        self.load()
+        self.assertEqual(eROSITA.objects.get(name='SRC1').ls_dup.objID, 2)
+        self.assertEqual(LS.xray_sources.through.objects.count(), 5)
+
+        # a nearer one replaces it
+        self.write_opt_sources(1, 'ls', ls_sources + [('SRC1', 7, 6, 10.0, 20.0001)])
+        self.load()
+        self.assertEqual(eROSITA.objects.get(name='SRC1').ls_dup.objID, 6)
+        self.assertEqual(eROSITA.objects.get(name='SRC2').ls_dup.objID, 3)
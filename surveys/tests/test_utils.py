@@ -0,0 +1,91 @@
+from django.test import SimpleTestCase
+import numpy as np
+import pandas as pd
+
+from ..coords import angular_separation, position_angle
+from ..models import LS, eROSITA
+from ..utils import DisjointSet, diff_row_hashes, get_opt_rows
+
+
+class DisjointSetTests(SimpleTestCase):
+    def test_groups(self):
+        sets = DisjointSet()
+        for x, y in [(1, 2), (3, 4), (2, 4), (5, 5), (6, 7)]:
+            sets.union(x, y)
+        sets.find(8)
+        groups = sorted(sorted(group) for group in sets.groups().values())
+        self.assertEqual(groups, [[1, 2, 3, 4], [5], [6, 7], [8]])
+
+    def test_find(self):
+        sets = DisjointSet()
+        self.assertEqual(sets.find('a'), 'a')
+        sets.union('a', 'b')
+        sets.union('c', 'b')
+        self.assertEqual(sets.find('b'), sets.find('c'))
+        self.assertEqual(sets.find('a'), sets.find('c'))
+
+    def test_long_chain(self):
+        sets = DisjointSet()
+        for i in range(10000):
+            sets.union(i + 1, i)
+        self.assertEqual(len(sets.groups()), 1)
+        self.assertEqual(sets.parent[0], sets.find(10000))
+
+
+class DiffRowHashesTests(SimpleTestCase):
+    def test_without_old_version(self):
+        new = pd.DataFrame({'row': [0, 1, 2], 'key': [10, 11, 10], 'hash': [1, 2, 3]})
+        inserted, updated, deleted = diff_row_hashes(None, new, ['key'])
+        # duplicate keys are loaded once
+        self.assertEqual(inserted.tolist(), [0, 1])
+        self.assertEqual(updated.tolist(), [])
+        self.assertTrue(deleted.empty)
+
+    def test_diff(self):
+        old = pd.DataFrame({'key': [1, 2, 3, 4], 'hash': [10, 20, 30, 40]})
+        new = pd.DataFrame({'row': [0, 1, 2, 3], 'key': [2, 3, 5, 1], 'hash': [20, 31, 50, 10]})
+        inserted, updated, deleted = diff_row_hashes(old, new, ['key'])
+        self.assertEqual(inserted.tolist(), [2])
+        self.assertEqual(updated.tolist(), [1])
+        self.assertEqual(deleted['key'].tolist(), [4])
+
+    def test_several_key_columns(self):
+        old = pd.DataFrame({'survey': [1, 1], 'name': ['a', 'b'], 'hash': [1, 2]})
+        new = pd.DataFrame({'row': [0, 1], 'survey': [2, 1], 'name': ['a', 'b'], 'hash': [1, 2]})
+        inserted, updated, deleted = diff_row_hashes(old, new, ['survey', 'name'])
+        self.assertEqual(inserted.tolist(), [0])
+        self.assertEqual(updated.tolist(), [])
+        self.assertEqual(deleted.values.tolist(), [[1, 'a']])
+
+
+class OptRowsTests(SimpleTestCase):
+    def get_opt_source(self, pk, ra, dec, separation=None, position_angle=None):
+        opt_source = LS(pk=pk, ra=ra, dec=dec)
+        # annotated by eROSITA.get_opt_survey_sources
+        opt_source.separation = separation
+        opt_source.position_angle = position_angle
+        return opt_source
+
+    def test_rows(self):
+        master_source = eROSITA(RA=10, DEC=20, pos_r98=5, ls_dup_id=2)
+        opt_sources = [self.get_opt_source(1, 10, 20.001, 3.6, 0),
+                       self.get_opt_source(3, 10.0012, 20, None),
+                       self.get_opt_source(2, 10, 20.0015, 5.4, 0)]
+        rows = get_opt_rows(master_source, opt_sources, 'LS')
+
+        # sorted by separation, missing ones are calculated
+        self.assertEqual([row.source.pk for row in rows], [1, 3, 2])
+        self.assertEqual([row.counterpart for row in rows], [False, False, True])
+        self.assertEqual([row.in_rc for row in rows], [True, True, True])
+        self.assertEqual(rows[0].separation, 3.6)
+        self.assertAlmostEqual(rows[1].separation, float(angular_separation(10, 20, 10.0012, 20)))
+        self.assertAlmostEqual(rows[1].position_angle, float(position_angle(10, 20, 10.0012, 20)))
+        self.assertAlmostEqual(rows[1].position_angle, 90, places=3)
+
+    def test_without_pos_r98(self):
+        master_source = eROSITA(RA=10, DEC=20, pos_r98=None)
+        rows = get_opt_rows(master_source, [self.get_opt_source(1, 10, 20, 0.0, 0)], 'LS')
+        self.assertEqual([(row.counterpart, row.in_rc) for row in rows], [(False, False)])
+
+    def test_without_sources(self):
+        self.assertEqual(get_opt_rows(eROSITA(RA=10, DEC=20), None, 'GAIA'), [])
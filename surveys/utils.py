@@ -1,26 +1,386 @@
+from collections import namedtuple
+import glob
 import textwrap
-from typing import Type, List, Callable
+from typing import Type, List, Callable, Iterable, Iterator, Optional, Tuple
 
 import astropy.units as u
 from astropy.coordinates import SkyCoord
 from django.core.management import BaseCommand
 from django.utils import timezone
+import numpy as np
 import pandas as pd
 import pickle
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 
-from surveys.models import eROSITA, MetaObject, Comment, OptComment
+from surveys.coords import HPIDX_ORDER, angular_separation, healpix_cone_ranges, position_angle, unit_vectors
+from surveys.models import eROSITA, MetaObject, Comment, OptComment, OriginFile, IngestCheckpoint
 from django.contrib.auth.models import User
 
 from django.conf import settings
 import os
+import shutil
 import datetime
 
 from django.utils.timezone import make_aware
 
-from django.db.models import ExpressionWrapper, FloatField, Model
-from django.db.models.functions.math import ACos, Cos, Radians, Pi, Sin
-from math import radians
+from django.db.models import ExpressionWrapper, F, FloatField, Model, Q, QuerySet, Value
+from django.db.models.functions import ASin, Least, Pi, Sqrt
+from math import radians, sin
+
+
+def format_temporal_columns(batch: pa.RecordBatch) -> pa.RecordBatch:
+    """Convert timestamp and date columns to ISO date strings.
+
+    Converters write native Arrow timestamps, models keep dates in
+    CharFields as 'YYYY-MM-DD' strings.
+    """
+    for i, field in enumerate(batch.schema):
+        if pa.types.is_timestamp(field.type):
+            column = pc.strftime(batch.column(i), format='%Y-%m-%d')
+        elif pa.types.is_date(field.type):
+            column = batch.column(i).cast(pa.string())
+        else:
+            continue
+        batch = batch.set_column(i, field.name, column)
+    return batch
+
+
+def hp_pixels_filter(pixels: Iterable[int], order: int,
+                     partitioning: Optional[ds.Partitioning] = None) -> ds.Expression:
+    """Return dataset filter of rows with `hpidx` inside nested HEALPix
+    `pixels` of `order`.
+
+    Rows are selected by `hpidx` ranges, which uses row group statistics of
+    sorted files. If dataset is partitioned by `hp_pixel_{order}` column
+    (see `write_partitioned_dataset`), partitions are pruned too.
+    """
+    pixels = sorted(set(pixels))
+    shift = 2 * (HPIDX_ORDER - order)
+    hpidx = ds.field('hpidx')
+    expression = None
+    for pixel in pixels:
+        pixel_range = (hpidx >= pixel << shift) & (hpidx < (pixel + 1) << shift)
+        expression = pixel_range if expression is None else expression | pixel_range
+    if expression is None:
+        raise ValueError('No HEALPix pixels to filter')
+
+    for name in (partitioning.schema.names if partitioning is not None else []):
+        if not name.startswith('hp_pixel_'):
+            continue
+        partition_order = int(name[len('hp_pixel_'):])
+        if partition_order <= order:
+            partition_pixels = {pixel >> 2 * (order - partition_order) for pixel in pixels}
+        else:
+            scale = 4 ** (partition_order - order)
+            partition_pixels = {pixel * scale + i for pixel in pixels for i in range(scale)}
+        expression = ds.field(name).isin(sorted(partition_pixels)) & expression
+    return expression
+
+
+def write_partitioned_dataset(file_path, order: int = 3, row_group_size: int = 100000):
+    """Replace Parquet file with Hive partitioned dataset in a directory
+    with the same name.
+
+    Rows are partitioned by `survey` and by nested HEALPix pixel of `hpidx`
+    of the `order` (column `hp_pixel_{order}`), rows of each file are sorted
+    by `hpidx`, so min/max statistics of row groups are tight.
+    """
+    source_path = file_path + '.tmp'
+    os.replace(file_path, source_path)
+    pixel_column = f'hp_pixel_{order}'
+    partitioning = ds.partitioning(pa.schema([('survey', pa.int64()), (pixel_column, pa.int64())]),
+                                   flavor='hive')
+    try:
+        dataset = ds.dataset(source_path, format='parquet')
+        columns = {name: ds.field(name) for name in dataset.schema.names}
+        columns['survey'] = ds.field('survey').cast(pa.int64())
+        columns[pixel_column] = pc.shift_right(ds.field('hpidx'), 2 * (HPIDX_ORDER - order))
+        ds.write_dataset(dataset.scanner(columns=columns), file_path, format='parquet',
+                         partitioning=partitioning, basename_template='part-{i}.parquet')
+
+        # sort rows of each file
+        for fragment in ds.dataset(file_path, format='parquet', partitioning=partitioning).get_fragments():
+            table = pq.read_table(fragment.path).sort_by('hpidx')
+            pq.write_table(table, fragment.path, row_group_size=row_group_size)
+    except Exception:
+        if os.path.isdir(file_path):
+            shutil.rmtree(file_path)
+        os.replace(source_path, file_path)
+        raise
+    os.remove(source_path)
+
+
+def iter_record_batches(file_path, columns: Optional[Iterable[str]] = None,
+                        batch_size: int = 10000, start: int = 0,
+                        filter=None) -> Iterator[Tuple[int, pa.RecordBatch]]:
+    """Yield (number of the first row, record batch) of Parquet file or
+    Hive partitioned dataset directory.
+
+    Only `columns` present in the file are read (all columns if None).
+    Row groups of a file before `start` row are not read. Datasets and
+    `filter` (expression or function of dataset partitioning returning it)
+    are read through `pyarrow.dataset` with predicate pushdown, rows are
+    numbered after filtering.
+    """
+    if os.path.isdir(file_path) or filter is not None:
+        dataset = ds.dataset(file_path, format='parquet', partitioning='hive')
+        if columns is not None:
+            dataset_columns = set(dataset.schema.names)
+            columns = [column for column in dict.fromkeys(columns) if column in dataset_columns]
+        if callable(filter):
+            filter = filter(dataset.partitioning)
+        batches = dataset.to_batches(columns=columns, filter=filter, batch_size=batch_size)
+        first_group = 0
+    else:
+        parquet_file = pq.ParquetFile(file_path)
+        if columns is not None:
+            file_columns = set(parquet_file.schema_arrow.names)
+            columns = [column for column in dict.fromkeys(columns)
+                       if column in file_columns]
+
+        # skip whole row groups before start row
+        first_group, group_start = 0, 0
+        while first_group < parquet_file.num_row_groups:
+            group_rows = parquet_file.metadata.row_group(first_group).num_rows
+            if group_start + group_rows > start:
+                break
+            group_start += group_rows
+            first_group += 1
+        batches = parquet_file.iter_batches(batch_size=batch_size,
+                                            row_groups=range(first_group, parquet_file.num_row_groups),
+                                            columns=columns)
+        first_group = group_start
+    skip = start - first_group
+
+    start = first_group
+    for batch in batches:
+        if skip:
+            batch_skip = min(skip, batch.num_rows)
+            batch = batch.slice(batch_skip)
+            start += batch_skip
+            skip -= batch_skip
+        if not batch.num_rows:
+            continue
+        yield start, batch
+        start += batch.num_rows
+
+
+def iter_parquet_batches(file_path, columns: Optional[Iterable[str]] = None,
+                         batch_size: int = 10000,
+                         start: int = 0,
+                         filter=None) -> Iterator[pd.DataFrame]:
+    """Read Parquet file or partitioned dataset by record batches.
+
+    Only `columns` present in the file are read (all columns if None), NaN
+    values are replaced with None in each batch. Index of a batch continues
+    row numbers of the file, so memory is bounded by batch size. Dictionary
+    columns are read as categoricals, timestamps as date strings.
+
+    :param file_path: path of Parquet file or dataset directory.
+    :param columns: names of columns to read, e.g. model fields.
+    :param batch_size: max number of rows in a batch.
+    :param start: number of rows to skip, row groups before it are not read.
+    :param filter: dataset filter expression, or function returning it by
+        partitioning of the dataset, e.g. from `hp_pixels_filter`.
+    """
+    for start, batch in iter_record_batches(file_path, columns, batch_size, start, filter):
+        yield record_batch_to_frame(batch, start)
+
+
+def record_batch_to_frame(batch: pa.RecordBatch, start: int = 0) -> pd.DataFrame:
+    """Convert record batch to DataFrame as rows of a file from `start`
+    row, see `iter_parquet_batches`."""
+    data = format_temporal_columns(batch).to_pandas()
+    data.index = pd.RangeIndex(start, start + len(data))
+    return data.replace({np.nan: None})
+
+
+def get_checkpoint(file_path, catalogue: str, resume: bool = False,
+                   batch_size: Optional[int] = None) -> IngestCheckpoint:
+    """Return checkpoint of loading catalogue from the input file.
+
+    The file is stored as OriginFile with path relative to WORK_DIR.
+    Checkpoint is reset unless `resume` is set.
+    """
+    origin_file, _ = OriginFile.objects.get_or_create(
+        file_name=os.path.relpath(file_path, settings.WORK_DIR))
+    checkpoint, created = IngestCheckpoint.objects.get_or_create(
+        origin_file=origin_file, catalogue=catalogue,
+        defaults={'batch_size': batch_size})
+    if not resume:
+        checkpoint.reset(batch_size)
+    elif checkpoint.status != IngestCheckpoint.DONE:
+        checkpoint.set_status(IngestCheckpoint.RUNNING)
+    return checkpoint
+
+
+# hash of null values in row hashes
+NULL_HASH = np.uint64(0x9E3779B97F4A7C15)
+
+
+def arrow_row_hashes(batch: pa.RecordBatch, columns: Iterable[str]) -> np.ndarray:
+    """Hash values of `columns` in each row of the batch.
+
+    Hashes depend only on values and column types from the file schema, so
+    they are the same for equal rows in any batch (unlike pandas frames,
+    where dtypes depend on nulls in the batch).
+    """
+    result = np.zeros(batch.num_rows, dtype=np.uint64)
+    for name in columns:
+        column = batch.column(name)
+        nulls = column.is_null().to_numpy(zero_copy_only=False)
+        if pa.types.is_boolean(column.type):
+            values = pc.fill_null(column, False).to_numpy(zero_copy_only=False)
+        elif (pa.types.is_integer(column.type) or pa.types.is_floating(column.type)
+              or pa.types.is_temporal(column.type)):
+            values = pc.fill_null(column, pa.scalar(0, column.type)).to_numpy(zero_copy_only=False)
+        else:
+            values = column.cast(pa.string()).to_numpy(zero_copy_only=False)
+        hashes = pd.util.hash_array(np.asarray(values))
+        hashes[nulls] = NULL_HASH
+        result = result * np.uint64(1000003) ^ hashes
+    return result
+
+
+def read_row_hashes(file_path, key_columns: List[str], columns: Iterable[str],
+                    batch_size: int = 10000) -> pd.DataFrame:
+    """Return table with `row` (row number in the file), key columns and
+    `hash` of values of `columns` (only present in the file) for all rows.
+    """
+    if os.path.isdir(file_path):
+        file_columns = set(ds.dataset(file_path, format='parquet', partitioning='hive').schema.names)
+    else:
+        file_columns = set(pq.ParquetFile(file_path).schema_arrow.names)
+    columns = [column for column in dict.fromkeys(columns) if column in file_columns]
+    read_columns = list(dict.fromkeys(key_columns + columns))
+
+    tables = []
+    for start, batch in iter_record_batches(file_path, read_columns, batch_size):
+        hashes = batch.select(key_columns).to_pandas()
+        hashes.insert(0, 'row', np.arange(start, start + batch.num_rows))
+        hashes['hash'] = arrow_row_hashes(batch, columns)
+        tables.append(hashes)
+
+    if not tables:
+        return pd.DataFrame(columns=['row'] + key_columns + ['hash'])
+    return pd.concat(tables, ignore_index=True)
+
+
+def row_hashes_path(origin_file: OriginFile) -> str:
+    """Path of the file with row hashes of the current version of input
+    file."""
+    return os.path.join(settings.WORK_DIR, 'hashes',
+                        f'{origin_file.file_name}.v{origin_file.version}.parquet')
+
+
+def load_row_hashes(origin_file: OriginFile) -> Optional[pd.DataFrame]:
+    """Return row hashes of the current version of input file, None if
+    there are no stored hashes."""
+    path = row_hashes_path(origin_file)
+    if not os.path.isfile(path):
+        return None
+    return pd.read_parquet(path)
+
+
+def save_row_hashes(origin_file: OriginFile, hashes: pd.DataFrame):
+    """Store row hashes as the next version of input file."""
+    old_path = row_hashes_path(origin_file)
+    origin_file.version = (origin_file.version or 0) + 1
+    path = row_hashes_path(origin_file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    hashes.drop(columns='row').to_parquet(path, index=False)
+    origin_file.save()
+    if os.path.isfile(old_path):
+        os.remove(old_path)
+
+
+def clear_row_hashes(origin_files: Iterable[OriginFile]) -> int:
+    """Delete stored row hashes of all versions of input files and reset
+    their versions, the next incremental load treats all rows as inserted.
+
+    :return: number of deleted files.
+    """
+    removed_num = 0
+    origin_files = list(origin_files)
+    for origin_file in origin_files:
+        pattern = os.path.join(settings.WORK_DIR, 'hashes', glob.escape(origin_file.file_name) + '.v*.parquet')
+        for path in glob.glob(pattern):
+            os.remove(path)
+            removed_num += 1
+        origin_file.version = OriginFile._meta.get_field('version').default
+    OriginFile.objects.bulk_update(origin_files, ['version'], batch_size=1000)
+    return removed_num
+
+
+def diff_row_hashes(old: Optional[pd.DataFrame], new: pd.DataFrame,
+                    key_columns: List[str]) -> Tuple[np.ndarray, np.ndarray, pd.DataFrame]:
+    """Compare row hashes of two versions of input file.
+
+    :param old: hashes of the previous version or None, if there is no one.
+    :param new: hashes of the new version from `read_row_hashes`.
+
+    :return: rows of new version to insert and to update, keys of deleted
+        rows.
+    """
+    new = new.drop_duplicates(key_columns)
+    if old is None:
+        return new['row'].to_numpy(), np.array([], dtype=int), new.iloc[:0][key_columns]
+
+    merged = old.drop_duplicates(key_columns).merge(new, on=key_columns, how='outer',
+                                                    suffixes=('_old', ''), indicator=True)
+    inserted = merged.loc[merged['_merge'] == 'right_only', 'row']
+    updated = merged.loc[(merged['_merge'] == 'both') & (merged['hash_old'] != merged['hash']), 'row']
+    deleted = merged.loc[merged['_merge'] == 'left_only', key_columns]
+    return inserted.astype(int).to_numpy(), updated.astype(int).to_numpy(), deleted
+
+
+def filter_in_chunks(queryset: QuerySet, field: str, values: Iterable,
+                     chunk_size: int = 500) -> Iterator[Model]:
+    """Yield objects of queryset with `field` value in `values`, keeping
+    the number of query parameters below database limits."""
+    values = list(values)
+    for i in range(0, len(values), chunk_size):
+        yield from queryset.filter(**{field + '__in': values[i:i + chunk_size]})
+
+
+def calculate_link_separations(through: Type[Model], links: pd.DataFrame) -> pd.DataFrame:
+    """Return `links` with `sep` (arcseconds) and `pa` (degrees) columns
+    calculated from coordinates of linked sources, for links created before
+    separations were stored. Pairs without coordinates get NaN.
+
+    :param through: through model of `xray_sources` of optical survey.
+    :param links: table with `opt_pk` and `xray_pk` columns.
+    """
+    opt_model = through._meta.get_field(through.opt_field).related_model
+    opt_coords = pd.DataFrame.from_records(
+        list(filter_in_chunks(opt_model.objects.values_list('pk', 'ra', 'dec'), 'pk',
+                              links['opt_pk'].unique().tolist())),
+        columns=['pk', 'ra', 'dec']).set_index('pk')
+    xray_coords = pd.DataFrame.from_records(
+        list(filter_in_chunks(eROSITA.objects.values_list('pk', 'RA', 'DEC'), 'pk',
+                              links['xray_pk'].unique().tolist())),
+        columns=['pk', 'RA', 'DEC']).set_index('pk')
+    opt_coords = opt_coords.reindex(links['opt_pk']).to_numpy(dtype=float)
+    xray_coords = xray_coords.reindex(links['xray_pk']).to_numpy(dtype=float)
+    coords = (xray_coords[:, 0], xray_coords[:, 1], opt_coords[:, 0], opt_coords[:, 1])
+    return links.assign(sep=angular_separation(*coords), pa=position_angle(*coords))
+
+
+def mark_pre_class_dirty(xray_pks: Iterable[int]) -> int:
+    """Mark eROSITA sources and their meta objects for recalculation of
+    pre-class flags by `calc_pre_class --incremental`.
+
+    :return: number of marked eROSITA sources.
+    """
+    xray_pks = sorted(set(int(pk) for pk in xray_pks))
+    for i in range(0, len(xray_pks), 500):
+        chunk = xray_pks[i:i + 500]
+        eROSITA.objects.filter(pk__in=chunk).update(pre_class_dirty=True)
+        MetaObject.objects.filter(object_sources__in=chunk).update(pre_class_dirty=True)
+    return len(xray_pks)
 
 
 def add_metadata_fields(comment_df):
@@ -44,6 +404,48 @@ def get_sep(master_source, opt_source):
     return sep.arcsecond
 
 
+# row of optical sources table of the source page
+OptRow = namedtuple('OptRow', ['source', 'separation', 'position_angle', 'counterpart', 'in_rc'])
+
+
+def get_opt_rows(master_source: eROSITA, opt_sources: Optional[QuerySet],
+                 opt_survey_name: str) -> List[OptRow]:
+    """Return rows of optical sources table of the master source in one pass.
+
+    Separations (arcseconds) and position angles (degrees) are taken from
+    links, missing ones are calculated at once with NumPy, rows are sorted
+    by separation. Counterpart is found by `*_dup_id` of the master source,
+    sources within 1.1 * pos_r98 are in the radius of correlation.
+
+    :param opt_sources: optical sources as returned by
+        `eROSITA.get_opt_survey_sources`.
+    """
+    if not opt_sources:
+        return []
+
+    opt_sources = list(opt_sources)
+    separations = np.array([opt_source.separation for opt_source in opt_sources], dtype=float)
+    angles = np.array([opt_source.position_angle for opt_source in opt_sources], dtype=float)
+    missing = np.isnan(separations) | np.isnan(angles)
+    if missing.any():
+        coords = (master_source.RA, master_source.DEC,
+                  [opt_source.ra for opt_source, is_missing in zip(opt_sources, missing) if is_missing],
+                  [opt_source.dec for opt_source, is_missing in zip(opt_sources, missing) if is_missing])
+        separations[missing] = angular_separation(*coords)
+        angles[missing] = position_angle(*coords)
+
+    dup_pk = getattr(master_source, opt_survey_name.lower() + '_dup_id')
+    # no sources are in the radius of correlation of master source without pos_r98
+    rc = -np.inf if master_source.pos_r98 is None else 1.1 * master_source.pos_r98
+    in_rc = (separations < rc).tolist()
+    # stable sort keeps order of links with equal separations
+    order = np.argsort(separations, kind='stable')
+    rows = [OptRow(opt_source, sep, pa, opt_source.pk == dup_pk, is_in_rc)
+            for opt_source, sep, pa, is_in_rc
+            in zip(opt_sources, separations.tolist(), angles.tolist(), in_rc)]
+    return [rows[i] for i in order]
+
+
 def change_opt_cp(source, opt_survey_name, opt_id):
     opt_sources = eROSITA.get_opt_survey_sources(source, opt_survey_name)
     if opt_sources is None:
@@ -54,9 +456,13 @@ def change_opt_cp(source, opt_survey_name, opt_id):
         return 'No opt sources with this opt_id'
 
     new_opt_cp = new_opt_cp[0]
-    new_sep = get_sep(source, new_opt_cp)
+    # separation is stored in the link
+    new_sep = new_opt_cp.separation
+    if new_sep is None:
+        new_sep = get_sep(source, new_opt_cp)
     print('Opt source:', new_opt_cp, 'sep:', new_sep)
     eROSITA.change_dup_source(source, opt_survey_name, new_opt_cp, new_sep)
+    mark_pre_class_dirty([source.pk])
     return 1
 
 
@@ -138,11 +544,17 @@ def restore_comments(saved_comments, com_type='Xray'):
 
 def cone_search_filter(queryset, ra, dec, radius):
     """
-    Executes cone search by annotating each target with separation distance from the specified RA/Dec.
-    Formula is from Wikipedia: https://en.wikipedia.org/wiki/Angular_distance
-    The result is converted to radians.
+    Executes cone search by comparing squared chord distance between unit
+    vectors (`c_x`, `c_y`, `c_z`) of targets and the specified RA/Dec with
+    the chord of the radius: |v - v0|^2 <= (2 sin(r / 2))^2. Only arithmetic
+    is evaluated in SQL for filtering, selected targets are annotated with
+    `separation` in degrees (2 asin(|v - v0| / 2)).
+
+    Targets are preselected by the declination band on indexed `c_z` and, if
+    `hpidx` is indexed, by ranges of `hpidx` (nested HEALPix pixels covering
+    the cone, see `healpix_cone_ranges`).
 
-    :param queryset: Queryset of Target objects
+    :param queryset: Queryset of Target objects with `hpidx` and unit vector fields
     :type queryset: Target
 
     :param ra: Right ascension of center of cone.
@@ -158,22 +570,26 @@ def cone_search_filter(queryset, ra, dec, radius):
     dec = float(dec)
     radius = float(radius)
 
-    # Cone search is preceded by a square search to reduce the search radius before annotating the queryset, in
-    # order to make the query faster.
-    double_radius = radius * 2
-    queryset = queryset.filter(
-        RA__gte=ra - double_radius, RA__lte=ra + double_radius,
-        DEC__gte=dec - double_radius, DEC__lte=dec + double_radius
-    )
+    # declination band, c_z = sin(dec)
+    queryset = queryset.filter(c_z__gte=sin(radians(max(dec - radius, -90))) - 1e-12,
+                               c_z__lte=sin(radians(min(dec + radius, 90))) + 1e-12)
 
-    separation = ExpressionWrapper(
-        180/Pi() * ACos(
-            (Sin(radians(dec)) * Sin(Radians('DEC'))) +
-            (Cos(radians(dec)) * Cos(Radians('DEC')) * Cos(radians(ra) - Radians('RA')))
-        ), FloatField()
-    )
+    # hpidx is used only if it is indexed (calculated from RA, DEC by MetaObject),
+    # hpidx of eROSITA sources is taken from input files
+    if queryset.model._meta.get_field('hpidx').db_index:
+        hpidx_filter = Q()
+        for start, stop in healpix_cone_ranges(ra, dec, radius):
+            hpidx_filter |= Q(hpidx__range=(start, stop))
+        queryset = queryset.filter(hpidx_filter)
 
-    return queryset.annotate(separation=separation).filter(separation__lte=radius)
+    c_x, c_y, c_z = (float(c) for c in unit_vectors(ra, dec))
+    d_x, d_y, d_z = F('c_x') - c_x, F('c_y') - c_y, F('c_z') - c_z
+    chord2 = ExpressionWrapper(d_x * d_x + d_y * d_y + d_z * d_z, FloatField())
+
+    max_chord = 2 * sin(radians(min(radius, 180)) / 2)
+    queryset = queryset.alias(chord2=chord2).filter(chord2__lte=max_chord ** 2)
+    return queryset.annotate(separation=ExpressionWrapper(
+        360 / Pi() * ASin(Least(Sqrt(F('chord2')) / 2, Value(1.0))), FloatField()))
 
 
 def string_representation(include_fields: List[str] = None,
@@ -233,3 +649,36 @@ def help_from_docstring(model: Type[BaseCommand]):
     """Set's class `help` attribute equal to `__doc__`."""
     setattr(model, "help", textwrap.dedent(model.__doc__))
     return model
+
+
+class DisjointSet:
+    """Disjoint-set (union-find) structure with path compression.
+
+    Elements are any hashable objects, each new element forms its own set.
+    """
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        """Return root element of the set containing x."""
+        root = self.parent.setdefault(x, x)
+        while root != self.parent[root]:
+            root = self.parent[root]
+        # path compression
+        while x != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, x, y):
+        """Join sets containing x and y."""
+        root_x, root_y = self.find(x), self.find(y)
+        if root_x != root_y:
+            self.parent[root_y] = root_x
+
+    def groups(self) -> dict:
+        """Return dict {root element: list of elements of its set}."""
+        result = {}
+        for x in self.parent:
+            result.setdefault(self.find(x), []).append(x)
+        return result
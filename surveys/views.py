@@ -14,7 +14,7 @@ from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 
 from django.db.models import F, Count
 
-from surveys.utils import cone_search_filter, change_opt_cp
+from surveys.utils import cone_search_filter, change_opt_cp, get_opt_rows
 
 import csv
 
@@ -97,15 +97,14 @@ def source(request, pk):
     # print(f'Master source:{master_source}\n')
 
     opt_surveys = ['LS', 'PS', 'SDSS', 'GAIA']
-    # get list of query sets - optical sources from different surveys
+    # get list of table rows - optical sources from different surveys
     opt_sources = []
     opt_sources_ids = []
     for s_name in opt_surveys:
-        s_name_sources = eROSITA.get_opt_survey_sources(master_source, s_name)
-        opt_sources.append(s_name_sources)
+        s_name_rows = get_opt_rows(master_source, eROSITA.get_opt_survey_sources(master_source, s_name), s_name)
+        opt_sources.append(s_name_rows)
         # get opt_ids from all opt sources
-        if s_name_sources:
-            opt_sources_ids.append(list(s_name_sources.values_list('opt_id', flat=True)))
+        opt_sources_ids.append([row.source.opt_id for row in s_name_rows])
 
     # list of lists to list
     opt_sources_ids = sum(opt_sources_ids, [])